@@ -0,0 +1,240 @@
+"""Posting activity for every user, aggregated in bulk with NumPy.
+
+The stats job reads message timestamps, likes and follows as columns,
+ANALYTICS_FETCH rows at a time, and folds each chunk into histograms for
+all users at once: one np.bincount over `user_id * buckets + bucket`
+per chunk, over just the chunk's range of user ids, rather than a GROUP
+BY per user. Users who sign up while it runs wait for the next run. Archived messages
+(archive.py) are read straight out of their segments' columns.
+
+Results go in user_stats, one row per user with any activity, so a
+stats page is one primary-key lookup:
+
+    hourly          messages per hour of day (UTC), 24 buckets
+    weekly          messages per week, WEEKS buckets, oldest first
+    followers       follower count at the end of each of those weeks
+    messages        total messages
+    likes_received  likes on those messages
+
+Follows made before follows had a timestamp count as older than the
+window. Run it daily (cron):
+
+    python analytics.py
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from models import User, Message, Likes, Follows, UserStats
+
+HOURS = 24
+WEEKS = 26
+
+HOUR = 3600
+WEEK = 7 * 24 * HOUR
+
+ANALYTICS_FETCH = 100000
+
+WRITE_BATCH = 1000
+
+
+def epoch(column):
+    return func.extract('epoch', column)
+
+
+def chunks(conn, query):
+    """Columns of `query`'s rows as float64 arrays, a chunk at a time.
+
+    NULLs come back as NaN.
+    """
+
+    result = conn.execution_options(stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(ANALYTICS_FETCH)
+            if not rows:
+                break
+            yield np.array([tuple(row) for row in rows],
+                           dtype=np.float64).reshape(len(rows), -1).T
+    finally:
+        result.close()
+
+
+class Activity:
+    """Histograms for users 0..`size`-1, added to a chunk at a time.
+
+    `now` (seconds since the Unix epoch) is the end of the newest week.
+    """
+
+    def __init__(self, size, now):
+        self.size = size
+        self.now = now
+
+        self.hourly = np.zeros((size, HOURS), dtype=np.int32)
+        self.weekly = np.zeros((size, WEEKS), dtype=np.int32)
+        # column 0: followed before the first week shown
+        self.new_followers = np.zeros((size, WEEKS + 1), dtype=np.int32)
+        self.likes_received = np.zeros(size, dtype=np.int32)
+
+    def _add(self, totals, user_ids, buckets=None):
+        """Add to `totals` (size rows, a column per bucket, if any) a count
+        of each user (and bucket) pair, over the chunk's ids only."""
+
+        keep = user_ids < self.size
+        user_ids = user_ids[keep]
+        if not len(user_ids):
+            return
+
+        low = int(user_ids.min())
+        high = int(user_ids.max()) + 1
+
+        if buckets is None:
+            totals[low:high] += np.bincount(
+                user_ids - low, minlength=high - low).astype(np.int32)
+            return
+
+        width = totals.shape[1]
+        counts = np.bincount((user_ids - low) * width + buckets[keep],
+                             minlength=(high - low) * width)
+        totals[low:high] += counts.reshape(high - low, width).astype(np.int32)
+
+    def _weeks(self, epochs):
+        """Week of each time: WEEKS - 1 is this week; negative is older."""
+
+        age = np.floor((self.now - epochs) / WEEK).astype(np.int64)
+        return WEEKS - 1 - np.maximum(age, 0)
+
+    def add_messages(self, user_ids, epochs):
+        user_ids = user_ids.astype(np.int64)
+
+        hours = (np.floor(epochs / HOUR) % HOURS).astype(np.int64)
+        self._add(self.hourly, user_ids, hours)
+
+        weeks = self._weeks(epochs)
+        recent = weeks >= 0
+        self._add(self.weekly, user_ids[recent], weeks[recent])
+
+    def add_likes(self, author_ids):
+        self._add(self.likes_received, author_ids.astype(np.int64))
+
+    def add_follows(self, followed_ids, epochs):
+        # untimed follows are as old as can be
+        weeks = self._weeks(np.nan_to_num(epochs))
+        self._add(self.new_followers, followed_ids.astype(np.int64),
+                  np.maximum(weeks + 1, 0))
+
+    @property
+    def messages(self):
+        return self.hourly.sum(axis=1)
+
+    @property
+    def followers(self):
+        """(size, WEEKS) follower counts at the end of each week."""
+
+        return self.new_followers.cumsum(axis=1)[:, 1:]
+
+    def rows(self, computed_at):
+        """user_stats rows for every user with any activity."""
+
+        messages = self.messages
+        followers = self.followers
+
+        active = np.flatnonzero(
+            (messages > 0) | (self.likes_received > 0) | (followers[:, -1] > 0))
+
+        for user_id in active.tolist():
+            yield {
+                'user_id': user_id,
+                'computed_at': computed_at,
+                'hourly': self.hourly[user_id].tolist(),
+                'weekly': self.weekly[user_id].tolist(),
+                'followers': followers[user_id].tolist(),
+                'messages': int(messages[user_id]),
+                'likes_received': int(self.likes_received[user_id]),
+            }
+
+
+def compute(conn, cold=None, now=None):
+    """Activity of every user, read from `conn` (and the Archive `cold`)."""
+
+    now = now if now is not None else time.time()
+
+    users = User.__table__
+    messages = Message.__table__
+    likes = Likes.__table__
+    follows = Follows.__table__
+
+    last_id = conn.execute(select([func.max(users.c.id)])).scalar() or 0
+    activity = Activity(last_id + 1, now)
+
+    for user_ids, epochs in chunks(conn, select(
+            [messages.c.user_id, epoch(messages.c.timestamp)])):
+        activity.add_messages(user_ids, epochs)
+
+    if cold is not None:
+        for segment in cold.refresh().segments.values():
+            activity.add_messages(np.asarray(segment.user_ids),
+                                  np.asarray(segment.timestamps) / 1e6)
+
+    for (author_ids,) in chunks(conn, select([messages.c.user_id]).select_from(
+            likes.join(messages, likes.c.message_id == messages.c.id))):
+        activity.add_likes(author_ids)
+
+    for followed_ids, epochs in chunks(conn, select(
+            [follows.c.user_being_followed_id, epoch(follows.c.timestamp)])):
+        activity.add_follows(followed_ids, epochs)
+
+    return activity
+
+
+def save(conn, activity, computed_at):
+    """Replace user_stats with `activity`; returns the rows written."""
+
+    table = UserStats.__table__
+    rows = list(activity.rows(computed_at))
+
+    for start in range(0, len(rows), WRITE_BATCH):
+        stmt = insert(table).values(rows[start:start + WRITE_BATCH])
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id],
+            set_={column: stmt.excluded[column] for column in
+                  ('computed_at', 'hourly', 'weekly', 'followers',
+                   'messages', 'likes_received')}))
+
+    # users with no activity left
+    conn.execute(table.delete().where(table.c.computed_at < computed_at))
+
+    return len(rows)
+
+
+def run(engine, cold=None):
+    """Recompute every user's stats; returns how many users have some."""
+
+    computed_at = datetime.utcnow()
+
+    with engine.connect() as conn:
+        activity = compute(conn, cold, now=time.time())
+
+    with engine.begin() as conn:
+        return save(conn, activity, computed_at)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Recompute every user's activity stats.")
+    parser.parse_args()
+
+    import archive
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        started = time.time()
+        count = run(db.engine, archive.store(app.config['ARCHIVE_DIR']))
+        print(f"stats for {count} users in {time.time() - started:.1f}s")
@@ -1,45 +1,233 @@
+import heapq
+import hmac
+import mimetypes
 import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+import tempfile
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import partial
+
+from flask import (Blueprint, Flask, Response, render_template, request, flash,
+                   redirect, session, g, jsonify, current_app, abort,
+                   get_flashed_messages, has_request_context,
+                   send_from_directory, stream_with_context)
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.exceptions import NotFound
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
 
+import archive
+import assets
+import cache
+import export
+import images
+from cache import TTLCache
+from compression import CompressionMiddleware, accepted_encodings
 from forms import UserAddForm, LoginForm, MessageForm, EditUserForm
-from models import db, connect_db, User, Message, Likes
+from ids import datetime_from_id, id_from_datetime
+from models import (db, connect_db, User, Message, MessageTag, Follows, Likes,
+                    Notification, UserStats, PurgeJob)
+import notifications
+from notifications import notifier
+from profiler import profiler
+import purge
+from purge import purger
+import ranking
+from querybudget import query_budget, query_budget_guard
+import read_models
+from read_models import message_cards, user_cards, stream
+from tags import index_message
+from traffic import traffic
+import trending
+from trending import trends
+from write_behind import write_behind, LIKE, FOLLOW
 
 CURR_USER_KEY = "curr_user"
+FOLLOWS_VERSION_KEY = "follows_version"
+
+bp = Blueprint('warbler', __name__)
 
-app = Flask(__name__)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+def create_app(config=None):
+    """Create and configure a Warbler app.
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+    `config` (a dict) is applied over the defaults below, which come from
+    environment variables where it matters for deployment.
 
-connect_db(app)
+    The debug toolbar is only imported and installed when it would be
+    shown (DEBUG_TB_ENABLED, which defaults to debug mode). Set WARM_UP to
+    start warming the app up in the background (see startup.py).
+    """
+
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+    app.config['WRITE_BEHIND'] = bool(os.environ.get('WRITE_BEHIND'))
+    app.config['WARM_UP'] = bool(os.environ.get('WARM_UP'))
+    app.config['WARM_UP_BUDGET'] = float(os.environ.get('WARM_UP_BUDGET', 20))
+    app.config['WARM_UP_USERS'] = 1000
+    app.config['WARM_UP_DAYS'] = 7
+    app.config['WARM_UP_WORKERS'] = 4
+    app.config['CACHE_ENABLED'] = True
+    app.config['JINJA_CACHE_DIR'] = os.environ.get(
+        'JINJA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'warbler-jinja'))
+    app.config['COMPRESS'] = True
+    app.config['COMPRESS_MIN_SIZE'] = 500
+    app.config['ASSETS_DIR'] = assets.ASSETS_DIR
+    app.config['MEDIA_DIR'] = os.environ.get('MEDIA_DIR', images.MEDIA_DIR)
+    app.config['IMAGE_WORKERS'] = None
+    app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024
+    app.config['PROFILE_SAMPLE_RATE'] = float(
+        os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN')
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['QUERY_BUDGET_MODE'] = os.environ.get('QUERY_BUDGET_MODE', 'off')
+    app.config['TRAFFIC_CAPTURE_RATE'] = float(
+        os.environ.get('TRAFFIC_CAPTURE_RATE', 0))
+    app.config['EXPORT_DIR'] = os.environ.get(
+        'EXPORT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'exports'))
+    app.config['EXPORT_WORKERS'] = 2
+    app.config['EXPORT_RETENTION'] = 24 * 60 * 60
+    app.config['ARCHIVE_DIR'] = os.environ.get('ARCHIVE_DIR',
+                                               archive.ARCHIVE_DIR)
+    app.config['TRENDS_DIR'] = os.environ.get('TRENDS_DIR', trending.TRENDS_DIR)
+    app.config['TRENDS_INTERVAL'] = 30.0
+
+    if config:
+        app.config.update(config)
+
+    # after the overrides, so a config's DEBUG decides it too
+    app.config.setdefault('DEBUG_TB_ENABLED', app.debug)
+
+    # compiled templates are shared by every worker (and survive restarts)
+    if app.config['JINJA_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+        app.jinja_options = dict(
+            app.jinja_options,
+            bytecode_cache=FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR']))
+
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    app.jinja_env.globals['asset_url'] = partial(
+        assets.asset_url, assets_dir=app.config['ASSETS_DIR'])
+    app.jinja_env.filters['image_variant'] = images.image_variant
+    app.jinja_env.globals['user_counts'] = user_counts
+    app.jinja_env.globals['followed_ids'] = followed_ids
+    app.jinja_env.globals['trending_now'] = trending_now
+
+    connect_db(app)
+    write_behind.init_app(app)
+    profiler.init_app(app)
+    query_budget_guard.init_app(app)
+    traffic.init_app(app)
+    notifier.init_app(app)
+    trends.init_app(app)
+    purger.init_app(app)
+
+    if app.config['COMPRESS']:
+        app.wsgi_app = CompressionMiddleware(
+            app.wsgi_app, min_size=app.config['COMPRESS_MIN_SIZE'])
+
+    app.register_blueprint(bp)
+
+    @app.cli.command('warm-up')
+    def warm_up_command():
+        """Compile templates, open connections and fill the caches."""
+
+        from startup import warm_up, warm_caches
+        print(warm_up(app))
+        print(warm_caches(app))
+
+    if app.config['WARM_UP']:
+        from startup import warm_up_state
+        warm_up_state.start(app)
+
+    return app
+
+
+def __getattr__(name):
+    """Build the module-level `app` on first use.
+
+    Keeps `from app import app` (tests, `flask run`) working without making
+    every import of this module construct an app.
+    """
+
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
         g.user = User.query.get(session[CURR_USER_KEY])
 
+        # a deleted account is logged out wherever it was logged in
+        if g.user and g.user.deleted_at is not None:
+            do_logout()
+            g.user = None
+
+        # pages list follows straight from the database, so make sure
+        # the user sees their own buffered follows there
+        if g.user and write_behind.has_pending(FOLLOW, g.user.id):
+            write_behind.flush_user(FOLLOW, g.user.id)
+
     else:
         g.user = None
 
 
+def followed_ids():
+    """Ids of the users the logged-in user follows (cached).
+
+    For pages that show a follow button per user card; asking
+    `g.user.is_following` for each card is a query per card.
+    """
+
+    if not g.user:
+        return frozenset()
+
+    return following_of(g.user.id)
+
+
+def liked_ids(message_ids):
+    """Which of `message_ids` the logged-in user likes, counting their
+    buffered likes.
+
+    Read off the likes primary key, (user_id, message_id), alone.
+    """
+
+    message_ids = list(message_ids)
+    found = ()
+    if message_ids:
+        found = [message_id for (message_id,) in
+                 db.session.query(Likes.message_id)
+                 .filter(Likes.user_id == g.user.id,
+                         Likes.message_id.in_(message_ids))]
+
+    return write_behind.overlay(LIKE, g.user.id, found)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -53,7 +241,327 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+##############################################################################
+# Feed pagination
+#
+# Message ids are time-ordered (see ids.py), so feeds page on the primary
+# key: `?before=<id>` returns the page of messages older than that id.
+#
+# messages is partitioned by month of id (see partitions.py). Message
+# feeds look back one window at a time, newest first, each query bounded
+# on both sides so the planner only touches the partitions inside it.
+# Busy feeds fill a page from the first window; quiet ones widen out.
+
+PAGE_SIZE = 100
+
+# how far back from the cursor each successive query looks; None: no limit
+FEED_WINDOWS = (timedelta(days=31), timedelta(days=124), timedelta(days=490),
+                None)
+
+
+def page_before(query, column=Message.id):
+    """Newest-first page of `query`, starting below the `before` cursor."""
+
+    before = request.args.get('before', type=int)
+    if before is not None:
+        query = query.filter(column < before)
+
+    return query.order_by(column.desc()).limit(PAGE_SIZE)
+
+
+def feed_page(query, column=Message.id):
+    """Newest-first page of messages from `query`, below the `before` cursor.
+
+    `query` is a Core select, e.g. read_models.message_select(). A
+    generator of its rows, read in FEED_WINDOWS steps back in time until
+    the page is full. `column` is what the feed orders on; it must equal
+    Message.id (e.g. MessageTag.message_id), which is bounded too so
+    partitions are pruned.
+    """
+
+    upper = request.args.get('before', type=int)
+    newest = datetime.utcnow()
+    if upper is not None and upper < id_from_datetime(newest):
+        newest = datetime_from_id(upper)
+    remaining = PAGE_SIZE
+
+    for window in FEED_WINDOWS:
+        page = query
+        if upper is not None:
+            page = page.where(column < upper)
+            if column is not Message.id:
+                page = page.where(Message.id < upper)
+
+        lower = None
+        if window is not None:
+            lower = id_from_datetime(newest - window)
+            page = page.where(column >= lower)
+            if column is not Message.id:
+                page = page.where(Message.id >= lower)
+
+        for row in stream(page.order_by(column.desc()).limit(remaining)):
+            remaining -= 1
+            yield row
+
+        if not remaining or lower is None:
+            return
+        upper = lower
+
+
+##############################################################################
+# Cold archive
+#
+# Old, unliked messages live in segment files (see archive.py), not the
+# messages table. Profiles read through to them once a page crosses the
+# archive's cutoff; other feeds only show what's still hot.
+
+
+def cold_archive():
+    return archive.store(current_app.config['ARCHIVE_DIR'])
+
+
+def message_count(user):
+    """How many messages `user` has, hot and archived.
+
+    A message can be in both for a while (the archive job was
+    interrupted); only hot ones below the cutoff can be, and those are
+    counted once.
+    """
+
+    cold = cold_archive()
+    archived = cold.user_count(user.id)
+    if not archived:
+        return Message.query.filter(Message.user_id == user.id).count()
+
+    hot, old_ids = (db.session
+                    .query(func.count(Message.id),
+                           func.array_agg(Message.id)
+                           .filter(Message.id < cold.cutoff))
+                    .filter(Message.user_id == user.id)
+                    .one())
+    both = sum(1 for message_id in old_ids or () if cold.contains(message_id))
+    return hot + archived - both
+
+
+##############################################################################
+# Cached reads
+#
+# Per-worker caches (cache.py) of what most logged-in pages need: who a
+# user follows, their profile counts, and the first page of their home
+# timeline; and of the pages everyone piles onto at once: a popular
+# message, a popular profile. Pages are cached as read-model cards
+# (read_models.py), which belong to no session. Writes below drop the
+# entries they change; other workers see changes when their copies expire.
+# What depends on who a user follows is keyed on a count of their follow
+# changes kept in their session (follows_key), so they see their own
+# follows and unfollows on every worker straight away.
+#
+# Loads are single-flight, so a crowd missing on one key runs its
+# queries once; with `stale_ttl`, the crowd gets the old page while one
+# request refreshes it.
+
+follow_cache = TTLCache('follows', maxsize=20000, ttl=300)
+counts_cache = TTLCache('counts', maxsize=20000, ttl=60, stale_ttl=60)
+timeline_cache = TTLCache('timelines', maxsize=5000, ttl=30, stale_ttl=30)
+message_cache = TTLCache('messages', maxsize=10000, ttl=10, stale_ttl=60)
+profile_cache = TTLCache('profiles', maxsize=5000, ttl=10, stale_ttl=60)
+trend_cache = TTLCache('trends', maxsize=1, ttl=30, stale_ttl=300)
+candidate_cache = TTLCache('candidates', maxsize=5000, ttl=60, stale_ttl=60)
+
+Counts = namedtuple('Counts', 'messages following followers likes')
+
+
+def cached(cache, key, loader):
+    if not current_app.config['CACHE_ENABLED']:
+        return loader()
+    return cache.get_or_load(key, loader)
+
+
+def follows_key(user_id):
+    """Cache key for what depends on who `user_id` follows.
+
+    For the logged-in user it carries the version of their follows kept
+    in the session, which forget_follow bumps; a worker holding an older
+    copy misses and reloads.
+    """
+
+    version = 0
+    if has_request_context() and session.get(CURR_USER_KEY) == user_id:
+        version = session.get(FOLLOWS_VERSION_KEY, 0)
+    return (user_id, version)
+
+
+def following_of(user_id):
+    """Frozen set of the ids `user_id` follows."""
+
+    return cached(follow_cache, follows_key(user_id), lambda: frozenset(
+        followed_id for (followed_id,) in
+        db.session.query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id)))
+
+
+def user_counts(user):
+    """`user`'s profile counts; `user` may be a User or a UserCard."""
+
+    return cached(counts_cache, user.id, lambda: Counts(
+        messages=message_count(user),
+        following=Follows.query.filter(
+            Follows.user_following_id == user.id).count(),
+        followers=Follows.query.filter(
+            Follows.user_being_followed_id == user.id).count(),
+        likes=Likes.query.filter(Likes.user_id == user.id).count()))
+
+
+def home_query(user_id):
+    return read_models.message_select().where(
+        Message.user_id.in_(following_of(user_id)))
+
+
+def home_timeline(user_id):
+    """First page of `user_id`'s home timeline, as a list of MessageCards."""
+
+    return cached(timeline_cache, follows_key(user_id), lambda: list(
+        message_cards(feed_page(home_query(user_id)))))
+
+
+def home_candidates(user_id):
+    """`user_id`'s ranking.Candidates, for the ranked home feed."""
+
+    def load():
+        return ranking.load_candidates(user_id, list(message_cards(stream(
+            ranking.candidate_query(home_query(user_id))))))
+
+    return cached(candidate_cache, follows_key(user_id), load)
+
+
+def profile_page(user_id):
+    """(UserCard, first page of their messages), or None if there's no
+    such user."""
+
+    def load():
+        user = read_models.user(user_id)
+        if user is None:
+            return None
+        return user, list(profile_messages(user))
+
+    return cached(profile_cache, user_id, load)
+
+
+def message_page(message_id):
+    """The MessageCard of a message, hot or archived; None if there's
+    no such message."""
+
+    def load():
+        msg = read_models.message(message_id)
+        if msg is None:
+            archived = cold_archive().find(message_id)
+            if archived is not None:
+                # no author: their account is deleted, pending its purge
+                author = read_models.user(archived.user_id)
+                if author is not None:
+                    msg = read_models.archived_card(archived, author)
+        return msg
+
+    return cached(message_cache, message_id, load)
+
+
+def trending_now():
+    """What's trending across workers (trending.py), highest score first."""
+
+    return cached(trend_cache, None, trends.current)
+
+
+def forget_follow(follower_id, followed_id):
+    key = follows_key(follower_id)
+    if has_request_context() and session.get(CURR_USER_KEY) == follower_id:
+        session[FOLLOWS_VERSION_KEY] = key[1] + 1
+
+    follow_cache.delete(key)
+    timeline_cache.delete(key)
+    candidate_cache.delete(key)
+    counts_cache.delete(follower_id, followed_id)
+
+
+def forget_user(user_id):
+    """Drop what this worker has cached about `user_id` itself."""
+
+    key = follows_key(user_id)
+    follow_cache.delete(key)
+    timeline_cache.delete(key)
+    candidate_cache.delete(key)
+    counts_cache.delete(user_id)
+    profile_cache.delete(user_id)
+
+
+def warm_user(user_id):
+    """Fill the caches for `user_id` (for startup.warm_caches)."""
+
+    user = read_models.user(user_id)
+    if user is not None:
+        home_timeline(user_id)
+        user_counts(user)
+
+
+def profile_messages(user):
+    """Newest-first page of `user`'s (a UserCard's) messages, hot and
+    archived, as MessageCards.
+
+    The two are merged on id, so a page that crosses the archive's
+    cutoff carries on into archived messages. A message found in both
+    (the archive job was interrupted) is shown once.
+    """
+
+    hot = message_cards(feed_page(
+        read_models.message_select().where(Message.user_id == user.id)))
+    cold = (read_models.archived_card(msg, user)
+            for msg in cold_archive().user_messages(
+                user.id, before=request.args.get('before', type=int),
+                limit=PAGE_SIZE))
+
+    last_id = None
+    shown = 0
+    for msg in heapq.merge(hot, cold, key=lambda msg: -msg.id):
+        if msg.id == last_id:
+            continue
+        last_id = msg.id
+        yield msg
+
+        shown += 1
+        if shown == PAGE_SIZE:
+            return
+
+
+##############################################################################
+# Streamed rendering
+#
+# List pages are streamed: rows come off a server-side cursor
+# (read_models.stream) and HTML is sent as it is produced, so
+# time-to-first-byte and memory don't grow with the number of rows.
+# Templates get the rows as an iterator, so they can't take its length;
+# feed templates work out the next page's cursor as they loop.
+
+# template output pieces gathered into each chunk sent
+TEMPLATE_CHUNK = 16
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but returns a streamed response."""
+
+    app = current_app._get_current_object()
+
+    # pop flashed messages now: by the time the template asks for them the
+    # headers (and session cookie) will have gone out
+    get_flashed_messages(with_categories=True)
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(TEMPLATE_CHUNK)
+
+    return Response(stream_with_context(stream))
+
+
+@bp.route('/signup', methods=["GET", "POST"])
+@query_budget(2)
 def signup():
     """Handle user signup.
 
@@ -89,7 +597,8 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
+@query_budget(1)
 def login():
     """Handle user login."""
 
@@ -109,7 +618,8 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
+@query_budget(1)
 def logout():
     """Handle logout of user."""
 
@@ -120,7 +630,8 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
+@query_budget(3)
 def list_users():
     """Page with listing of users.
 
@@ -129,32 +640,34 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = read_models.user_select()
+    if search:
+        users = users.where(User.username.like(f"%{search}%"))
 
-    return render_template('users/index.html', users=users)
+    return stream_template('users/index.html', following=followed_ids(),
+                           users=user_cards(stream(users)))
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
+@query_budget(11)
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    if request.args.get('before') is None:
+        page = profile_page(user_id)
+        if page is None:
+            abort(404)
+        user, messages = page
+    else:
+        user = read_models.user(user_id) or abort(404)
+        messages = profile_messages(user)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    return stream_template('users/show.html', user=user, page_size=PAGE_SIZE,
+                           messages=messages)
 
 
-@app.route('/users/<int:user_id>/following')
+@bp.route('/users/<int:user_id>/following')
+@query_budget(9)
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -162,11 +675,15 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = read_models.user(user_id) or abort(404)
+    return render_template('users/following.html', user=user,
+                           users=user_cards(stream(
+                               read_models.following(user_id))),
+                           following=followed_ids())
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
+@query_budget(9)
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -174,11 +691,15 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = read_models.user(user_id) or abort(404)
+    return render_template('users/followers.html', user=user,
+                           users=user_cards(stream(
+                               read_models.followers(user_id))),
+                           following=followed_ids())
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
+@query_budget(4)
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -187,13 +708,34 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if followed_user.deleted_at is not None:
+        abort(404)
+
+    if write_behind.enabled:
+        if not g.user.is_following(followed_user):
+            write_behind.record(FOLLOW, g.user.id, followed_user.id, True)
+            notifier.notify(notifications.FOLLOW, followed_user.id, g.user.id)
+            forget_follow(g.user.id, followed_user.id)
+
+        return redirect(f"/users/{g.user.id}/following")
+
+    # one INSERT; following someone twice is a no-op
+    followed = db.session.execute(
+        insert(Follows.__table__)
+        .values(user_following_id=g.user.id,
+                user_being_followed_id=followed_user.id)
+        .on_conflict_do_nothing()).rowcount
     db.session.commit()
 
+    if followed:
+        notifier.notify(notifications.FOLLOW, follow_id, session[CURR_USER_KEY])
+        forget_follow(session[CURR_USER_KEY], follow_id)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@query_budget(3)
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -201,14 +743,26 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    if write_behind.enabled:
+        if Follows.exists(g.user.id, follow_id):
+            write_behind.record(FOLLOW, g.user.id, follow_id, False)
+            forget_follow(g.user.id, follow_id)
+
+        return redirect(f"/users/{g.user.id}/following")
+
+    (Follows
+     .query
+     .filter(Follows.user_following_id == g.user.id,
+             Follows.user_being_followed_id == follow_id)
+     .delete(synchronize_session=False))
     db.session.commit()
+    forget_follow(session[CURR_USER_KEY], follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
+@query_budget(4)
 def profile():
     """Update profile for current user."""
 
@@ -216,14 +770,34 @@ def profile():
     form = EditUserForm(obj=user)
     if form.validate_on_submit():
         if User.authenticate(user.username,form.password.data):
-            User.edit(
-                    orig_username=user.username,
-                    new_username=form.username.data,
-                    email=form.email.data,
-                    image_url=form.image_url.data,
-                    header_image_url=form.header_image_url.data,
-                    bio=form.bio.data)
-            db.session.commit()
+            image_url = form.image_url.data
+            header_image_url = form.header_image_url.data
+
+            # uploads win over typed-in URLs
+            try:
+                if form.image_file.data:
+                    image_url = store_image(form.image_file.data)
+                if form.header_image_file.data:
+                    header_image_url = store_image(form.header_image_file.data)
+            except images.ImageError as error:
+                flash(str(error), 'danger')
+                return redirect('/users/profile')
+
+            try:
+                User.edit(
+                        orig_username=user.username,
+                        new_username=form.username.data,
+                        email=form.email.data,
+                        image_url=image_url,
+                        header_image_url=header_image_url,
+                        bio=form.bio.data)
+                db.session.commit()
+            except IntegrityError:
+                # usernames (ignoring case) and emails are unique
+                db.session.rollback()
+                flash("Username or email already taken", 'danger')
+                return redirect('/users/profile')
+            profile_cache.delete(session[CURR_USER_KEY])
             return redirect(f'/users/{session[CURR_USER_KEY]}')
         else:
             flash("Password Incorrect")
@@ -232,9 +806,92 @@ def profile():
     return render_template('users/edit.html', form=form, user=user)
 
 
-@app.route('/users/delete', methods=["POST"])
+def store_image(upload):
+    """Store an uploaded image locally and return its URL."""
+
+    return images.store_upload(upload,
+                               media_dir=current_app.config['MEDIA_DIR'],
+                               max_workers=current_app.config['IMAGE_WORKERS'],
+                               logger=current_app.logger)
+
+
+@bp.route('/users/export')
+@query_budget(6)
+def users_export():
+    """Download the logged-in user's data as NDJSON (or ?format=csv).
+
+    Streamed straight off the database, so big accounts cost no more
+    memory than small ones.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        abort(400)
+
+    mimetype, ext = export.FORMATS[fmt]
+    filename = f"warbler-{g.user.username}.{ext}"
+
+    return Response(stream_with_context(export.stream(g.user.id, fmt)),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             f'attachment; filename="{filename}"'})
+
+
+@bp.route('/users/export', methods=["POST"])
+@query_budget(1)
+def users_export_start():
+    """Prepare a compressed export file in the background."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.form.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        abort(400)
+
+    name = export.start_job(current_app._get_current_object(), g.user.id, fmt,
+                            current_app.config['EXPORT_DIR'])
+    return redirect(f"/users/export/{name}")
+
+
+@bp.route('/users/export/<name>')
+@query_budget(1)
+def users_export_download(name):
+    """Download a prepared export, or say it isn't ready yet."""
+
+    match = export.JOB_NAME_RE.fullmatch(name)
+    if not g.user or not match or int(match.group(1)) != g.user.id:
+        raise NotFound()
+
+    directory = current_app.config['EXPORT_DIR']
+    path = os.path.join(directory, name)
+    if os.path.exists(path):
+        return send_from_directory(directory, name, as_attachment=True,
+                                   mimetype='application/gzip')
+
+    failed = os.path.exists(path + '.failed')
+    # not running either (the check after catches it just finishing):
+    # expired, or never started
+    if (not failed and not os.path.exists(path + '.tmp')
+            and not os.path.exists(path)):
+        raise NotFound()
+
+    return render_template('users/export.html', failed=failed)
+
+
+@bp.route('/users/delete', methods=["POST"])
+@query_budget(3)
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    The account is tombstoned at once; its content is purged in the
+    background (purge.py).
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -242,13 +899,18 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+    g.user.deleted_at = datetime.utcnow()
+    purger.enqueue([user_id], purge.ACCOUNT)
     db.session.commit()
+    forget_user(user_id)
+    purger.kick()
 
     return redirect("/signup")
 
 
-@app.route('/users/add_like/<int:msg_id>', methods=["POST"])
+@bp.route('/users/add_like/<int:msg_id>', methods=["POST"])
+@query_budget(4)
 def add_like(msg_id):
     """Adds a liked message to the user profile"""
 
@@ -256,28 +918,66 @@ def add_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = g.user
-    msg = msg_id
+    if write_behind.enabled:
+        liked = write_behind.state(
+            LIKE, g.user.id, msg_id, lambda: Likes.exists(g.user.id, msg_id))
 
-    if msg in [like.id for like in g.user.likes]:
-        like = (Likes
-                .query
-                .filter(Likes.message_id == msg)
-                .all())
-        db.session.delete(like[0])
-        db.session.commit()
+        # the flush can't check it, so a like of no message is refused here
+        author_id = None if liked else message_author(msg_id)
+        if not liked and author_id is None:
+            abort(404)
+
+        write_behind.record(LIKE, g.user.id, msg_id, not liked)
+        counts_cache.delete(g.user.id)
+        if author_id is not None:
+            notifier.notify(notifications.LIKE, author_id, g.user.id, msg_id)
 
         return redirect('/')
-    else:
-        new_like = Likes(user_id=user.id,message_id=msg)
 
-        db.session.add(new_like)
-        db.session.commit()
+    # toggle: drop the like if there is one, otherwise add it; both are
+    # primary key lookups, and a double click can't like it twice
+    unliked = (Likes
+               .query
+               .filter(Likes.user_id == g.user.id,
+                       Likes.message_id == msg_id)
+               .delete(synchronize_session=False))
+
+    liked = 0
+    if not unliked:
+        liked = db.session.execute(
+            insert(Likes.__table__)
+            .values(user_id=g.user.id, message_id=msg_id)
+            .on_conflict_do_nothing()).rowcount
+
+    db.session.commit()
+    counts_cache.delete(session[CURR_USER_KEY])
+
+    if liked:
+        notify_like(msg_id)
+
+    return redirect('/')
 
-        return redirect('/')
-    
 
-@app.route('/users/<int:user_id>/likes')
+def message_author(msg_id):
+    """The id of the author of `msg_id`, or None if there's no such message."""
+
+    return (db.session
+            .query(Message.user_id)
+            .filter(Message.id == msg_id)
+            .scalar())
+
+
+def notify_like(msg_id):
+    """Let the author of `msg_id` know the logged-in user liked it."""
+
+    author_id = message_author(msg_id)
+    if author_id is not None:
+        notifier.notify(notifications.LIKE, author_id,
+                        session[CURR_USER_KEY], msg_id)
+
+
+@bp.route('/users/<int:user_id>/likes')
+@query_budget(10)
 def users_likes(user_id):
     """shows the users liked messages"""
 
@@ -285,16 +985,34 @@ def users_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    likes = [like.id for like in g.user.likes]
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, likes=likes)
+    write_behind.flush_user(LIKE, g.user.id)
+
+    user = read_models.user(user_id) or abort(404)
+    messages = list(message_cards(stream(read_models.liked(user_id))))
+    if user_id == g.user.id:
+        likes = {msg.id for msg in messages}
+    else:
+        likes = liked_ids(msg.id for msg in messages)
+    return render_template('users/likes.html', user=user, likes=likes,
+                           messages=messages)
+
+
+@bp.route('/users/<int:user_id>/stats')
+@query_budget(8)
+def users_stats(user_id):
+    """Show a user's posting activity, as of the last analytics run."""
+
+    user = read_models.user(user_id) or abort(404)
+    stats = UserStats.query.get(user_id)
+    return render_template('users/stats.html', user=user, stats=stats)
 
 
 
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
+@query_budget(6)
 def messages_add():
     """Add a message:
 
@@ -308,24 +1026,36 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        index_message(msg)
         db.session.commit()
+        counts_cache.delete(msg.user_id)
+        profile_cache.delete(msg.user_id)
+
+        notifier.notify_mentions(msg)
+        trends.record(msg.text)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/<int:message_id>', methods=["GET"])
+@query_budget(4)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = message_page(message_id)
+    if msg is None:
+        abort(404)
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
+@query_budget(4)
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -333,41 +1063,300 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
-    db.session.commit()
+    msg = Message.query.get(message_id) or cold_archive().find(message_id)
+    if msg is None:
+        abort(404)
+
+    if getattr(msg, 'archived', False):
+        cold_archive().remove([message_id])
+    else:
+        db.session.delete(msg)
+        db.session.commit()
+    counts_cache.delete(msg.user_id)
+    profile_cache.delete(msg.user_id)
+    message_cache.delete(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Tag and mention feeds:
+
+
+def tagged_messages(tag):
+    """Page of messages indexed under `tag`, newest first."""
+
+    return message_cards(feed_page(read_models.tagged(tag),
+                                   column=MessageTag.message_id))
+
+
+@bp.route('/tags/<tag>')
+@query_budget(5)
+def tags_show(tag):
+    """Show messages using #tag."""
+
+    messages = tagged_messages(f"#{tag.lower()}")
+    return stream_template('messages/index.html', title=f"#{tag}",
+                           messages=messages, page_size=PAGE_SIZE)
+
+
+@bp.route('/users/mentions')
+@query_budget(5)
+def users_mentions():
+    """Show messages mentioning the logged-in user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    messages = tagged_messages(f"@{g.user.username.lower()}")
+    return stream_template('messages/index.html', title=f"@{g.user.username}",
+                           messages=messages, page_size=PAGE_SIZE)
+
+
+##############################################################################
+# Notifications
+
+
+@bp.route('/notifications')
+@query_budget(5)
+def notifications_show():
+    """Show the logged-in user's notifications, newest first.
+
+    Viewing them marks them all read.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    page = page_before(Notification
+                       .query
+                       .filter(Notification.user_id == g.user.id),
+                       column=Notification.id).all()
+
+    # one query for every actor named on the page
+    actor_ids = {actor_id for n in page
+                 for actor_id in n.actor_ids[:notifications.MAX_ACTORS]}
+    usernames = {}
+    if actor_ids:
+        usernames = dict(db.session
+                         .query(User.id, User.username)
+                         .filter(User.id.in_(actor_ids)))
+
+    items = [(n, notifications.summary(n, usernames), datetime_from_id(n.id))
+             for n in page]
+    cursor = page[-1].id if len(page) == PAGE_SIZE else None
+
+    # render before marking read, so new ones are still highlighted
+    html = render_template('notifications/index.html', notifications=items,
+                           cursor=cursor)
+
+    if g.user.unread_notifications:
+        notifications.mark_read(g.user)
+        db.session.commit()
+
+    return html
+
+
+##############################################################################
+# Moderation
+#
+# Admins remove users' messages, or whole accounts, in bulk. The work is
+# queued for purge.py like an account deleting itself; these respond as
+# soon as it's queued.
+
+MODERATION_ACTIONS = {'messages': purge.MESSAGES, 'accounts': purge.ACCOUNT}
+
+# users per request, so one form can't queue an unbounded batch
+MODERATION_MAX_USERS = 1000
+
+
+def require_admin():
+    if not g.user or not g.user.is_admin:
+        abort(403)
+
+
+@bp.route('/admin/moderation', methods=["POST"])
+@query_budget(3)
+def moderate():
+    """Queue the purge of `action` ("messages" or "accounts") for the
+    comma-separated `user_ids`; responds 202 with the jobs."""
+
+    require_admin()
+
+    scope = MODERATION_ACTIONS.get(request.form.get('action'))
+    try:
+        user_ids = sorted({int(user_id) for user_id in
+                           request.form.get('user_ids', '').split(',')
+                           if user_id.strip()})
+    except ValueError:
+        abort(400)
+    if scope is None or not user_ids or len(user_ids) > MODERATION_MAX_USERS:
+        abort(400)
+
+    if scope == purge.ACCOUNT:
+        (User
+         .query
+         .filter(User.id.in_(user_ids), User.deleted_at.is_(None))
+         .update({User.deleted_at: datetime.utcnow()},
+                 synchronize_session=False))
+
+    jobs = purger.enqueue(user_ids, scope, requested_by=g.user.id)
+    db.session.commit()
+
+    for user_id in user_ids:
+        forget_user(user_id)
+    purger.kick()
+
+    return jsonify(jobs=[{'id': job_id, 'user_id': user_id, 'scope': scope}
+                         for job_id, user_id in jobs]), 202
+
+
+@bp.route('/admin/purges/<int:job_id>')
+@query_budget(2)
+def purge_status(job_id):
+    """How far a queued purge has got."""
+
+    require_admin()
+    return jsonify(purge.job_status(PurgeJob.query.get_or_404(job_id)))
+
+
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
+@query_budget(11)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, or with
+      ?feed=ranked, their best recent ones (ranking.py); the choice is
+      remembered for the session
     """
 
     if g.user:
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_([following.id for following in g.user.following]))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        
-        likes = [like.id for like in g.user.likes]
+        feed = request.args.get('feed')
+        if feed in ranking.FEEDS:
+            if session.get('feed') != feed:
+                session['feed'] = feed
+        else:
+            feed = session.get('feed', ranking.LATEST)
+
+        ranked_page = max(request.args.get('page', 0, type=int), 0)
+        if feed == ranking.RANKED:
+            messages = ranking.ranked(home_candidates(g.user.id),
+                                      offset=ranked_page * PAGE_SIZE,
+                                      limit=PAGE_SIZE)
+        elif request.args.get('before') is None:
+            messages = home_timeline(g.user.id)
+        else:
+            messages = list(message_cards(feed_page(home_query(g.user.id))))
 
-        return render_template('home.html', messages=messages, likes=likes)
+        likes = liked_ids(msg.id for msg in messages)
+
+        return stream_template('home.html', likes=likes, page_size=PAGE_SIZE,
+                               messages=messages, feed=feed,
+                               ranked_page=ranked_page)
 
     else:
         return render_template('home-anon.html')
 
 
+@bp.route('/assets/<path:filename>')
+@query_budget(1)
+def assets_show(filename):
+    """Serve a built static asset (see assets.py).
+
+    Sends the precompressed variant the client accepts, if there is one.
+    Built names are content-addressed, so they can be cached forever.
+    """
+
+    directory = current_app.config['ASSETS_DIR']
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding not in accepted:
+            continue
+        try:
+            resp = send_from_directory(directory, filename + suffix,
+                                       mimetype=mimetype)
+        except NotFound:
+            continue
+        resp.headers['Content-Encoding'] = encoding
+        break
+    else:
+        resp = send_from_directory(directory, filename, mimetype=mimetype)
+
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
+
+@bp.route('/media/<digest>/<name>')
+@query_budget(1)
+def media_show(digest, name):
+    """Serve a stored image or one of its resized variants."""
+
+    if not images.DIGEST_RE.fullmatch(digest):
+        raise NotFound()
+
+    directory, filename, final = images.media_file(
+        digest, name, media_dir=current_app.config['MEDIA_DIR'])
+    resp = send_from_directory(directory, filename)
+
+    if final:
+        resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        # the variant is still being made; serve the original for now
+        resp.headers['Cache-Control'] = 'public, max-age=60'
+    return resp
+
+
+@bp.route('/metrics')
+@query_budget(1)
+def metrics():
+    """Internal counters for this worker, as JSON.
+
+    For admins, or scrapers sending "Authorization: Bearer <METRICS_TOKEN>".
+    """
+
+    token = current_app.config['METRICS_TOKEN']
+    given = request.headers.get('Authorization', '')
+    # bytes: compare_digest refuses non-ASCII str
+    if not (token and hmac.compare_digest(given.encode(),
+                                          f"Bearer {token}".encode())):
+        require_admin()
+
+    return jsonify(write_behind=write_behind.metrics(),
+                   notifications=notifier.metrics(),
+                   trends=trends.metrics(),
+                   purges=purger.metrics(),
+                   caches=cache.metrics())
+
+
+@bp.route('/healthz/live')
+@query_budget(1)
+def healthz_live():
+    """The process is up."""
+
+    return jsonify(status='ok')
+
+
+@bp.route('/healthz/ready')
+@query_budget(1)
+def healthz_ready():
+    """Whether this worker should get traffic: 503 while it warms up."""
+
+    from startup import warm_up_state
+
+    status = warm_up_state.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -375,10 +1364,14 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    # built assets and stored images set their own caching headers
+    if request.endpoint in ('warbler.assets_show', 'warbler.media_show'):
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
@@ -0,0 +1,567 @@
+"""Cold archive of old messages in compressed, columnar segment files.
+
+The archive job moves old messages out of the messages table into one
+segment file per month under ARCHIVE_DIR. Only messages nobody has
+liked are moved: liked ones stay hot, since the likes table points at
+them. Their #tag index rows go with them, so tag and mention feeds only
+show hot messages.
+
+A segment keeps its rows sorted by (user_id, id):
+
+    header      magic, row count, rows per text block, text block count
+    user_id     int64 column
+    id          int64 column
+    timestamp   int64 column, microseconds since the Unix epoch
+    by_id       int64 column, row numbers in id order (for lookups by id)
+    blocks      int64 file offsets of the text blocks, plus the end
+    text        zlib-compressed blocks of BLOCK_ROWS texts each
+
+The int64 columns are read straight out of the memory-mapped file, so
+one user's rows are found with a binary search and only the text
+blocks actually shown are decompressed.
+
+manifest.json lists the segments and the cutoff: the id below which
+messages may be archived. Above it, everything is still in the table.
+
+    python archive.py [--older-than-days 365]
+"""
+
+import argparse
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+import partitions
+from ids import datetime_from_id
+
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'archive')
+
+MANIFEST = 'manifest.json'
+
+MAGIC = b'WARBSEG1'
+HEADER = struct.Struct('<8sqqq')
+
+BLOCK_ROWS = 256
+
+# decompressed text blocks kept per segment
+CACHED_BLOCKS = 16
+
+DELETE_BATCH = 10000
+
+_UNIX_EPOCH = datetime(1970, 1, 1)
+
+_stores = {}
+
+
+class ArchivedMessage:
+    """A message read from the archive; quacks like a Message for views."""
+
+    __slots__ = ('id', 'user_id', 'timestamp', 'text', 'user')
+
+    archived = True
+
+    def __init__(self, id, user_id, timestamp, text, user=None):
+        self.id = id
+        self.user_id = user_id
+        self.timestamp = timestamp
+        self.text = text
+        self.user = user
+
+
+def to_micros(dt):
+    return (dt - _UNIX_EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return _UNIX_EPOCH + timedelta(microseconds=micros)
+
+
+##############################################################################
+# Segment files
+
+
+def write_segment(path, rows, block_rows=BLOCK_ROWS):
+    """Write `rows` of (user_id, id, timestamp micros, text) to `path`.
+
+    `rows` must be sorted by (user_id, id). Written under a temporary
+    name and renamed into place.
+    """
+
+    if sys.byteorder != 'little':
+        raise RuntimeError("segments are little-endian")
+
+    count = len(rows)
+    user_ids = array('q', (row[0] for row in rows))
+    ids = array('q', (row[1] for row in rows))
+    timestamps = array('q', (row[2] for row in rows))
+    by_id = array('q', sorted(range(count), key=ids.__getitem__))
+
+    blocks = []
+    for start in range(0, count, block_rows):
+        texts = [row[3].encode() for row in rows[start:start + block_rows]]
+        offsets = array('i', [0])
+        for encoded in texts:
+            offsets.append(offsets[-1] + len(encoded))
+        blocks.append(zlib.compress(offsets.tobytes() + b"".join(texts)))
+
+    position = HEADER.size + 8 * (4 * count + len(blocks) + 1)
+    block_offsets = array('q')
+    for block in blocks:
+        block_offsets.append(position)
+        position += len(block)
+    block_offsets.append(position)
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, count, block_rows, len(blocks)))
+        for column in (user_ids, ids, timestamps, by_id, block_offsets):
+            f.write(column.tobytes())
+        for block in blocks:
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(path + '.tmp', path)
+
+
+class Segment:
+    """One memory-mapped segment file."""
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self.version = _version(os.fstat(f.fileno()))
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self.block_rows, blocks = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a message segment")
+
+        columns = memoryview(self._map)[
+            HEADER.size:HEADER.size + 8 * (4 * self.count + blocks + 1)].cast('q')
+
+        n = self.count
+        self.user_ids = columns[:n]
+        self.ids = columns[n:2 * n]
+        self.timestamps = columns[2 * n:3 * n]
+        self.by_id = columns[3 * n:4 * n]
+        self.block_offsets = columns[4 * n:]
+
+        # segments are shared by a worker's threads
+        self._blocks_lock = threading.Lock()
+        self._blocks = OrderedDict()
+
+    def _texts(self, block):
+        """(offsets, data) of one decompressed text block, cached."""
+
+        with self._blocks_lock:
+            cached = self._blocks.get(block)
+            if cached is not None:
+                self._blocks.move_to_end(block)
+                return cached
+
+        # decompressed outside the lock; two threads may both do one block
+        start, end = self.block_offsets[block], self.block_offsets[block + 1]
+        data = zlib.decompress(self._map[start:end])
+
+        rows = min(self.block_rows, self.count - block * self.block_rows)
+        offsets = memoryview(data)[:4 * (rows + 1)].cast('i')
+        texts = (offsets, data[4 * (rows + 1):])
+
+        with self._blocks_lock:
+            self._blocks[block] = texts
+            if len(self._blocks) > CACHED_BLOCKS:
+                self._blocks.popitem(last=False)
+
+        return texts
+
+    def text(self, row):
+        offsets, data = self._texts(row // self.block_rows)
+        i = row % self.block_rows
+        return data[offsets[i]:offsets[i + 1]].decode()
+
+    def message(self, row):
+        return ArchivedMessage(self.ids[row], self.user_ids[row],
+                               from_micros(self.timestamps[row]),
+                               self.text(row))
+
+    def user_range(self, user_id):
+        """[lo, hi) rows belonging to `user_id`."""
+
+        return (bisect.bisect_left(self.user_ids, user_id),
+                bisect.bisect_left(self.user_ids, user_id + 1))
+
+    def user_rows(self, user_id, before=None):
+        """`user_id`'s rows with id below `before`, newest first."""
+
+        lo, hi = self.user_range(user_id)
+        if before is not None:
+            hi = bisect.bisect_left(self.ids, before, lo, hi)
+
+        return range(hi - 1, lo - 1, -1)
+
+    def find(self, message_id):
+        """Row holding `message_id`, or None."""
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ids[self.by_id[mid]] < message_id:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self.count and self.ids[self.by_id[lo]] == message_id:
+            return self.by_id[lo]
+        return None
+
+    def rows(self):
+        """Every row as (user_id, id, timestamp micros, text)."""
+
+        for row in range(self.count):
+            yield (self.user_ids[row], self.ids[row], self.timestamps[row],
+                   self.text(row))
+
+
+def _version(stat):
+    # files here are replaced, never edited in place, so this changes
+    # whenever the content does
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+##############################################################################
+# The archive
+
+
+class Archive:
+    """Every segment in a directory, kept in step with its manifest."""
+
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+        self.cutoff = None
+        self._manifest_version = None
+        # month ("2024-01") -> Segment, newest month first; replaced, never
+        # changed in place, so readers can go on with the one they got
+        self.segments = OrderedDict()
+        # one reload at a time; segments and cutoff change together
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        """Reload the manifest if the archive job has changed it."""
+
+        with self._refresh_lock:
+            self._reload()
+        return self
+
+    def _reload(self):
+        try:
+            version = _version(os.stat(os.path.join(self.directory, MANIFEST)))
+        except FileNotFoundError:
+            version = None
+
+        if version == self._manifest_version:
+            return
+
+        manifest = self._read_manifest()
+        segments = OrderedDict()
+        for month in sorted(manifest['segments'], reverse=True):
+            path = os.path.join(self.directory, manifest['segments'][month])
+            old = self.segments.get(month)
+            if old is not None and old.version == _version(os.stat(path)):
+                segments[month] = old
+            else:
+                segments[month] = Segment(path)
+
+        self.segments = segments
+        self.cutoff = manifest['cutoff']
+        self._manifest_version = version
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'cutoff': None, 'segments': {}}
+
+    def _write_manifest(self, manifest):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def _lock(self):
+        """Exclusive lock for changing the archive (one writer at a time)."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        lock = open(os.path.join(self.directory, '.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    ##########################################################################
+    # Reading
+
+    def user_messages(self, user_id, before=None, limit=None):
+        """`user_id`'s archived messages below `before`, newest first."""
+
+        self.refresh()
+        found = 0
+
+        for month, segment in self.segments.items():
+            low, high = partitions.month_bounds(*_month(month))
+            if before is not None and low >= before:
+                continue
+
+            for row in segment.user_rows(user_id, before):
+                yield segment.message(row)
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+    def user_count(self, user_id):
+        """How many of `user_id`'s messages are archived."""
+
+        self.refresh()
+        total = 0
+        for segment in self.segments.values():
+            lo, hi = segment.user_range(user_id)
+            total += hi - lo
+        return total
+
+    def _locate(self, message_id):
+        """(segment, row) holding `message_id`; row (or both) None if not."""
+
+        self.refresh()
+        created = datetime_from_id(message_id)
+        segment = self.segments.get(f"{created.year:04d}-{created.month:02d}")
+        if segment is None:
+            return None, None
+        return segment, segment.find(message_id)
+
+    def find(self, message_id):
+        """The archived message with `message_id`, or None."""
+
+        segment, row = self._locate(message_id)
+        return segment.message(row) if row is not None else None
+
+    def contains(self, message_id):
+        """Is `message_id` archived? (doesn't read its text)"""
+
+        return self._locate(message_id)[1] is not None
+
+    ##########################################################################
+    # Writing
+
+    def add_month(self, year, month, rows):
+        """Merge `rows` into the month's segment; returns the row count.
+
+        `rows` are (user_id, id, timestamp micros, text).
+        """
+
+        lock = self._lock()
+        try:
+            manifest = self._read_manifest()
+            key = f"{year:04d}-{month:02d}"
+            name = f"messages-{key}.seg"
+            path = os.path.join(self.directory, name)
+
+            merged = {row[1]: tuple(row) for row in rows}
+            if key in manifest['segments']:
+                for row in Segment(path).rows():
+                    merged.setdefault(row[1], row)
+
+            ordered = sorted(merged.values(), key=lambda row: (row[0], row[1]))
+            write_segment(path, ordered)
+
+            high = partitions.month_bounds(year, month)[1]
+            manifest['segments'][key] = name
+            manifest['cutoff'] = max(manifest['cutoff'] or 0, high)
+            self._write_manifest(manifest)
+        finally:
+            lock.close()
+
+        return len(ordered)
+
+    def remove(self, message_ids):
+        """Delete archived messages (rewrites the segments holding them)."""
+
+        lock = self._lock()
+        try:
+            manifest = self._read_manifest()
+            by_month = {}
+            for message_id in message_ids:
+                created = datetime_from_id(message_id)
+                key = f"{created.year:04d}-{created.month:02d}"
+                if key in manifest['segments']:
+                    by_month.setdefault(key, set()).add(message_id)
+
+            for key, ids in by_month.items():
+                path = os.path.join(self.directory, manifest['segments'][key])
+                rows = [row for row in Segment(path).rows() if row[1] not in ids]
+                write_segment(path, rows)
+
+            # bump the manifest so readers reopen the rewritten segments
+            self._write_manifest(manifest)
+        finally:
+            lock.close()
+
+    def remove_users(self, user_ids):
+        """Delete every archived message by `user_ids`; returns how many.
+
+        Only segments holding some are rewritten.
+        """
+
+        user_ids = set(user_ids)
+        removed = 0
+
+        lock = self._lock()
+        try:
+            manifest = self._read_manifest()
+            for key, name in manifest['segments'].items():
+                path = os.path.join(self.directory, name)
+                segment = Segment(path)
+
+                found = 0
+                for user_id in user_ids:
+                    lo, hi = segment.user_range(user_id)
+                    found += hi - lo
+                if not found:
+                    continue
+
+                write_segment(path, [row for row in segment.rows()
+                                     if row[0] not in user_ids])
+                removed += found
+
+            if removed:
+                self._write_manifest(manifest)
+        finally:
+            lock.close()
+
+        return removed
+
+
+def _month(key):
+    year, month = key.split('-')
+    return int(year), int(month)
+
+
+def store(directory=ARCHIVE_DIR):
+    """The shared Archive for `directory`."""
+
+    if directory not in _stores:
+        _stores[directory] = Archive(directory)
+    return _stores[directory]
+
+
+##############################################################################
+# The archive job
+
+SELECT_COLD = """
+    SELECT m.user_id, m.id, m.timestamp, m.text
+    FROM messages m
+    WHERE m.id >= :low AND m.id < :high
+      AND NOT EXISTS (SELECT 1 FROM likes l WHERE l.message_id = m.id)
+    ORDER BY m.user_id, m.id
+"""
+
+# skips any liked since they were read: deleting those would cascade to
+# the like; they stay hot, and their copies are taken out of the archive
+DELETE_ARCHIVED = """
+    DELETE FROM messages m
+    WHERE m.id = ANY(:ids)
+      AND NOT EXISTS (SELECT 1 FROM likes l WHERE l.message_id = m.id)
+    RETURNING m.id
+"""
+
+
+def archive_month(engine, archive, year, month):
+    """Move one month's unliked messages into the archive.
+
+    The segment is written before any row is deleted, so a failure in
+    between leaves messages in both places (reads skip duplicates),
+    never in neither. Messages liked meanwhile stay hot only.
+    """
+
+    low, high = partitions.month_bounds(year, month)
+
+    with engine.connect() as conn:
+        rows = [(user_id, message_id, to_micros(timestamp), body)
+                for user_id, message_id, timestamp, body in conn.execute(
+                    text(SELECT_COLD), {'low': low, 'high': high})]
+
+    if not rows:
+        return 0
+
+    archive.add_month(year, month, rows)
+
+    ids = [row[1] for row in rows]
+    kept = set()
+    for start in range(0, len(ids), DELETE_BATCH):
+        batch = ids[start:start + DELETE_BATCH]
+        with engine.begin() as conn:
+            deleted = {message_id for (message_id,) in conn.execute(
+                text(DELETE_ARCHIVED), {'ids': batch})}
+        kept.update(message_id for message_id in batch
+                    if message_id not in deleted)
+
+    if kept:
+        archive.remove(kept)
+
+    return len(rows) - len(kept)
+
+
+def archive_older_than(engine, archive, days, now=None):
+    """Archive every whole month that ended more than `days` ago.
+
+    Returns {month: messages moved}.
+    """
+
+    now = now or datetime.utcnow()
+    threshold = now - timedelta(days=days)
+
+    with engine.connect() as conn:
+        oldest = conn.execute(text("SELECT min(id) FROM messages")).scalar()
+    if oldest is None:
+        return {}
+
+    start = datetime_from_id(oldest)
+    year, month = start.year, start.month
+    moved = {}
+
+    while True:
+        next_year, next_month = partitions.add_months(year, month, 1)
+        if datetime(next_year, next_month, 1) > threshold:
+            break
+        moved[f"{year:04d}-{month:02d}"] = archive_month(engine, archive,
+                                                         year, month)
+        year, month = next_year, next_month
+
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Move old, unliked messages into the cold archive.")
+    parser.add_argument('--older-than-days', type=int, default=365)
+    args = parser.parse_args()
+
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        archive = store(app.config['ARCHIVE_DIR'])
+        moved = archive_older_than(db.engine, archive, args.older_than_days)
+        for month, count in moved.items():
+            print(f"{month}: {count} messages archived")
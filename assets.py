@@ -0,0 +1,114 @@
+"""Fingerprinted, precompressed static assets.
+
+The build step copies every file under static/ to ASSETS_DIR with a
+content hash in its name (style.css -> style.3f2a9c01d4e7.css). Next to
+each copy it writes .gz and .br versions where compression is worth it,
+plus a manifest.json mapping source paths to built ones:
+
+    python assets.py
+
+Built files never change, so /assets/ serves them with immutable caching,
+picking the precompressed variant the client accepts. Templates use
+`asset_url('stylesheets/style.css')`, which falls back to /static/ for
+anything not built.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+from compression import brotli
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build', 'assets')
+
+MANIFEST = 'manifest.json'
+
+# keep a compressed variant only if it is at most this fraction of the size
+WORTHWHILE_RATIO = 0.9
+
+_manifests = {}
+
+
+def fingerprint(path):
+    """Short content hash of the file at `path`."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def _write_if_smaller(path, data, original_size):
+    if len(data) <= original_size * WORTHWHILE_RATIO:
+        with open(path, 'wb') as f:
+            f.write(data)
+        return True
+    return False
+
+
+def build(static_dir=STATIC_DIR, assets_dir=ASSETS_DIR):
+    """Build fingerprinted, precompressed copies; returns the manifest."""
+
+    manifest = {}
+
+    for root, dirs, files in os.walk(static_dir):
+        for name in files:
+            source = os.path.join(root, name)
+            relpath = os.path.relpath(source, static_dir).replace(os.sep, '/')
+
+            stem, ext = os.path.splitext(relpath)
+            built = f"{stem}.{fingerprint(source)}{ext}"
+            target = os.path.join(assets_dir, built)
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            _write_if_smaller(target + '.gz',
+                              gzip.compress(data, compresslevel=9, mtime=0),
+                              len(data))
+            if brotli is not None:
+                _write_if_smaller(target + '.br',
+                                  brotli.compress(data, quality=11),
+                                  len(data))
+
+            manifest[relpath] = built
+
+    with open(os.path.join(assets_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def load_manifest(assets_dir=ASSETS_DIR):
+    """The build manifest for `assets_dir` ({} if there's no build)."""
+
+    if assets_dir not in _manifests:
+        try:
+            with open(os.path.join(assets_dir, MANIFEST)) as f:
+                _manifests[assets_dir] = json.load(f)
+        except FileNotFoundError:
+            _manifests[assets_dir] = {}
+
+    return _manifests[assets_dir]
+
+
+def asset_url(path, assets_dir=ASSETS_DIR):
+    """URL for static file `path`, fingerprinted when it has been built."""
+
+    built = load_manifest(assets_dir).get(path)
+    if built is None:
+        return f"/static/{path}"
+
+    return f"/assets/{built}"
+
+
+if __name__ == '__main__':
+    for source, built in sorted(build().items()):
+        print(f"{source} -> {built}")
@@ -0,0 +1,82 @@
+"""Index #tags and @mentions of messages posted before tag indexing existed.
+
+Walks the messages table in id order from this process, hands each batch
+to a process pool as plain (id, text) tuples to tokenize, and inserts
+the index rows from this process, in order. Only this thread touches the
+database. Safe to re-run or to stop and resume from an id:
+
+    python backfill_tags.py [--after ID] [--batch-size N] [--workers N]
+"""
+
+import argparse
+import os
+from collections import deque
+from multiprocessing import Pool
+
+from app import create_app
+from models import db, Message
+from tags import index_rows, tag_rows
+
+
+def read_batch(after, batch_size):
+    """The next `batch_size` (id, text)s of messages with id > `after`."""
+
+    return [(message_id, text) for message_id, text in (
+        db.session
+        .query(Message.id, Message.text)
+        .filter(Message.id > after)
+        .order_by(Message.id)
+        .limit(batch_size))]
+
+
+def tokenize_batch(batch):
+    """Index rows for a batch of (id, text); runs in a pool worker."""
+
+    return batch[-1][0], [row for message_id, text in batch
+                          for row in tag_rows(message_id, text)]
+
+
+def backfill(after=0, batch_size=5000, workers=None):
+    """Index every message with id > `after`; returns the rows inserted."""
+
+    inserted = 0
+    # batches being tokenized, oldest first; enough to keep every worker busy
+    in_flight = deque()
+    ahead = 2 * (workers or os.cpu_count() or 1)
+
+    read_all = False
+
+    with Pool(workers) as pool:
+        while True:
+            if not read_all:
+                batch = read_batch(after, batch_size)
+                if batch:
+                    in_flight.append(pool.apply_async(tokenize_batch,
+                                                      (batch,)))
+                    after = batch[-1][0]
+                else:
+                    read_all = True
+
+            if not in_flight:
+                break
+            if not read_all and len(in_flight) < ahead:
+                continue
+
+            last_id, rows = in_flight.popleft().get()
+            index_rows(rows)
+            db.session.commit()
+            inserted += len(rows)
+            print(f"indexed through message {last_id} ({inserted} tags)")
+
+    return inserted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--after', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    create_app()
+    backfill(args.after, args.batch_size, args.workers)
@@ -0,0 +1,118 @@
+"""Benchmark read-model cards against ORM instances on message pages.
+
+Walks back through --pages newest-first pages of PAGE_SIZE messages and
+their authors, reading what the feed templates read, both ways:
+
+    orm     Message.query with joinedload(Message.user)
+    cards   read_models.message_cards over a Core select
+
+Reported per way: rows per second, and the peak memory allocated while
+loading one page (tracemalloc, measured on a second, slower pass). The
+session is cleared after every page, as at the end of a request.
+
+    python bench_read_models.py --pages 200
+
+Point DATABASE_URL at a seeded database.
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from sqlalchemy.orm import joinedload
+
+import read_models
+from models import db, Message
+
+PAGE_SIZE = 100
+
+
+def orm_page(before):
+    query = Message.query.options(joinedload(Message.user))
+    if before is not None:
+        query = query.filter(Message.id < before)
+
+    return [(msg.id, msg.text, msg.timestamp, msg.user.id, msg.user.username,
+             msg.user.image_url)
+            for msg in query.order_by(Message.id.desc()).limit(PAGE_SIZE)]
+
+
+def card_page(before):
+    query = read_models.message_select()
+    if before is not None:
+        query = query.where(Message.id < before)
+
+    rows = read_models.stream(
+        query.order_by(Message.id.desc()).limit(PAGE_SIZE))
+    return [(msg.id, msg.text, msg.timestamp, msg.user.id, msg.user.username,
+             msg.user.image_url)
+            for msg in read_models.message_cards(rows)]
+
+
+def walk(load, pages, peaks=None):
+    """Yield each page `load` returns, up to `pages` of them.
+
+    With a list for `peaks`, appends the memory allocated at most while
+    loading each page.
+    """
+
+    before = None
+    for _ in range(pages):
+        if peaks is not None:
+            tracemalloc.start()
+        page = load(before)
+        if peaks is not None:
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        db.session.remove()
+        if not page:
+            return
+        yield page
+        before = page[-1][0]
+
+
+def bench(load, pages):
+    """Result row for one way of loading pages."""
+
+    started = time.perf_counter()
+    rows = sum(len(page) for page in walk(load, pages))
+    elapsed = time.perf_counter() - started
+
+    peaks = []
+    for _ in walk(load, pages, peaks):
+        pass
+
+    return {'rows': rows, 'seconds': elapsed,
+            'rps': rows / elapsed if elapsed else 0.0,
+            'peak': max(peaks, default=0) / 1024}
+
+
+def format_results(results):
+    lines = [f"{'way':8} {'rows':>8} {'seconds':>8} {'rows/s':>10} "
+             f"{'peak KiB':>9}"]
+
+    for name, row in results.items():
+        lines.append(f"{name:8} {row['rows']:8d} {row['seconds']:8.2f} "
+                     f"{row['rps']:10.0f} {row['peak']:9.1f}")
+
+    lines.append("peak is memory allocated while loading one page, at most")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare read-model cards with ORM instances.")
+    parser.add_argument('--pages', type=int, default=100)
+    args = parser.parse_args()
+
+    from app import create_app
+
+    app = create_app()
+    with app.test_request_context('/'):
+        # once each first, so neither pays for a cold cache
+        bench(orm_page, 1)
+        bench(card_page, 1)
+
+        print(format_results({'orm': bench(orm_page, args.pages),
+                              'cards': bench(card_page, args.pages)}))
@@ -0,0 +1,274 @@
+"""Benchmark Warbler under gunicorn across worker/thread configurations.
+
+Each configuration is served by `gunicorn -c gunicorn.conf.py wsgi:app`
+and driven by --clients keep-alive clients for --duration seconds.
+Reported per configuration: requests per second, latency percentiles,
+and memory per worker, read from /proc (Linux):
+
+    rss      resident memory, shared pages included
+    pss      shared pages split between the processes sharing them,
+             so the workers' pss adds up to what they really use
+    private  pages only that worker has: the cost of one more worker
+
+Configurations are WORKERSxTHREADS, with ":nopreload" to build the app in
+each worker rather than once in the master:
+
+    python bench_serve.py --configs 4x1,4x1:nopreload,2x4 --duration 20
+
+Requests are --paths, or the GET requests of a captured traffic log
+(traffic.py), sent as the users who made them. Point DATABASE_URL at a
+seeded database.
+"""
+
+import argparse
+import http.client
+import itertools
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import traffic
+
+SERVER_START_TIMEOUT = 60
+
+
+def parse_config(text):
+    """{'workers', 'threads', 'preload'} from e.g. "4x2:nopreload"."""
+
+    shape, _, option = text.partition(':')
+    workers, _, threads = shape.partition('x')
+    return {'workers': int(workers), 'threads': int(threads or 1),
+            'preload': option != 'nopreload'}
+
+
+def config_name(config):
+    name = f"{config['workers']}x{config['threads']}"
+    return name if config['preload'] else name + ":nopreload"
+
+
+def child_pids(pid):
+    """Pids of `pid`'s child processes."""
+
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the command name may hold spaces; fields follow its ")"
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def memory(pid):
+    """{'rss', 'pss', 'private'} of process `pid`, in KiB."""
+
+    totals = {'rss': 0, 'pss': 0, 'private': 0}
+    fields = {'Rss:': 'rss', 'Pss:': 'pss',
+              'Private_Clean:': 'private', 'Private_Dirty:': 'private'}
+
+    # smaps_rollup (Linux 4.14+) is smaps already summed up
+    path = f"/proc/{pid}/smaps_rollup"
+    if not os.path.exists(path):
+        path = f"/proc/{pid}/smaps"
+
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if parts and parts[0] in fields:
+                totals[fields[parts[0]]] += int(parts[1])
+
+    return totals
+
+
+class Server:
+    """A gunicorn master running one configuration, as a context manager."""
+
+    def __init__(self, config, port):
+        self.config = config
+        self.port = port
+        self.process = None
+
+    def __enter__(self):
+        env = dict(os.environ,
+                   PORT=str(self.port),
+                   WEB_CONCURRENCY=str(self.config['workers']),
+                   WEB_THREADS=str(self.config['threads']),
+                   PRELOAD='1' if self.config['preload'] else '0')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+             '--access-logfile', '/dev/null', 'wsgi:app'],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(self.process.stderr.read().decode())
+            if (len(self.workers()) == self.config['workers']
+                    and self._listening()):
+                return self
+            time.sleep(0.2)
+
+        self.__exit__()
+        raise RuntimeError(f"{config_name(self.config)} didn't start")
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait()
+
+    def _listening(self):
+        try:
+            socket.create_connection(('127.0.0.1', self.port), 1).close()
+            return True
+        except OSError:
+            return False
+
+    def workers(self):
+        return child_pids(self.process.pid)
+
+
+def session_cookies(records):
+    """{user_id: Cookie header} for the users in `records`."""
+
+    from app import create_app, CURR_USER_KEY
+
+    app = create_app()
+    serializer = app.session_interface.get_signing_serializer(app)
+    name = app.config['SESSION_COOKIE_NAME']
+
+    return {user_id: f"{name}={serializer.dumps({CURR_USER_KEY: user_id})}"
+            for user_id in {record.get('user_id') for record in records}
+            if user_id is not None}
+
+
+def drive(port, records, cookies, clients, duration):
+    """Send `records` round-robin from `clients` threads for `duration`s.
+
+    Returns (latencies in ms, 5xx or failed requests).
+    """
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def client(offset):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        mine = []
+        failed = 0
+
+        for record in itertools.islice(itertools.cycle(records), offset, None):
+            if time.time() >= stop_at:
+                break
+
+            headers = {}
+            if record.get('user_id') in cookies:
+                headers['Cookie'] = cookies[record['user_id']]
+
+            start = time.perf_counter()
+            try:
+                conn.request('GET', record['path'], headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 500:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                continue
+            mine.append((time.perf_counter() - start) * 1000)
+
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sorted(latencies), errors[0]
+
+
+def bench(config, records, cookies, clients, duration, port):
+    """Result row for one configuration."""
+
+    with Server(config, port) as server:
+        # a few seconds' traffic first, so workers reach steady state
+        drive(port, records, cookies, clients, min(duration, 3))
+        latencies, errors = drive(port, records, cookies, clients, duration)
+
+        workers = [memory(pid) for pid in server.workers()]
+        master = memory(server.process.pid)
+
+    def average(key):
+        return sum(usage[key] for usage in workers) / len(workers) / 1024
+
+    return {
+        'config': config_name(config),
+        'rps': len(latencies) / duration,
+        'p50': traffic.percentile(latencies, 50) or 0.0,
+        'p99': traffic.percentile(latencies, 99) or 0.0,
+        'errors': errors,
+        'rss': average('rss'),
+        'pss': average('pss'),
+        'private': average('private'),
+        'total_pss': (master['pss'] + sum(usage['pss'] for usage in workers))
+                     / 1024,
+    }
+
+
+def format_results(results):
+    lines = [f"{'config':16} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+             f"{'errors':>6} {'rss MiB':>8} {'pss MiB':>8} {'priv MiB':>8} "
+             f"{'total MiB':>9}"]
+
+    for row in results:
+        lines.append(
+            f"{row['config']:16} {row['rps']:8.1f} {row['p50']:8.1f} "
+            f"{row['p99']:8.1f} {row['errors']:6d} {row['rss']:8.1f} "
+            f"{row['pss']:8.1f} {row['private']:8.1f} {row['total_pss']:9.1f}")
+
+    lines.append("memory is per worker, averaged; total is the master's "
+                 "and workers' pss")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark gunicorn configurations for Warbler.")
+    parser.add_argument('--configs', default='2x1,4x1,4x1:nopreload,2x4',
+                        help="comma-separated WORKERSxTHREADS[:nopreload]")
+    parser.add_argument('--paths', default='/',
+                        help="comma-separated paths to request")
+    parser.add_argument('--log', help="take requests from a traffic log")
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--port', type=int, default=8123)
+    args = parser.parse_args()
+
+    if args.log:
+        records = traffic.load(args.log)
+    else:
+        records = [{'path': path} for path in args.paths.split(',')]
+    cookies = session_cookies(records)
+
+    results = []
+    for text in args.configs.split(','):
+        results.append(bench(parse_config(text), records, cookies,
+                             args.clients, args.duration, args.port))
+        print(format_results(results[-1:]).splitlines()[1], flush=True)
+
+    print()
+    print(format_results(results))
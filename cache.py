@@ -0,0 +1,212 @@
+"""Small in-process caches for hot reads.
+
+Each worker has its own. Entries expire after the cache's TTL, and the
+least recently used go first once a cache is full. Writes invalidate
+what they change in their own worker only; other workers catch up when
+their copy expires, which is why TTLs are kept short.
+
+    timelines = TTLCache('timelines', maxsize=5000, ttl=30)
+    page = timelines.get_or_load(user_id, lambda: build_page(user_id))
+
+Loads are single-flight: however many threads miss on a key at once,
+one runs the loader and the rest wait for its result. With `stale_ttl`,
+an expired entry is still served for that much longer while one caller
+refreshes it (stale-while-revalidate), and kept if the refresh fails.
+
+Cached values are shared between requests and threads: never mutate one.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+_caches = {}
+
+_MISSING = object()
+
+# how long a caller waits on another's load before loading itself
+FLIGHT_TIMEOUT = 10.0
+
+
+class Flight:
+    """One load in progress; other callers wait on its outcome."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.value = None
+        self.error = None
+        # set if the key was deleted meanwhile: the result may be out of date
+        self.invalidated = False
+
+    def finish(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout):
+        """The loaded value (or the load's exception); _MISSING on timeout."""
+
+        if not self._done.wait(timeout):
+            return _MISSING
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class TTLCache:
+    """A thread-safe LRU mapping whose entries expire after `ttl` seconds.
+
+    Expired entries may be served for `stale_ttl` more seconds while
+    `get_or_load` refreshes them.
+    """
+
+    def __init__(self, name, maxsize=1000, ttl=60, stale_ttl=0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+        self._lock = threading.Lock()
+        # key -> (fresh until, usable until, value), least recently used first
+        self._entries = OrderedDict()
+        # key -> Flight
+        self._flights = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+        _caches[name] = self
+
+    def get(self, key, default=None):
+        """The fresh cached value for `key`, or `default`."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        now = time.monotonic()
+        self._entries[key] = (now + self.ttl,
+                              now + self.ttl + self.stale_ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """The cached value for `key`, calling `loader()` to fill a miss.
+
+        Only one caller at a time loads a key. The others wait for its
+        result or, if the entry is merely stale, get the stale value.
+        """
+
+        now = time.monotonic()
+        stale = _MISSING
+
+        with self._lock:
+            entry = self._entries.get(key)
+            flight = self._flights.get(key)
+
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+
+            if entry is not None and entry[1] > now:
+                self.stale_hits += 1
+                if flight is not None:
+                    # someone is already refreshing it
+                    return entry[2]
+                stale = entry[2]
+            elif flight is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            value = flight.wait(FLIGHT_TIMEOUT)
+            if value is not _MISSING:
+                return value
+            # the load is taking too long; do our own, uncoordinated
+            return loader()
+
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.finish(error=e)
+
+            if stale is not _MISSING:
+                return stale
+            raise
+
+        with self._lock:
+            if not flight.invalidated:
+                self._store(key, value)
+                self._flights.pop(key, None)
+        flight.finish(value)
+
+        return value
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                self._forget_flight(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for key in list(self._flights):
+                self._forget_flight(key)
+
+    def _forget_flight(self, key):
+        # a load already running may have read the old data; the next
+        # caller starts a fresh one
+        flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight.invalidated = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def metrics(self):
+        """Counters; `coalesced` are misses that waited on another's load."""
+
+        loads = self.misses + self.coalesced
+        return {'size': len(self._entries), 'hits': self.hits,
+                'stale_hits': self.stale_hits, 'misses': self.misses,
+                'coalesced': self.coalesced, 'errors': self.errors,
+                'coalesced_rate': self.coalesced / loads if loads else 0.0}
+
+
+def metrics():
+    """{cache name: counters} for every cache in this process."""
+
+    return {name: cache.metrics() for name, cache in _caches.items()}
+
+
+def clear_all():
+    for cache in _caches.values():
+        cache.clear()
@@ -0,0 +1,197 @@
+"""Negotiated gzip/brotli compression of Warbler responses.
+
+`CompressionMiddleware` wraps the WSGI app and compresses text responses
+(HTML, JSON, CSS, JS) when the client accepts it. Responses with a known
+length below `min_size` are left alone. Streamed responses (no length) are
+compressed chunk by chunk, flushing after each one so the client still
+gets HTML as it's produced.
+
+Brotli is used when the `brotli` package is installed and the client asks
+for it; otherwise gzip.
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/csv',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'image/svg+xml',
+}
+
+# never worth compressing (no body, or a partial one)
+SKIP_STATUSES = {'204', '206', '304'}
+
+
+def accepted_encodings(accept_encoding):
+    """Encodings from an Accept-Encoding header that have q > 0."""
+
+    accepted = set()
+
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name and q > 0:
+            accepted.add(name.strip().lower())
+
+    return accepted
+
+
+def negotiate(accept_encoding, available=('br', 'gzip')):
+    """Best of `available` the client accepts, or None."""
+
+    accepted = accepted_encodings(accept_encoding or '')
+
+    for encoding in available:
+        if encoding == 'br' and brotli is None:
+            continue
+        if encoding in accepted or '*' in accepted:
+            return encoding
+
+    return None
+
+
+class _Gzip:
+    def __init__(self, level):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def flush(self):
+        return self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+    def __init__(self, quality):
+        self._c = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+class CompressionMiddleware:
+    """WSGI middleware compressing text responses."""
+
+    def __init__(self, wsgi_app, min_size=500, gzip_level=6, brotli_quality=4):
+        self.wsgi_app = wsgi_app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _should_compress(self, status, headers):
+        if status.split(' ', 1)[0] in SKIP_STATUSES:
+            return False
+
+        names = {name.lower(): value for name, value in headers}
+
+        if 'content-encoding' in names:
+            return False
+
+        content_type = names.get('content-type', '').split(';')[0].strip()
+        if content_type not in COMPRESSIBLE_TYPES:
+            return False
+
+        length = names.get('content-length')
+        return length is None or int(length) >= self.min_size
+
+    def _compressor(self, encoding):
+        if encoding == 'br':
+            return _Brotli(self.brotli_quality)
+        return _Gzip(self.gzip_level)
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+
+        state = {}
+
+        def compressing_start_response(status, headers, exc_info=None):
+            state['called'] = True
+            headers = _add_vary(headers, 'Accept-Encoding')
+
+            if self._should_compress(status, headers):
+                state['streamed'] = not any(
+                    name.lower() == 'content-length' for name, value in headers)
+                state['compressor'] = self._compressor(encoding)
+                headers = [(name, value) for name, value in headers
+                           if name.lower() != 'content-length']
+                headers.append(('Content-Encoding', encoding))
+
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.wsgi_app(environ, compressing_start_response)
+
+        if state.get('called') and 'compressor' not in state:
+            return app_iter
+
+        # either compressing, or the app will only start the response
+        # when first iterated and we can't tell yet
+        return self._compressed(app_iter, state)
+
+    def _compressed(self, app_iter, state):
+        try:
+            for chunk in app_iter:
+                compressor = state.get('compressor')
+                if compressor is None:
+                    yield chunk
+                    continue
+
+                data = compressor.compress(chunk)
+                if state['streamed']:
+                    # keep the stream moving instead of waiting for a block
+                    data += compressor.flush()
+                if data:
+                    yield data
+
+            if state.get('compressor') is not None:
+                yield state['compressor'].finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def _add_vary(headers, field):
+    """`headers` with `field` added to (or as) the Vary header."""
+
+    result = []
+    seen = False
+
+    for name, value in headers:
+        if name.lower() == 'vary':
+            seen = True
+            fields = [f.strip() for f in value.split(',') if f.strip()]
+            if field.lower() not in (f.lower() for f in fields):
+                fields.append(field)
+            value = ', '.join(fields)
+        result.append((name, value))
+
+    if not seen:
+        result.append(('Vary', field))
+
+    return result
@@ -0,0 +1,378 @@
+"""Weekly digest: the top warbles from the people each user follows.
+
+Built offline for everyone at once, not a home timeline per user:
+
+1.  One query ranks the week's messages by likes, per author, keeping
+    each author's top DIGEST_SIZE (no reader's digest can use more of
+    theirs). The result is held in memory before the pool forks, so
+    every worker shares it.
+2.  Users are split into fixed ranges of CHUNK_SIZE ids, handed out to a
+    process pool. A worker reads a range's readers and their follows in
+    two queries, merges each reader's followed authors' candidates,
+    renders the digest with the precompiled templates and hands it to
+    the transport.
+3.  Each finished range is checkpointed, so a run that stops part way is
+    resumed, for the same week, where it left off. A range that was cut
+    off mid-way is sent again in full.
+
+Transports: "file" writes .eml files (tests, dry runs), "smtp" sends
+through SMTP_HOST. Run it weekly (cron):
+
+    python digest.py [--workers N] [--transport file|smtp] [--week-ending 2024-05-06]
+"""
+
+import argparse
+import heapq
+import json
+import os
+import smtplib
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from functools import partial
+from multiprocessing import Pool
+
+from sqlalchemy import text
+
+from ids import id_from_datetime
+
+DIGEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'digests')
+
+# messages per digest
+DIGEST_SIZE = 5
+
+# user ids per unit of work (and of checkpointing)
+CHUNK_SIZE = 1000
+
+SUBJECT = "Top warbles from your week"
+
+# each author's week, best first; ids bound the scan to the week's
+# partitions (ids are time-ordered, see ids.py)
+SELECT_CANDIDATES = """
+    WITH liked AS (
+        SELECT m.id, m.user_id, m.timestamp, m.text,
+               count(l.message_id) AS likes
+        FROM messages m
+        LEFT JOIN likes l ON l.message_id = m.id
+        WHERE m.id >= :low AND m.id < :high
+        GROUP BY m.id, m.user_id, m.timestamp, m.text
+    ), ranked AS (
+        SELECT liked.*, row_number() OVER (
+            PARTITION BY user_id ORDER BY likes DESC, id DESC) AS rank
+        FROM liked
+    )
+    SELECT r.user_id, u.username, r.id, r.timestamp, r.text, r.likes
+    FROM ranked r
+    JOIN users u ON u.id = r.user_id
+    WHERE r.rank <= :size AND u.deleted_at IS NULL
+"""
+
+SELECT_READERS = """
+    SELECT id, username, email FROM users
+    WHERE id >= :low AND id < :high AND deleted_at IS NULL
+    ORDER BY id
+"""
+
+SELECT_FOLLOWS = """
+    SELECT user_following_id, user_being_followed_id FROM follows
+    WHERE user_following_id >= :low AND user_following_id < :high
+"""
+
+# set in this process before the pool forks; workers read their copies
+_job = {}
+
+
+def week_ending(day=None):
+    """The end of the last whole week on or before `day`: Monday,
+    midnight UTC."""
+
+    day = day or datetime.utcnow()
+    monday = day - timedelta(days=day.weekday())
+    return datetime(monday.year, monday.month, monday.day)
+
+
+def candidates(conn, end, size=DIGEST_SIZE):
+    """{author id: [(likes, id, author id, username, timestamp, text)],
+    best first} for the week up to `end`."""
+
+    start = end - timedelta(days=7)
+    by_author = defaultdict(list)
+
+    for user_id, username, message_id, timestamp, body, likes in conn.execute(
+            text(SELECT_CANDIDATES),
+            {'low': id_from_datetime(start), 'high': id_from_datetime(end),
+             'size': size}):
+        by_author[user_id].append((likes, message_id, user_id, username,
+                                   timestamp, body))
+
+    for messages in by_author.values():
+        messages.sort(reverse=True)
+    return dict(by_author)
+
+
+def top_messages(by_author, followed, size=DIGEST_SIZE):
+    """The `size` best of the candidates of authors in `followed`."""
+
+    return heapq.nlargest(size, (message for author in followed
+                                 for message in by_author.get(author, ())))
+
+
+def chunk_ranges(max_id, chunk_size=CHUNK_SIZE):
+    """(chunk number, first id, end id) covering ids 0..`max_id`."""
+
+    return [(n, n * chunk_size, (n + 1) * chunk_size)
+            for n in range(max_id // chunk_size + 1)]
+
+
+##############################################################################
+# Rendering and transports
+
+
+def build_message(reader, messages, templates, end, sender, base_url):
+    """The digest email for `reader`, an (id, username, email) row."""
+
+    user_id, username, email = reader
+    context = {
+        'username': username,
+        'messages': [{'id': message_id, 'user_id': author_id,
+                      'username': author, 'text': body, 'likes': likes,
+                      'timestamp': timestamp}
+                     for likes, message_id, author_id, author, timestamp, body
+                     in messages],
+        'week_start': end - timedelta(days=7),
+        'week_end': end - timedelta(days=1),
+        'base_url': base_url,
+    }
+
+    msg = EmailMessage()
+    msg['Subject'] = SUBJECT
+    msg['From'] = sender
+    msg['To'] = email
+    msg['X-Warbler-User'] = str(user_id)
+    msg.set_content(templates['text'].render(context))
+    msg.add_alternative(templates['html'].render(context), subtype='html')
+    return msg
+
+
+class FileTransport:
+    """Writes each digest to `directory`/<user id>.eml."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def send(self, msg):
+        path = os.path.join(self.directory, f"{msg['X-Warbler-User']}.eml")
+        with open(path + '.tmp', 'wb') as f:
+            f.write(msg.as_bytes())
+        os.replace(path + '.tmp', path)
+
+
+class SMTPTransport:
+    """Sends digests through an SMTP server, one connection per chunk."""
+
+    def __init__(self, host, port=25):
+        self.host = host
+        self.port = port
+        self.smtp = None
+
+    def __enter__(self):
+        self.smtp = smtplib.SMTP(self.host, self.port)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.smtp.quit()
+        self.smtp = None
+
+    def send(self, msg):
+        self.smtp.send_message(msg)
+
+
+def make_transport(name, out=None):
+    if name == 'file':
+        return FileTransport(out)
+    if name == 'smtp':
+        return SMTPTransport(os.environ.get('SMTP_HOST', 'localhost'),
+                             int(os.environ.get('SMTP_PORT', 25)))
+    raise ValueError(f"unknown transport {name!r}")
+
+
+##############################################################################
+# Checkpoints
+
+
+class Checkpoint:
+    """The chunks of one week's run already sent, kept in `path`.
+
+    Chunk numbers only mean the same ranges at the same `chunk_size`; a
+    checkpoint saved at another is ignored.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.done = set()
+        self.stats = Counter()
+
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['chunk_size'] == chunk_size:
+                self.done = set(saved['done'])
+                self.stats.update(saved['stats'])
+
+    def record(self, chunk, stats):
+        self.done.add(chunk)
+        self.stats.update(stats)
+
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'chunk_size': self.chunk_size,
+                       'done': sorted(self.done), 'stats': self.stats}, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+##############################################################################
+# The job
+
+
+def send_chunk(chunk):
+    """Build and send the digests for one range of users; runs in a pool
+    worker. Returns (chunk number, counters)."""
+
+    from models import db
+
+    number, low, high = chunk
+    stats = Counter()
+
+    started = time.perf_counter()
+    with _job['app'].app_context(), db.engine.connect() as conn:
+        params = {'low': low, 'high': high}
+        readers = conn.execute(text(SELECT_READERS), params).fetchall()
+        follows = defaultdict(list)
+        for follower, followed in conn.execute(text(SELECT_FOLLOWS), params):
+            follows[follower].append(followed)
+    stats['query_seconds'] = time.perf_counter() - started
+
+    with _job['transport']() as transport:
+        for reader in readers:
+            stats['readers'] += 1
+            messages = top_messages(_job['candidates'], follows[reader[0]],
+                                    _job['size'])
+            if not messages:
+                continue
+
+            started = time.perf_counter()
+            msg = build_message(reader, messages, _job['templates'],
+                                _job['end'], _job['sender'],
+                                _job['base_url'])
+            stats['render_seconds'] += time.perf_counter() - started
+
+            started = time.perf_counter()
+            transport.send(msg)
+            stats['send_seconds'] += time.perf_counter() - started
+            stats['sent'] += 1
+
+    return number, stats
+
+
+def run(app, end, transport, workers=None, chunk_size=CHUNK_SIZE,
+        size=DIGEST_SIZE, directory=DIGEST_DIR, restart=False):
+    """Send every user their digest for the week up to `end`, resuming
+    a run for the same week unless `restart`.
+
+    `transport` builds a transport (in each worker). Returns the run's
+    counters, including those of the runs it resumed.
+    """
+
+    from models import db
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{end:%Y-%m-%d}.checkpoint.json")
+    if restart and os.path.exists(path):
+        os.remove(path)
+    checkpoint = Checkpoint(path, chunk_size)
+
+    started = time.perf_counter()
+
+    with app.app_context():
+        with db.engine.connect() as conn:
+            max_id = conn.execute(text("SELECT max(id) FROM users")).scalar()
+            by_author = candidates(conn, end, size)
+
+        # workers open their own connections; none of these may cross
+        db.engine.dispose()
+
+    _job.update(
+        app=app, candidates=by_author, transport=transport, size=size,
+        end=end,
+        templates={'text': app.jinja_env.get_template('digest/email.txt'),
+                   'html': app.jinja_env.get_template('digest/email.html')},
+        sender=os.environ.get('DIGEST_FROM', 'digest@warbler.local'),
+        base_url=os.environ.get('DIGEST_BASE_URL', 'http://localhost:5000'))
+
+    chunks = [chunk for chunk in chunk_ranges(max_id or 0, chunk_size)
+              if chunk[0] not in checkpoint.done]
+    stats = Counter(resumed_chunks=len(checkpoint.done))
+
+    try:
+        with Pool(workers) as pool:
+            for number, chunk_stats in pool.imap_unordered(send_chunk, chunks):
+                checkpoint.record(number, chunk_stats)
+                stats.update(chunk_stats)
+    finally:
+        _job.clear()
+
+    stats['seconds'] = time.perf_counter() - started
+    stats['authors'] = len(by_author)
+    stats['total_sent'] = checkpoint.stats['sent']
+    return stats
+
+
+def format_report(stats):
+    seconds = stats['seconds']
+    rate = stats['sent'] / seconds if seconds else 0.0
+
+    lines = [f"{stats['sent']} digests for {stats['readers']} users "
+             f"in {seconds:.1f}s ({rate:.0f} digests/s)",
+             f"candidates from {stats['authors']} authors",
+             f"worker seconds: query {stats['query_seconds']:.1f}, "
+             f"render {stats['render_seconds']:.1f}, "
+             f"send {stats['send_seconds']:.1f}"]
+
+    if stats['resumed_chunks']:
+        lines.append(f"resumed after {stats['resumed_chunks']} chunks; "
+                     f"{stats['total_sent']} sent this week in all")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Send every user their weekly digest.")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--transport', choices=['file', 'smtp'],
+                        default='file')
+    parser.add_argument('--out', help="where the file transport writes")
+    parser.add_argument('--week-ending',
+                        type=lambda day: datetime.strptime(day, '%Y-%m-%d'))
+    parser.add_argument('--restart', action='store_true',
+                        help="ignore the checkpoint of an earlier run")
+    args = parser.parse_args()
+
+    from app import create_app
+
+    end = week_ending(args.week_ending)
+    out = args.out or os.path.join(DIGEST_DIR, f"{end:%Y-%m-%d}")
+
+    print(format_report(run(create_app(), end,
+                            partial(make_transport, args.transport, out),
+                            workers=args.workers, chunk_size=args.chunk_size,
+                            restart=args.restart)))
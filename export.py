@@ -0,0 +1,320 @@
+"""Export everything a user has on Warbler, without loading it all.
+
+Each section (profile, messages, likes, followers, following) is one
+query read through a server-side cursor, EXPORT_FETCH rows at a time, and
+encoded as it arrives, so memory stays flat however big the account is.
+Archived messages (archive.py) follow the ones still in the table.
+
+    stream(user_id, 'ndjson')      generator of bytes, for a response
+    write(user_id, 'csv', path)    gzip-compressed file, for big accounts
+    start_job(app, user_id, 'csv', directory)
+                                   `write` in a background thread
+
+A user has at most one background export running; asking again while
+it is gets that one. Finished and failed export files are deleted after
+EXPORT_RETENTION seconds.
+
+Formats: NDJSON, one object per line with a "type" field, or CSV, one
+table whose columns are the union of the sections' fields.
+
+From the command line (e.g. for a support request):
+
+    python export.py <user_id> [--format csv] [--out export.csv.gz]
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import select
+
+import archive
+from models import db, User, Message, Likes, Follows
+
+EXPORT_FETCH = 500
+
+FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+}
+
+JOB_NAME_RE = re.compile(r"(\d+)-[\w-]{16}\.(ndjson|csv)\.gz")
+
+# a job's ".tmp" file untouched this long (seconds) belongs to a dead worker
+STALE_AFTER = 15 * 60
+
+_pool = None
+_pool_pid = None
+_jobs_lock = threading.Lock()
+
+CSV_FIELDS = ['type', 'id', 'user_id', 'username', 'text', 'timestamp',
+              'email', 'bio', 'location', 'image_url', 'header_image_url']
+
+
+def sections(user_id):
+    """(type, query) for each part of `user_id`'s export."""
+
+    users = User.__table__
+    messages = Message.__table__
+    likes = Likes.__table__
+    follows = Follows.__table__
+
+    return [
+        ('profile', select([users.c.id, users.c.username, users.c.email,
+                            users.c.bio, users.c.location, users.c.image_url,
+                            users.c.header_image_url])
+         .where(users.c.id == user_id)),
+
+        ('message', select([messages.c.id, messages.c.text,
+                            messages.c.timestamp])
+         .where(messages.c.user_id == user_id)
+         .order_by(messages.c.id)),
+
+        ('like', select([messages.c.id, messages.c.user_id, messages.c.text,
+                         messages.c.timestamp])
+         .select_from(likes.join(messages, likes.c.message_id == messages.c.id))
+         .where(likes.c.user_id == user_id)
+         .order_by(messages.c.id)),
+
+        ('follower', select([users.c.id.label('user_id'), users.c.username])
+         .select_from(follows.join(
+             users, users.c.id == follows.c.user_following_id))
+         .where(follows.c.user_being_followed_id == user_id)
+         .order_by(users.c.id)),
+
+        ('following', select([users.c.id.label('user_id'), users.c.username])
+         .select_from(follows.join(
+             users, users.c.id == follows.c.user_being_followed_id))
+         .where(follows.c.user_following_id == user_id)
+         .order_by(users.c.id)),
+    ]
+
+
+def archived_batches(cold, user_id):
+    """Batches of `user_id`'s archived messages, as 'message' rows."""
+
+    batch = []
+    for msg in cold.user_messages(user_id):
+        batch.append(('message', {'id': msg.id, 'text': msg.text,
+                                  'timestamp': msg.timestamp}))
+        if len(batch) == EXPORT_FETCH:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def batches(conn, user_id, cold=None):
+    """Batches of (type, row dict), up to EXPORT_FETCH rows each.
+
+    `cold` is the Archive to read archived messages from, if any.
+    """
+
+    for kind, query in sections(user_id):
+        result = conn.execution_options(stream_results=True).execute(query)
+        try:
+            while True:
+                rows = result.fetchmany(EXPORT_FETCH)
+                if not rows:
+                    break
+                yield [(kind, dict(row)) for row in rows]
+        finally:
+            result.close()
+
+        if kind == 'message' and cold is not None:
+            yield from archived_batches(cold, user_id)
+
+
+def _json_default(value):
+    # timestamps are the only non-JSON values in an export
+    return value.isoformat()
+
+
+def encode(batches, fmt):
+    """Encode batches of rows as `fmt`; yields one bytes chunk per batch."""
+
+    if fmt == 'ndjson':
+        for batch in batches:
+            yield "".join(
+                json.dumps(dict(row, type=kind), default=_json_default) + "\n"
+                for kind, row in batch).encode()
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS)
+    writer.writeheader()
+
+    for batch in batches:
+        for kind, row in batch:
+            writer.writerow(dict(row, type=kind))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+    # a header alone, for an export with no rows at all
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def stream(user_id, fmt):
+    """Generator of `user_id`'s export as `fmt`, for a streamed response.
+
+    Uses a connection of its own, held until the generator is done.
+    """
+
+    cold = archive.store(current_app.config['ARCHIVE_DIR'])
+    with db.engine.connect() as conn:
+        yield from encode(batches(conn, user_id, cold), fmt)
+
+
+def write(user_id, fmt, path):
+    """Write `user_id`'s export as `fmt` to a gzip file at `path`.
+
+    Written under a temporary name and renamed when complete, so a file
+    at `path` is always a finished export.
+    """
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    with gzip.open(path + '.tmp', 'wb') as f:
+        for chunk in stream(user_id, fmt):
+            f.write(chunk)
+
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def job_name(user_id, fmt):
+    """File name for a new background export (unguessable)."""
+
+    return f"{user_id}-{secrets.token_urlsafe(12)}.{FORMATS[fmt][1]}.gz"
+
+
+def _executor(max_workers):
+    """This process's export threads (pools don't survive fork)."""
+
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ThreadPoolExecutor(max_workers=max_workers,
+                                   thread_name_prefix='export')
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def _age(path, now):
+    try:
+        return now - os.path.getmtime(path)
+    except FileNotFoundError:
+        # deleted meanwhile
+        return None
+
+
+def running_job(directory, user_id, now=None):
+    """Name of `user_id`'s export still being written, or None.
+
+    A job's file exists as "<name>.tmp" from when it is started until it
+    is complete; the other workers see it there too.
+    """
+
+    now = now or time.time()
+    prefix = f"{user_id}-"
+
+    for entry in os.listdir(directory):
+        name = entry[:-len('.tmp')]
+        if (entry.startswith(prefix) and entry.endswith('.tmp')
+                and JOB_NAME_RE.fullmatch(name)):
+            age = _age(os.path.join(directory, entry), now)
+            if age is not None and age < STALE_AFTER:
+                return name
+
+    return None
+
+
+def cleanup(directory, retention, now=None):
+    """Delete exports, finished or failed, older than `retention` seconds.
+
+    Also deletes ".tmp" files abandoned by dead workers. Returns the
+    number of files deleted.
+    """
+
+    now = now or time.time()
+    deleted = 0
+
+    for entry in os.listdir(directory):
+        name, _, suffix = entry.partition('.gz')
+        if not JOB_NAME_RE.fullmatch(name + '.gz'):
+            continue
+
+        limit = STALE_AFTER if suffix == '.tmp' else retention
+        age = _age(os.path.join(directory, entry), now)
+        if age is not None and age >= limit:
+            try:
+                os.remove(os.path.join(directory, entry))
+                deleted += 1
+            except FileNotFoundError:
+                pass
+
+    return deleted
+
+
+def start_job(app, user_id, fmt, directory):
+    """Write an export in the background; returns its file name.
+
+    The file appears in `directory` when it is complete. If the export
+    fails, a "<name>.failed" file appears instead. If one of the user's
+    exports is still being written, returns its name instead of starting
+    another. Old exports are cleaned up on the way.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    cleanup(directory, app.config['EXPORT_RETENTION'])
+
+    with _jobs_lock:
+        running = running_job(directory, user_id)
+        if running is not None:
+            return running
+
+        name = job_name(user_id, fmt)
+        path = os.path.join(directory, name)
+        # claims the job for running_job until `write` renames it
+        open(path + '.tmp', 'wb').close()
+
+    def run():
+        try:
+            with app.app_context():
+                write(user_id, fmt, path)
+        except Exception:
+            app.logger.exception("export %s failed", name)
+            open(path + '.failed', 'w').close()
+            try:
+                os.remove(path + '.tmp')
+            except FileNotFoundError:
+                pass
+
+    _executor(app.config['EXPORT_WORKERS']).submit(run)
+    return name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Write a user's data export to a gzip file.")
+    parser.add_argument('user_id', type=int)
+    parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+    parser.add_argument('--out')
+    args = parser.parse_args()
+
+    from app import create_app
+
+    out = args.out or f"warbler-{args.user_id}.{FORMATS[args.format][1]}.gz"
+    with create_app().app_context():
+        print(write(args.user_id, args.format, out))
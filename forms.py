@@ -1,6 +1,18 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, PasswordField, TextAreaField
-from wtforms.validators import DataRequired, Email, Length
+from wtforms.validators import DataRequired, Email, Length, Regexp
+
+from models import USERNAME_PATTERN
+
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
+USERNAME_VALIDATORS = [
+    DataRequired(),
+    Regexp(f"^{USERNAME_PATTERN}$",
+           message="Letters, digits, _, . and - only, "
+                   "starting and ending with a letter or digit."),
+]
 
 
 class MessageForm(FlaskForm):
@@ -12,7 +24,7 @@ class MessageForm(FlaskForm):
 class UserAddForm(FlaskForm):
     """Form for adding users."""
 
-    username = StringField('Username', validators=[DataRequired()])
+    username = StringField('Username', validators=USERNAME_VALIDATORS)
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
@@ -28,9 +40,11 @@ class LoginForm(FlaskForm):
 class EditUserForm(FlaskForm):
     """Form for editing users."""
 
-    username = StringField('Username', validators=[DataRequired()])
+    username = StringField('Username', validators=USERNAME_VALIDATORS)
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     image_url = StringField('(Optional) Image URL')
+    image_file = FileField('(Optional) Upload Image', validators=[FileAllowed(IMAGE_EXTENSIONS)])
     header_image_url = StringField('(Optional) Header Image URL')
+    header_image_file = FileField('(Optional) Upload Header Image', validators=[FileAllowed(IMAGE_EXTENSIONS)])
     bio = StringField('(Optional) Bio')
     password = PasswordField('Password', validators=[Length(min=6)])
\ No newline at end of file
@@ -0,0 +1,135 @@
+"""Gunicorn settings for running Warbler in production.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The master imports and builds the app once (preload_app), then forks
+WEB_CONCURRENCY workers of WEB_THREADS threads each. Imported code and
+compiled templates are shared copy-on-write between workers instead of
+being built again in each one.
+
+No database connection crosses a fork: the master's pool is emptied
+before each worker is forked, and models.py won't hand a worker a
+connection some other process opened. Each worker opens its own pool;
+with WARM_UP set it does so before it takes traffic.
+
+With WARM_UP and preloading, the master warms the caches (startup.py)
+before forking, within WARM_UP_BUDGET, and every worker starts with
+its copy. Without preloading, each worker warms its own.
+
+Reloading:
+
+    kill -HUP <master>      replace the workers, letting each finish its
+                            requests first (graceful_timeout); preloaded
+                            code is NOT reloaded
+    kill -USR2 <master>     start a second master on the new code, then
+    kill -QUIT <old master> retire the old one once the new one is up
+
+With PRELOAD=0, HUP reloads code too, at the cost of the shared memory.
+
+Message ids (ids.py) need a node id per process. Each worker takes a
+slot, the lowest no live worker holds, and mints ids as node
+WARBLER_NODE_BASE + slot; a replacement worker reuses its predecessor's
+slot. Workers overlap while reloading, so a server uses up to
+2 x WEB_CONCURRENCY node ids: give each host its own range of them.
+
+Settings come from the environment: PORT (8000), WEB_CONCURRENCY
+(2 x CPUs + 1), WEB_THREADS (1), PRELOAD (1), MAX_REQUESTS (0: never
+recycle workers), WARBLER_NODE_BASE (WARBLER_NODE_ID, else 1).
+bench_serve.py compares configurations.
+"""
+
+import multiprocessing
+import os
+
+from ids import MAX_NODE_ID
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 1))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+preload_app = os.environ.get('PRELOAD', '1') != '0'
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 2
+
+# staggered, so recycled workers don't all restart at once
+max_requests = int(os.environ.get('MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+
+node_base = int(os.environ.get('WARBLER_NODE_BASE',
+                               os.environ.get('WARBLER_NODE_ID', 1)))
+
+# new workers start before old ones stop, when reloading
+node_slots = 2 * workers
+
+
+def on_starting(server):
+    if not 1 <= node_base <= MAX_NODE_ID - node_slots + 1:
+        raise RuntimeError(
+            f"WARBLER_NODE_BASE must leave room for {node_slots} node ids "
+            f"in 1-{MAX_NODE_ID}")
+
+
+def pre_fork(server, worker):
+    """Give the new worker a node slot, and empty the master's pool, so
+    it inherits no connections.
+
+    Preloading (or warming up) the app in the master may have opened some.
+    A warm-up still running is given the rest of its budget, then stopped.
+    """
+
+    taken = {other.node_slot for other in server.WORKERS.values()}
+    free = [slot for slot in range(node_slots) if slot not in taken]
+    if not free:
+        raise RuntimeError(f"all {node_slots} node ids are in use")
+    worker.node_slot = free[0]
+
+    if preload_app:
+        from models import db
+        from startup import warm_up_state
+        from wsgi import app
+
+        warm_up_state.stop()
+        with app.app_context():
+            db.engine.dispose()
+
+
+def post_fork(server, worker):
+    """Mint this worker's message ids as its own node."""
+
+    from ids import generator
+
+    generator.set_node_id(node_base + worker.node_slot)
+
+
+def post_worker_init(worker):
+    """Open this worker's connections before it takes traffic."""
+
+    from wsgi import app
+
+    # without preloading, create_app started this worker's own warm-up
+    if preload_app and app.config['WARM_UP']:
+        # templates were compiled in the master already; this mostly
+        # fills the worker's own pool
+        from startup import warm_up
+        timings = warm_up(app)
+        worker.log.info("warmed up in %.0f ms", sum(timings.values()) * 1000)
+
+
+def worker_exit(server, worker):
+    """Write out buffered likes, follows and notifications, and this
+    worker's trends snapshot."""
+
+    from notifications import notifier
+    from trending import trends
+    from write_behind import write_behind
+
+    write_behind.flush()
+    notifier.flush()
+    trends.snapshot()
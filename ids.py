@@ -0,0 +1,149 @@
+"""Time-sortable 64-bit ids for Warbler messages.
+
+Ids are laid out Snowflake-style, most significant bit first:
+
+    41 bits  milliseconds since EPOCH
+    10 bits  node id
+    12 bits  per-millisecond sequence
+
+so sorting by id is sorting by creation time, and any number of processes
+can mint ids without talking to each other as long as they run under
+different node ids.
+
+Under gunicorn every worker is given its own node id, WARBLER_NODE_BASE
+plus its worker slot (see gunicorn.conf.py); give each host its own
+range. A lone process takes WARBLER_NODE_ID (0-1023). Without either the
+node id is derived from the host name and process id, which is good
+enough for development but not unique across many processes. Node 0 is
+reserved for ids backfilled from existing timestamps (see
+`id_from_datetime`).
+"""
+
+import os
+import socket
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+# 2010-01-01T00:00:00Z, in milliseconds since the Unix epoch
+EPOCH = 1262304000000
+
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_NODE_ID = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+NODE_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = NODE_BITS + SEQUENCE_BITS
+
+_UNIX_EPOCH = datetime(1970, 1, 1)
+
+
+def default_node_id():
+    """Node id for this process: WARBLER_NODE_ID, else host + pid."""
+
+    configured = os.environ.get('WARBLER_NODE_ID')
+    if configured is not None:
+        node_id = int(configured)
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f"WARBLER_NODE_ID must be 0-{MAX_NODE_ID}")
+        return node_id
+
+    seed = f"{socket.gethostname()}:{os.getpid()}".encode()
+    # never hand out the backfill node
+    return zlib.crc32(seed) % MAX_NODE_ID + 1
+
+
+def _millis(dt):
+    """Milliseconds since the Unix epoch for a naive UTC datetime."""
+
+    return (dt - _UNIX_EPOCH) // timedelta(milliseconds=1)
+
+
+def id_from_datetime(dt, node_id=0, sequence=0):
+    """Build the id a message created at `dt` (naive UTC) would have.
+
+    With the defaults this is the smallest id for that millisecond, which
+    makes it usable as a cursor bound: `Message.id < id_from_datetime(t)`
+    selects everything posted before `t`.
+    """
+
+    return (((_millis(dt) - EPOCH) << TIMESTAMP_SHIFT)
+            | (node_id << NODE_SHIFT)
+            | sequence)
+
+
+def datetime_from_id(message_id):
+    """Creation time (naive UTC) encoded in `message_id`."""
+
+    millis = (message_id >> TIMESTAMP_SHIFT) + EPOCH
+    return _UNIX_EPOCH + timedelta(milliseconds=millis)
+
+
+class IdGenerator:
+    """Thread-safe generator of Snowflake-style ids."""
+
+    def __init__(self, node_id=None):
+        self._configured_node_id = node_id
+        self._lock = threading.Lock()
+        self._reset()
+
+    def set_node_id(self, node_id):
+        """Mint ids as `node_id` from now on, in this process."""
+
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f"node id must be 0-{MAX_NODE_ID}")
+
+        with self._lock:
+            self._configured_node_id = node_id
+            self.node_id = node_id
+            self._pid = os.getpid()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        if self._configured_node_id is None:
+            self.node_id = default_node_id()
+        else:
+            self.node_id = self._configured_node_id
+        self._last_millis = -1
+        self._sequence = 0
+
+    def next_id(self):
+        """Return a new id, unique for this node and larger than the last."""
+
+        with self._lock:
+            # a forked worker must not keep minting its parent's ids
+            if os.getpid() != self._pid:
+                self._reset()
+
+            now = int(time.time() * 1000)
+
+            # the clock went backwards (NTP step); stay monotonic
+            if now < self._last_millis:
+                now = self._last_millis
+
+            if now == self._last_millis:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # used up this millisecond, wait for the next one
+                    while now <= self._last_millis:
+                        now = int(time.time() * 1000)
+            else:
+                self._sequence = 0
+
+            self._last_millis = now
+
+            return (((now - EPOCH) << TIMESTAMP_SHIFT)
+                    | (self.node_id << NODE_SHIFT)
+                    | self._sequence)
+
+
+generator = IdGenerator()
+
+
+def generate_id():
+    """Column default for Message.id."""
+
+    return generator.next_id()
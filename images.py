@@ -0,0 +1,202 @@
+"""Local, content-addressed store for avatar and header images.
+
+Uploaded images are stored under MEDIA_DIR by the SHA-256 of their bytes:
+
+    media/ab/<digest>/original.png
+    media/ab/<digest>/timeline.jpg    96x96 crop, timeline avatars
+    media/ab/<digest>/card.jpg        fits 400x400, user cards
+    media/ab/<digest>/hero.jpg        fits 1600x1600, profile header
+
+and served from /media/<digest>/<name>. Identical uploads share one
+directory. The resized variants are made in a process pool, off the
+request; until they exist the original is served in their place. A
+failed resize is logged, and tried again when the same image is
+uploaded again.
+
+Users' image URLs keep pointing at the original. Templates ask for a
+variant with the `image_variant` filter, which leaves remote URLs as
+they are.
+
+Resizing needs Pillow (optional); without it uploads are refused.
+"""
+
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional dependency
+    Image = None
+
+MEDIA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media')
+
+# name -> (width, height, crop to exactly that size?)
+VARIANTS = {
+    'timeline': (96, 96, True),
+    'card': (400, 400, False),
+    'hero': (1600, 1600, False),
+}
+
+ALLOWED_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+JPEG_QUALITY = 85
+
+DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+MEDIA_URL_RE = re.compile(r"^/media/([0-9a-f]{64})/")
+
+_pool = None
+_pool_pid = None
+
+# originals whose variants this process is making right now
+_resizing = set()
+
+
+class ImageError(ValueError):
+    """The upload isn't an image we can store."""
+
+
+def _executor(max_workers=None):
+    """This process's resize pool (pools don't survive fork)."""
+
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ProcessPoolExecutor(max_workers=max_workers)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def image_dir(digest, media_dir=MEDIA_DIR):
+    return os.path.join(media_dir, digest[:2], digest)
+
+
+def make_variants(original_path):
+    """Write every variant next to `original_path`; runs in the pool."""
+
+    directory = os.path.dirname(original_path)
+
+    with Image.open(original_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            # flatten transparency onto white for JPEG
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image.convert('RGBA'),
+                             mask=image.convert('RGBA').split()[-1])
+            image = background
+
+        for name, (width, height, crop) in VARIANTS.items():
+            if crop:
+                variant = ImageOps.fit(image, (width, height), Image.LANCZOS)
+            else:
+                variant = image.copy()
+                variant.thumbnail((width, height), Image.LANCZOS)
+
+            # write then rename, so a half-written variant is never served
+            target = os.path.join(directory, f"{name}.jpg")
+            variant.save(target + '.tmp', 'JPEG', quality=JPEG_QUALITY,
+                         optimize=True, progressive=True)
+            os.replace(target + '.tmp', target)
+
+
+def variants_missing(directory):
+    """Are any of the variants in `directory` not written yet?"""
+
+    return not all(os.path.exists(os.path.join(directory, f"{name}.jpg"))
+                   for name in VARIANTS)
+
+
+def queue_variants(original, max_workers=None, logger=None):
+    """Have the pool make `original`'s variants, unless it already is.
+
+    A failure is logged to `logger`; the original is served meanwhile,
+    and the next upload of the same bytes tries again.
+    """
+
+    if original in _resizing:
+        return
+    _resizing.add(original)
+
+    def done(future):
+        _resizing.discard(original)
+        error = future.exception()
+        if error is not None and logger is not None:
+            logger.error("resizing %s failed", original,
+                         exc_info=(type(error), error, error.__traceback__))
+
+    _executor(max_workers).submit(make_variants, original).add_done_callback(
+        done)
+
+
+def store_upload(upload, media_dir=MEDIA_DIR, max_workers=None, logger=None):
+    """Store an uploaded image (a FileStorage) and return its URL.
+
+    Queues the resizing in the process pool and returns without waiting.
+    """
+
+    if Image is None:
+        raise ImageError("Image uploads need Pillow installed.")
+
+    data = upload.read()
+    digest = hashlib.sha256(data).hexdigest()
+    directory = image_dir(digest, media_dir)
+
+    for ext in ALLOWED_FORMATS.values():
+        original = os.path.join(directory, f"original.{ext}")
+        if os.path.exists(original):
+            # seen these exact bytes before; resizing them may have failed
+            if variants_missing(directory):
+                queue_variants(original, max_workers, logger)
+            return f"/media/{digest}/original.{ext}"
+
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image_format = image.format
+            image.verify()
+    except Exception:
+        raise ImageError("That file isn't an image.")
+
+    if image_format not in ALLOWED_FORMATS:
+        raise ImageError("Images must be JPEG, PNG, GIF or WebP.")
+
+    ext = ALLOWED_FORMATS[image_format]
+    os.makedirs(directory, exist_ok=True)
+    original = os.path.join(directory, f"original.{ext}")
+
+    with open(original + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(original + '.tmp', original)
+
+    queue_variants(original, max_workers, logger)
+
+    return f"/media/{digest}/original.{ext}"
+
+
+def media_file(digest, name, media_dir=MEDIA_DIR):
+    """Directory and file name to serve for /media/<digest>/<name>.
+
+    Falls back to the original while a variant is still being made.
+    Returns (directory, name, final) where `final` says whether the
+    file served is the one asked for (and so can be cached forever).
+    """
+
+    directory = image_dir(digest, media_dir)
+    if os.path.exists(os.path.join(directory, name)):
+        return directory, name, True
+
+    for ext in ALLOWED_FORMATS.values():
+        if os.path.exists(os.path.join(directory, f"original.{ext}")):
+            return directory, f"original.{ext}", False
+
+    return directory, name, False
+
+
+def image_variant(url, variant):
+    """Jinja filter: URL of `variant` for a locally stored image URL."""
+
+    match = MEDIA_URL_RE.match(url or '')
+    if match is None or variant not in VARIANTS:
+        return url
+
+    return f"/media/{match.group(1)}/{variant}.jpg"
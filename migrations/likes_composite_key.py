@@ -0,0 +1,78 @@
+"""Rebuild likes around a (user_id, message_id) primary key.
+
+The old table had a serial id, no index on user_id and a unique
+message_id (one like per message, in all). Rows are copied into a new
+table in batches of the old id, one transaction each, dropping
+duplicates and rows missing either side; then, in one transaction, the
+old table is dropped, the new one takes its name and gets its reverse
+(message_id, user_id) index. An interrupted copy can be run again.
+
+Run it once, from the project root, with the app stopped:
+
+    python -m migrations.likes_composite_key
+"""
+
+from sqlalchemy import text
+
+from app import create_app
+from models import db
+
+BATCH_SIZE = 50000
+
+CREATE_NEW_TABLE = """
+    CREATE TABLE IF NOT EXISTS likes_new (
+        user_id INTEGER NOT NULL
+            REFERENCES users (id) ON DELETE CASCADE,
+        message_id BIGINT NOT NULL
+            REFERENCES messages (id) ON DELETE CASCADE,
+        PRIMARY KEY (user_id, message_id)
+    )
+"""
+
+COPY_BATCH = """
+    INSERT INTO likes_new (user_id, message_id)
+    SELECT user_id, message_id FROM likes
+    WHERE id >= :low AND id < :high
+      AND user_id IS NOT NULL AND message_id IS NOT NULL
+    ON CONFLICT DO NOTHING
+"""
+
+SWAP_TABLES = [
+    "DROP TABLE likes",
+    "ALTER TABLE likes_new RENAME TO likes",
+    "ALTER TABLE likes RENAME CONSTRAINT likes_new_pkey TO likes_pkey",
+    """ALTER TABLE likes
+       RENAME CONSTRAINT likes_new_user_id_fkey TO likes_user_id_fkey""",
+    """ALTER TABLE likes
+       RENAME CONSTRAINT likes_new_message_id_fkey TO likes_message_id_fkey""",
+    # built once the rows are in, rather than kept up row by row
+    "CREATE INDEX likes_message_id_user_id ON likes (message_id, user_id)",
+]
+
+
+def migrate(engine):
+    """Run the migration; returns (rows before, rows after)."""
+
+    with engine.begin() as conn:
+        conn.execute(text(CREATE_NEW_TABLE))
+        before, high_water = conn.execute(text(
+            "SELECT count(*), coalesce(max(id), -1) FROM likes")).first()
+
+    for low in range(0, high_water + 1, BATCH_SIZE):
+        with engine.begin() as conn:
+            conn.execute(text(COPY_BATCH),
+                         {'low': low, 'high': low + BATCH_SIZE})
+
+    with engine.begin() as conn:
+        for statement in SWAP_TABLES:
+            conn.execute(text(statement))
+        after = conn.execute(text("SELECT count(*) FROM likes")).scalar()
+
+    return before, after
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        before, after = migrate(db.engine)
+        print(f"{after} likes kept of {before} ({before - after} dropped)")
@@ -0,0 +1,31 @@
+"""Add the notifications table and the users' cached unread count.
+
+Run it once, from the project root:
+
+    python -m migrations.notifications
+"""
+
+from sqlalchemy import text
+
+from app import create_app
+from models import db, Notification
+
+SCHEMA_CHANGES = [
+    """ALTER TABLE users ADD COLUMN IF NOT EXISTS
+       unread_notifications INTEGER NOT NULL DEFAULT 0""",
+]
+
+
+def migrate(conn):
+    """Run the migration on `conn` (inside a transaction)."""
+
+    for statement in SCHEMA_CHANGES:
+        conn.execute(text(statement))
+
+    Notification.__table__.create(conn, checkfirst=True)
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context(), db.engine.begin() as conn:
+        migrate(conn)
@@ -0,0 +1,62 @@
+"""Turn the existing messages table into a partitioned one.
+
+The current table is kept, renamed to messages_legacy, and attached as
+the partition for every id below the start of next month; new months
+get partitions of their own (see partitions.py). Foreign keys from
+likes and message_tags are moved over to the partitioned table.
+
+Needs PostgreSQL 12 or later, and time-ordered ids already in place
+(migrations.snowflake_message_ids). Run it once, from the project root,
+with the app stopped:
+
+    python -m migrations.partition_messages
+"""
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+import partitions
+from app import create_app
+from models import db, Message
+
+DETACH_OLD_TABLE = partitions.DROP_FOREIGN_KEYS + [
+    "ALTER TABLE messages RENAME TO messages_legacy",
+    "ALTER TABLE messages_legacy RENAME CONSTRAINT messages_pkey TO messages_legacy_pkey",
+    "ALTER TABLE messages_legacy RENAME CONSTRAINT messages_user_id_fkey TO messages_legacy_user_id_fkey",
+]
+
+ATTACH_OLD_TABLE = """
+    ALTER TABLE messages ATTACH PARTITION messages_legacy
+    FOR VALUES FROM (MINVALUE) TO ({cutover})
+"""
+
+
+def migrate(conn, now=None):
+    """Run the migration on `conn` (inside a transaction)."""
+
+    now = now or datetime.utcnow()
+
+    for statement in DETACH_OLD_TABLE:
+        conn.execute(text(statement))
+
+    # creates the default partition as well
+    Message.__table__.create(conn)
+
+    # the legacy table covers everything up to the end of this month
+    year, month = partitions.add_months(now.year, now.month, 1)
+    cutover = partitions.month_bounds(year, month)[0]
+    conn.execute(text(ATTACH_OLD_TABLE.format(cutover=cutover)))
+
+    for offset in range(1, 4):
+        partitions.create_partition(
+            conn, *partitions.add_months(now.year, now.month, offset))
+
+    for statement in partitions.ADD_FOREIGN_KEYS:
+        conn.execute(text(statement))
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context(), db.engine.begin() as conn:
+        migrate(conn)
@@ -0,0 +1,32 @@
+"""Add account tombstones, admins and the purge_jobs table (see purge.py).
+
+Run it once, from the project root:
+
+    python -m migrations.purge
+"""
+
+from sqlalchemy import text
+
+from app import create_app
+from models import db, PurgeJob
+
+SCHEMA_CHANGES = [
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP',
+    """ALTER TABLE users ADD COLUMN IF NOT EXISTS is_admin BOOLEAN
+       NOT NULL DEFAULT false""",
+]
+
+
+def migrate(conn):
+    """Run the migration on `conn` (inside a transaction)."""
+
+    for statement in SCHEMA_CHANGES:
+        conn.execute(text(statement))
+
+    PurgeJob.__table__.create(conn, checkfirst=True)
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context(), db.engine.begin() as conn:
+        migrate(conn)
@@ -0,0 +1,115 @@
+"""Move existing messages onto time-ordered ids.
+
+Widens messages.id and likes.message_id to BIGINT, rewrites every legacy
+(serial) message id into the id it would have been given by ids.py at its
+original timestamp, and replaces the import-time timestamp default with a
+server-side one.
+
+Legacy messages often share a timestamp (the old default was evaluated
+once per process), so ids are handed out in (timestamp, old id) order,
+each the larger of its timestamp's first id and one past the previous:
+messages sharing a millisecond take consecutive ids, filling the
+sequence bits, then the node bits, then spilling into later
+milliseconds. New ids stay unique and in the old order.
+
+The id map is kept in a table (message_id_map) until the end, and ids
+are rewritten BATCH_SIZE old ids per transaction; an interrupted run
+picks up where it stopped when run again.
+
+Run it once, from the project root, with the app stopped:
+
+    python -m migrations.snowflake_message_ids
+"""
+
+from sqlalchemy import text
+
+from app import create_app
+from ids import EPOCH, TIMESTAMP_SHIFT
+from models import db
+
+# serial ids stay far below this; time-ordered ids are far above it
+LEGACY_ID_LIMIT = 1 << 40
+
+BATCH_SIZE = 50000
+
+SCHEMA_CHANGES = [
+    "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey",
+    "ALTER TABLE messages ALTER COLUMN id DROP DEFAULT",
+    "ALTER TABLE messages ALTER COLUMN id TYPE BIGINT",
+    "ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT",
+    "DROP SEQUENCE IF EXISTS messages_id_seq",
+    """ALTER TABLE messages ALTER COLUMN timestamp
+       SET DEFAULT (now() at time zone 'utc')""",
+]
+
+# new_id(n) = max(first_id(n), new_id(n - 1) + 1), in closed form: n plus
+# the running max of first_id - n. Node 0 is reserved for backfilled ids,
+# and nothing else is minted at legacy timestamps.
+BUILD_ID_MAP = f"""
+    CREATE TABLE message_id_map AS
+    SELECT old_id,
+           max(first_id - n) OVER (ORDER BY n ROWS UNBOUNDED PRECEDING) + n
+             AS new_id
+    FROM (
+        SELECT id AS old_id,
+               (floor(extract(epoch FROM timestamp) * 1000)::bigint - {EPOCH})
+                 << {TIMESTAMP_SHIFT} AS first_id,
+               row_number() OVER (ORDER BY timestamp, id) AS n
+        FROM messages
+        WHERE id < {LEGACY_ID_LIMIT}
+    ) legacy
+"""
+
+INDEX_ID_MAP = "CREATE UNIQUE INDEX ON message_id_map (old_id)"
+
+REWRITE_BATCH = """
+    UPDATE {table} t
+    SET {column} = m.new_id
+    FROM message_id_map m
+    WHERE t.{column} = m.old_id
+      AND m.old_id >= :low AND m.old_id < :high
+"""
+
+RESTORE_FOREIGN_KEY = """
+    ALTER TABLE likes
+    ADD CONSTRAINT likes_message_id_fkey
+    FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE
+"""
+
+
+def migrate(engine):
+    """Run the migration; returns how many messages were given new ids."""
+
+    with engine.begin() as conn:
+        # a map left by an interrupted run already has the schema changed
+        if conn.execute(text(
+                "SELECT to_regclass('message_id_map')")).scalar() is None:
+            for statement in SCHEMA_CHANGES:
+                conn.execute(text(statement))
+            conn.execute(text(BUILD_ID_MAP))
+            conn.execute(text(INDEX_ID_MAP))
+
+        mapped, high_water = conn.execute(text(
+            "SELECT count(*), coalesce(max(old_id), -1) "
+            "FROM message_id_map")).first()
+
+    # rows already rewritten no longer match their old id
+    for low in range(0, high_water + 1, BATCH_SIZE):
+        bounds = {'low': low, 'high': low + BATCH_SIZE}
+        with engine.begin() as conn:
+            conn.execute(text(REWRITE_BATCH.format(
+                table='likes', column='message_id')), bounds)
+            conn.execute(text(REWRITE_BATCH.format(
+                table='messages', column='id')), bounds)
+
+    with engine.begin() as conn:
+        conn.execute(text(RESTORE_FOREIGN_KEY))
+        conn.execute(text("DROP TABLE message_id_map"))
+
+    return mapped
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        print(f"{migrate(db.engine)} messages given time-ordered ids")
@@ -0,0 +1,34 @@
+"""Add follow timestamps and the user_stats table (see analytics.py).
+
+Existing follows keep a NULL timestamp: when they were made isn't known.
+Run it once, from the project root:
+
+    python -m migrations.user_stats
+"""
+
+from sqlalchemy import text
+
+from app import create_app
+from models import db, UserStats
+
+SCHEMA_CHANGES = [
+    # added without a default first, so existing rows stay NULL
+    'ALTER TABLE follows ADD COLUMN IF NOT EXISTS "timestamp" TIMESTAMP',
+    """ALTER TABLE follows ALTER COLUMN "timestamp"
+       SET DEFAULT (now() at time zone 'utc')""",
+]
+
+
+def migrate(conn):
+    """Run the migration on `conn` (inside a transaction)."""
+
+    for statement in SCHEMA_CHANGES:
+        conn.execute(text(statement))
+
+    UserStats.__table__.create(conn, checkfirst=True)
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context(), db.engine.begin() as conn:
+        migrate(conn)
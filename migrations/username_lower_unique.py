@@ -0,0 +1,75 @@
+"""Make usernames unique ignoring case.
+
+@mentions are matched case-insensitively (tags.py lowercases them), so
+"Bob" and "bob" can't both be users. This adds a unique index on
+lower(username), built CONCURRENTLY so signups carry on meanwhile.
+
+Existing names that differ only in case have to be renamed first; the
+migration lists them and stops if there are any. Run it once, from the
+project root:
+
+    python -m migrations.username_lower_unique
+"""
+
+import sys
+
+from sqlalchemy import text
+
+from app import create_app
+from models import db, USERNAME_LOWER_INDEX
+
+FIND_CLASHES = """
+    SELECT lower(username), array_agg(username ORDER BY id)
+    FROM users
+    GROUP BY lower(username)
+    HAVING count(*) > 1
+    ORDER BY lower(username)
+"""
+
+# a failed concurrent build leaves an invalid index behind
+DROP_INVALID = f"""
+    DROP INDEX IF EXISTS {USERNAME_LOWER_INDEX}
+"""
+
+IS_INVALID = """
+    SELECT NOT indisvalid FROM pg_index
+    WHERE indexrelid = to_regclass(:name)
+"""
+
+CREATE_INDEX = f"""
+    CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {USERNAME_LOWER_INDEX}
+    ON users (lower(username))
+"""
+
+
+def migrate(engine):
+    """Run the migration; returns the clashing names, if it couldn't.
+
+    Returns [(lowercased name, [usernames])]; empty once the index is in.
+    """
+
+    with engine.connect() as conn:
+        clashes = [tuple(row) for row in conn.execute(text(FIND_CLASHES))]
+    if clashes:
+        return clashes
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as conn:
+        if conn.execute(text(IS_INVALID),
+                        {'name': USERNAME_LOWER_INDEX}).scalar():
+            conn.execute(text(DROP_INVALID))
+        conn.execute(text(CREATE_INDEX))
+
+    return []
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        clashes = migrate(db.engine)
+
+    for name, usernames in clashes:
+        print(f"{name}: {', '.join(usernames)}")
+    if clashes:
+        sys.exit("rename the users above so no two differ only in case")
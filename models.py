@@ -1,13 +1,32 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+import os
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, exc, func
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.pool import Pool
+
+from ids import generate_id
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+_bcrypt = None
+
+
+def get_bcrypt():
+    """Return the Bcrypt helper, importing it on first use.
+
+    flask_bcrypt loads the bcrypt C extension, which only signup and
+    login need.
+    """
+
+    global _bcrypt
+    if _bcrypt is None:
+        from flask_bcrypt import Bcrypt
+        _bcrypt = Bcrypt()
+    return _bcrypt
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -26,28 +45,68 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # NULL for follows made before this was recorded
+    timestamp = db.Column(
+        db.DateTime,
+        server_default=db.text("(now() at time zone 'utc')"),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Is there a follow from `follower_id` to `followed_id`?
+
+        Looks up the single row by primary key rather than walking
+        either user's collection.
+        """
+
+        query = cls.query.filter_by(
+            user_following_id=follower_id,
+            user_being_followed_id=followed_id,
+        )
+        return db.session.query(query.exists()).scalar()
+
 
 class Likes(db.Model):
-    """Mapping user likes to warbles."""
+    """Mapping user likes to warbles.
 
-    __tablename__ = 'likes' 
+    Keyed on (user_id, message_id), so "which of these has the user
+    liked" is read off the primary key alone, and a like can't be made
+    twice; the reverse index does the same for "who liked this".
+    """
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
+    __tablename__ = 'likes'
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        db.Index('likes_message_id_user_id', 'message_id', 'user_id'),
     )
 
+    @classmethod
+    def exists(cls, user_id, message_id):
+        """Has `user_id` liked `message_id`? (a primary key lookup)"""
+
+        query = cls.query.filter_by(user_id=user_id, message_id=message_id)
+        return db.session.query(query.exists()).scalar()
+
+
+# what a username may be: word characters, dots and dashes, starting and
+# ending with a word character (so "@bob." at the end of a sentence is a
+# mention of bob); signup checks it, and tags.py finds @mentions with it
+USERNAME_PATTERN = r"\w(?:[\w.-]*\w)?"
+
+USERNAME_LOWER_INDEX = 'users_username_lower_key'
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,25 +153,58 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # kept up to date by notifications.py, so the nav bar needn't count
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # may queue moderation purges (see purge.py)
+    is_admin = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+    )
+
+    # set when the account is deleted: it's hidden everywhere from then
+    # on, and the row goes once purge.py has cleared out its content
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # collections are dynamic so that appending to (or counting) them
+    # never loads a user's whole history into memory
+    messages = db.relationship('Message', lazy='dynamic')
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        lazy='dynamic'
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        lazy='dynamic'
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        lazy='dynamic'
+    )
+
+    # usernames are unique ignoring case, as @mentions are matched; the
+    # index serves that lookup too (see notifications.notify_mentions)
+    __table_args__ = (
+        db.Index(USERNAME_LOWER_INDEX, func.lower(username), unique=True),
     )
 
     def __repr__(self):
@@ -121,14 +213,12 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(self.id, other_user.id)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +227,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = get_bcrypt().generate_password_hash(password).decode('UTF-8')
 
         user = User(
             username=username,
@@ -160,10 +250,10 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = get_bcrypt().check_password_hash(user.password, password)
             if is_auth:
                 return user
 
@@ -187,9 +277,12 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # time-ordered, so feeds can sort and page on the primary key alone
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=generate_id,
     )
 
     text = db.Column(
@@ -200,7 +293,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=db.text("(now() at time zone 'utc')"),
     )
 
     user_id = db.Column(
@@ -211,6 +304,247 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # monthly partitions over the time-ordered id; see partitions.py
+    __table_args__ = (
+        db.Index('messages_user_id_id', 'user_id', 'id'),
+        {'postgresql_partition_by': 'RANGE (id)'},
+    )
+
+
+# a partitioned table takes no rows until it has partitions; the default
+# one keeps inserts working (e.g. in tests) until partitions.py makes
+# the monthly ones
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+    .execute_if(dialect='postgresql'))
+
+
+class MessageTag(db.Model):
+    """Inverted index of #tags and @mentions to the messages using them.
+
+    Tags are stored with their sigil ("#python", "@alice"), lowercased.
+    The primary key doubles as the index for tag feeds: one tag's messages
+    are a contiguous, id-ordered range.
+    """
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class Notification(db.Model):
+    """Aggregated activity for one user: follows, likes or mentions.
+
+    Events of the same kind about the same subject are folded into one
+    unread row ("12 people liked your warble"): `count` distinct actors,
+    the newest few of them first in `actor_ids`. The partial unique index is
+    what the batcher upserts against; once read, a row is left alone and
+    the next event starts a new one.
+    """
+
+    __tablename__ = 'notifications'
+
+    # time-ordered like message ids; bumped when more events are folded
+    # in, so the newest activity pages first
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+        default=generate_id,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # the liked/mentioning message; 0 for follows, which all aggregate
+    subject_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+    )
+
+    actor_ids = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    __table_args__ = (
+        db.Index('notifications_unread_key', 'user_id', 'kind', 'subject_id',
+                 unique=True, postgresql_where=db.text('NOT read')),
+        db.Index('notifications_user_id_id', 'user_id', 'id'),
+    )
+
+
+class UserStats(db.Model):
+    """A user's posting activity, as of the last analytics run.
+
+    Written in bulk by analytics.py; see there for what each array holds.
+    """
+
+    __tablename__ = 'user_stats'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    hourly = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+    )
+
+    weekly = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+    )
+
+    followers = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+    )
+
+    messages = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    likes_received = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    @property
+    def like_rate(self):
+        """Likes received per message."""
+
+        return self.likes_received / self.messages if self.messages else 0.0
+
+    @property
+    def follower_growth(self):
+        """Followers gained (or lost) over the weeks covered."""
+
+        return self.followers[-1] - self.followers[0]
+
+
+class PurgeJob(db.Model):
+    """A queued purge of one user's messages, or whole account.
+
+    Worked through in chunks by purge.py; `deleted` counts the rows
+    removed so far. Not a foreign key: the user row goes before the job
+    is finished with.
+    """
+
+    __tablename__ = 'purge_jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # purge.ACCOUNT or purge.MESSAGES
+    scope = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # the admin who asked for it; NULL: the user deleting their account
+    requested_by = db.Column(
+        db.Integer,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.text("(now() at time zone 'utc')"),
+    )
+
+    # also bumped after every chunk, so a job whose worker died is seen
+    # to have stalled and is taken up again
+    started_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    __table_args__ = (
+        db.Index('purge_jobs_pending', 'id',
+                 postgresql_where=db.text('finished_at IS NULL')),
+    )
+
+
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _refuse_inherited(dbapi_connection, connection_record, connection_proxy):
+    """Don't hand out a connection opened by another process.
+
+    A forked worker shares its parent's sockets; using one mixes two
+    processes' traffic on one session. The pool drops it and connects
+    afresh. It isn't closed: that would end the parent's session too.
+    """
+
+    if connection_record.info.get('pid', os.getpid()) != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "connection belongs to another process; reconnecting")
+
+
+event.listen(Pool, 'connect', _remember_pid)
+event.listen(Pool, 'checkout', _refuse_inherited)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
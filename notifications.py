@@ -0,0 +1,253 @@
+"""Notifications for follows, likes and mentions, delivered in batches.
+
+Routes call `notifier.notify(...)`, which only updates this worker's
+memory. Every NOTIFICATIONS_INTERVAL seconds a background thread writes
+everything gathered since as one multi-row upsert: events for the same
+(user, kind, subject) are folded together first, and then into the
+user's matching unread row, if any. After that, one UPDATE refreshes
+the cached `users.unread_notifications` of everyone affected.
+
+With NOTIFICATIONS_INTERVAL set to 0, each event is written straight
+away (useful in tests).
+
+Durability matches write_behind.py: a crashed worker loses at most one
+interval's worth of notifications; pending ones are flushed at exit.
+"""
+
+import atexit
+import os
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import and_, func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from ids import generate_id
+from models import db, Notification, User
+from tags import extract_tags
+
+FOLLOW = 'follow'
+LIKE = 'like'
+MENTION = 'mention'
+
+# actors named per notification, newest first: "alice, bob and 10 others"
+MAX_ACTORS = 3
+
+# an unread row keeps only its newest MAX_ACTORS actors, so it stays the
+# same size however many people like a warble: newer ones go first, each
+# once. An actor already in that short list isn't counted again; one
+# who dropped off it is (rare, and only ever overcounts)
+MERGE_ACTORS = f"""
+    (ARRAY(SELECT actor
+           FROM unnest(excluded.actor_ids || notifications.actor_ids)
+                WITH ORDINALITY AS merged(actor, n)
+           GROUP BY actor
+           ORDER BY min(n)))[1:{MAX_ACTORS}]
+"""
+
+COUNT_ACTORS = """
+    notifications.count + excluded.count
+    - cardinality(ARRAY(SELECT unnest(excluded.actor_ids)
+                        INTERSECT
+                        SELECT unnest(notifications.actor_ids)))
+"""
+
+
+class NotificationBatcher:
+    """Per-worker buffer of notification events."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 1.0
+        self._lock = threading.Lock()
+        # (user_id, kind, subject_id) -> [distinct actors, [ids, newest last]]
+        self._pending = {}
+        self._flusher_pid = None
+        self.stats = Counter()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('NOTIFICATIONS_INTERVAL', 1.0)
+
+        self.app = app
+        self.interval = app.config['NOTIFICATIONS_INTERVAL']
+
+        atexit.register(self.flush)
+
+    def _start_flusher(self):
+        """Start this process's flush thread (threads don't survive fork)."""
+
+        if self._flusher_pid == os.getpid():
+            return
+
+        self._flusher_pid = os.getpid()
+        thread = threading.Thread(target=self._run_flusher,
+                                  name='notifications', daemon=True)
+        thread.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("notification flush failed")
+
+    def notify(self, kind, user_id, actor_id, subject_id=0):
+        """Tell `user_id` that `actor_id` did `kind` (to `subject_id`)."""
+
+        if user_id == actor_id:
+            return
+
+        with self._lock:
+            self.stats['events'] += 1
+            entry = self._pending.setdefault((user_id, kind, subject_id),
+                                             [0, []])
+            if actor_id in entry[1]:
+                # e.g. like, unlike, like again: one person, moved to newest
+                entry[1].remove(actor_id)
+            else:
+                entry[0] += 1
+            entry[1].append(actor_id)
+
+            if self.interval:
+                self._start_flusher()
+
+        if not self.interval:
+            self.flush()
+
+    def notify_mentions(self, message):
+        """Notify the users @mentioned in `message`."""
+
+        names = [tag[1:] for tag in extract_tags(message.text)
+                 if tag.startswith('@')]
+        if not names:
+            return
+
+        # mentions are lowercased; usernames are unique ignoring case,
+        # and this is the expression their unique index is on
+        mentioned = (db.session
+                     .query(User.id)
+                     .filter(func.lower(User.username).in_(names)))
+
+        for (user_id,) in mentioned:
+            self.notify(MENTION, user_id, message.user_id, message.id)
+
+    def flush(self):
+        """Write out every pending notification."""
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if pending:
+            self._write(pending)
+
+    def _write(self, pending):
+        table = Notification.__table__
+        users = User.__table__
+
+        rows = [{'id': generate_id(),
+                 'user_id': user_id,
+                 'kind': kind,
+                 'subject_id': subject_id,
+                 'count': count,
+                 'actor_ids': actors[::-1][:MAX_ACTORS],
+                 'read': False}
+                for (user_id, kind, subject_id), (count, actors)
+                in pending.items()]
+
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'kind', 'subject_id'],
+            index_where=text('NOT read'),
+            set_={
+                'id': stmt.excluded.id,
+                # people, so like, unlike, like again counts once
+                'count': text(COUNT_ACTORS),
+                'actor_ids': text(MERGE_ACTORS),
+            })
+
+        unread = (select([func.count()])
+                  .where(and_(table.c.user_id == users.c.id,
+                              ~table.c.read))
+                  .as_scalar())
+        recipients = {user_id for user_id, kind, subject_id in pending}
+
+        try:
+            with self.app.app_context(), db.engine.begin() as conn:
+                conn.execute(stmt)
+                conn.execute(users.update()
+                             .where(users.c.id.in_(recipients))
+                             .values(unread_notifications=unread))
+        except Exception:
+            self._requeue(pending)
+            raise
+
+        with self._lock:
+            self.stats['flushes'] += 1
+            self.stats['rows_written'] += len(rows)
+
+    def _requeue(self, pending):
+        """Merge unwritten events back in with any gathered since."""
+
+        with self._lock:
+            for key, (count, actors) in pending.items():
+                entry = self._pending.setdefault(key, [0, []])
+                newer = entry[1]
+                entry[1] = [a for a in actors if a not in newer] + newer
+                entry[0] = len(entry[1])
+
+    def metrics(self):
+        """Counters for the metrics endpoint."""
+
+        with self._lock:
+            stats = dict(self.stats)
+            pending = len(self._pending)
+
+        return {
+            'pending': pending,
+            'events': stats.get('events', 0),
+            'rows_written': stats.get('rows_written', 0),
+            'flushes': stats.get('flushes', 0),
+        }
+
+
+def mark_read(user):
+    """Mark all of `user`'s notifications read and zero their count."""
+
+    (Notification
+     .query
+     .filter(Notification.user_id == user.id, ~Notification.read)
+     .update({'read': True}, synchronize_session=False))
+    user.unread_notifications = 0
+
+
+def summary(notification, usernames):
+    """Sentence describing `notification`, given {user id: username}."""
+
+    names = [f"@{usernames[actor_id]}"
+             for actor_id in notification.actor_ids[:MAX_ACTORS]
+             if actor_id in usernames]
+    others = notification.count - len(names)
+
+    if not names:
+        who = ("Someone" if notification.count == 1
+               else f"{notification.count} people")
+    elif others > 0:
+        who = ", ".join(names) + f" and {others} other{'s' if others > 1 else ''}"
+    elif len(names) > 1:
+        who = ", ".join(names[:-1]) + f" and {names[-1]}"
+    else:
+        who = names[0]
+
+    if notification.kind == FOLLOW:
+        return f"{who} followed you"
+    if notification.kind == LIKE:
+        return f"{who} liked your warble"
+    return f"{who} mentioned you"
+
+
+notifier = NotificationBatcher()
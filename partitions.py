@@ -0,0 +1,224 @@
+"""Monthly partitions of the messages table.
+
+`messages` is partitioned by RANGE (id). Ids are time-ordered (ids.py),
+so the range of ids minted in a month is fixed in advance:
+
+    messages_y2026m10   FOR VALUES FROM (<first id of Oct 2026>)
+                                     TO (<first id of Nov 2026>)
+
+plus messages_default, which only catches rows no monthly partition
+covers and should stay empty. Needs PostgreSQL 12 or later (foreign
+keys from likes and message_tags point at the partitioned table).
+
+Run `ensure` daily (cron) so next months' partitions exist before
+they're needed:
+
+    python partitions.py ensure [--ahead 3]
+    python partitions.py list
+    python partitions.py detach --before 2024-01 [--drop]
+
+Detaching stops queries on `messages` seeing those months. Postgres
+refuses while likes or tags still point at messages in them; archive
+or delete those first.
+
+Postgres also refuses to create a month while the default partition
+holds rows in its range, so `ensure` moves those rows over: with the
+foreign keys to messages dropped, it detaches the default partition,
+creates the month, moves the rows in and re-attaches the default.
+"""
+
+import argparse
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+
+from ids import id_from_datetime
+
+PARENT = 'messages'
+DEFAULT_PARTITION = 'messages_default'
+
+NAME_RE = re.compile(r"^messages_y(\d{4})m(\d{2})$")
+
+# foreign keys to messages; Postgres won't detach a partition they point into
+DROP_FOREIGN_KEYS = [
+    "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey",
+    """ALTER TABLE message_tags
+       DROP CONSTRAINT IF EXISTS message_tags_message_id_fkey""",
+]
+
+ADD_FOREIGN_KEYS = [
+    """ALTER TABLE likes ADD CONSTRAINT likes_message_id_fkey
+       FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE""",
+    """ALTER TABLE message_tags ADD CONSTRAINT message_tags_message_id_fkey
+       FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE""",
+]
+
+
+def add_months(year, month, months):
+    """(year, month) `months` after the given one (or before, if negative)."""
+
+    index = year * 12 + (month - 1) + months
+    return index // 12, index % 12 + 1
+
+
+def month_bounds(year, month):
+    """Id range [low, high) of messages created in that month."""
+
+    next_year, next_month = add_months(year, month, 1)
+    return (id_from_datetime(datetime(year, month, 1)),
+            id_from_datetime(datetime(next_year, next_month, 1)))
+
+
+def partition_name(year, month):
+    return f"{PARENT}_y{year:04d}m{month:02d}"
+
+
+def create_partition(conn, year, month):
+    """Create the partition for one month, unless it exists already."""
+
+    low, high = month_bounds(year, month)
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(year, month)} "
+        f"PARTITION OF {PARENT} FOR VALUES FROM ({low}) TO ({high})"))
+
+
+def move_from_default(conn, year, month):
+    """Create one month's partition, taking its rows out of the default one.
+
+    Returns the number of rows moved.
+    """
+
+    low, high = month_bounds(year, month)
+    bounds = {'low': low, 'high': high}
+    in_range = f"FROM {DEFAULT_PARTITION} WHERE id >= :low AND id < :high"
+
+    if conn.execute(text(f"SELECT 1 {in_range} LIMIT 1"), bounds).first() is None:
+        create_partition(conn, year, month)
+        return 0
+
+    for statement in DROP_FOREIGN_KEYS:
+        conn.execute(text(statement))
+    conn.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {DEFAULT_PARTITION}"))
+
+    create_partition(conn, year, month)
+    moved = conn.execute(text(
+        f"INSERT INTO {partition_name(year, month)} SELECT * {in_range}"),
+        bounds).rowcount
+    conn.execute(text(f"DELETE {in_range}"), bounds)
+
+    conn.execute(text(
+        f"ALTER TABLE {PARENT} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    for statement in ADD_FOREIGN_KEYS:
+        conn.execute(text(statement))
+
+    return moved
+
+
+def monthly_partitions(conn):
+    """[(year, month, name)] of attached monthly partitions, oldest first."""
+
+    names = conn.execute(text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :parent
+    """), {'parent': PARENT}).fetchall()
+
+    months = []
+    for (name,) in names:
+        match = NAME_RE.match(name)
+        if match:
+            months.append((int(match.group(1)), int(match.group(2)), name))
+
+    return sorted(months)
+
+
+def ensure(conn, ahead=3, now=None, months=()):
+    """Create partitions from this month to `ahead` months from now.
+
+    `months` are more (year, month)s to cover, e.g. of data about to be
+    loaded. Rows of a new month already in the default partition are
+    moved into it. Returns the names of the partitions created.
+    """
+
+    now = now or datetime.utcnow()
+    existing = {name for year, month, name in monthly_partitions(conn)}
+    wanted = {add_months(now.year, now.month, offset)
+              for offset in range(ahead + 1)}
+    created = []
+
+    for year, month in sorted(wanted.union(months)):
+        if partition_name(year, month) not in existing:
+            move_from_default(conn, year, month)
+            created.append(partition_name(year, month))
+
+    return created
+
+
+def detach(conn, before, drop=False):
+    """Detach (and optionally drop) monthly partitions older than `before`.
+
+    `before` is a (year, month); partitions of earlier months go.
+    Returns their names.
+    """
+
+    detached = []
+
+    for year, month, name in monthly_partitions(conn):
+        if (year, month) >= before:
+            break
+        conn.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {name}"))
+        if drop:
+            conn.execute(text(f"DROP TABLE {name}"))
+        detached.append(name)
+
+    return detached
+
+
+def default_rows(conn):
+    """Rows sitting in the default partition (should be 0)."""
+
+    return conn.execute(text(
+        f"SELECT count(*) FROM {DEFAULT_PARTITION}")).scalar()
+
+
+def _month(value):
+    year, month = value.split('-')
+    return int(year), int(month)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Manage monthly partitions of the messages table.")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    ensure_parser = commands.add_parser('ensure')
+    ensure_parser.add_argument('--ahead', type=int, default=3)
+
+    commands.add_parser('list')
+
+    detach_parser = commands.add_parser('detach')
+    detach_parser.add_argument('--before', type=_month, required=True,
+                               help="YYYY-MM; earlier months are detached")
+    detach_parser.add_argument('--drop', action='store_true')
+
+    args = parser.parse_args()
+
+    from app import create_app
+    from models import db
+
+    with create_app().app_context(), db.engine.begin() as conn:
+        if args.command == 'ensure':
+            for name in ensure(conn, ahead=args.ahead):
+                print(f"created {name}")
+        elif args.command == 'list':
+            for year, month, name in monthly_partitions(conn):
+                low, high = month_bounds(year, month)
+                print(f"{name}  [{low}, {high})")
+            print(f"{DEFAULT_PARTITION}: {default_rows(conn)} rows")
+        else:
+            for name in detach(conn, args.before, drop=args.drop):
+                print(f"{'dropped' if args.drop else 'detached'} {name}")
@@ -0,0 +1,221 @@
+"""On-demand sampling profiler for Warbler requests.
+
+A request is profiled when it is picked at random (PROFILE_SAMPLE_RATE,
+0 to 1, default 0) or when it carries PROFILE_HEADER with the value of
+PROFILE_TOKEN. For a profiled request a sampler thread snapshots the
+request thread's stack every PROFILE_INTERVAL seconds until the response
+has been sent (including streamed bodies).
+
+Each sample is attributed to Python frames ("app.py:homepage"). Frames
+from templates are shown as "[template] home.html", and while a query is
+running the sample ends in "[sql] SELECT ... FROM messages". Results are
+written to PROFILE_DIR in collapsed-stack format, one line per distinct
+stack with its sample count, ready for flamegraph.pl or speedscope.
+
+Requests that aren't profiled pay for one random number and a couple of
+dict lookups per query, so it can stay enabled in production.
+"""
+
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import request, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def sql_label(statement, width=80):
+    """Short one-line label for a SQL statement."""
+
+    return "[sql] " + WHITESPACE_RE.sub(" ", statement).strip()[:width]
+
+
+def frame_label(frame):
+    """Collapsed-stack label for one frame."""
+
+    code = frame.f_code
+    filename = code.co_filename
+
+    # compiled Jinja templates keep their template's path as file name
+    if filename.endswith(('.html', '.txt')):
+        return f"[template] {os.path.basename(filename)}"
+
+    return f"{os.path.basename(filename)}:{code.co_name}"
+
+
+class Profile:
+    """Samples collected for one request."""
+
+    def __init__(self, thread_id, endpoint, interval, sql_running):
+        self.thread_id = thread_id
+        self.endpoint = endpoint
+        self.interval = interval
+        self.samples = Counter()
+        self._sql_running = sql_running
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler',
+                                        daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling; False if it had already been stopped."""
+
+        if self._stopped.is_set():
+            return False
+
+        self._stopped.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.reverse()
+
+            # one label for consecutive frames of the same template
+            collapsed = [label for i, label in enumerate(stack)
+                         if i == 0 or label != stack[i - 1]]
+
+            statement = self._sql_running.get(self.thread_id)
+            if statement is not None:
+                collapsed.append(sql_label(statement))
+
+            self.samples[";".join(collapsed)] += 1
+
+    def folded(self):
+        """The profile in collapsed-stack format."""
+
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in self.samples.most_common())
+
+
+class SamplingProfiler:
+    """Flask extension profiling a fraction of requests."""
+
+    def __init__(self, app=None):
+        self.app = None
+        # thread id -> statement being executed, for profiled threads only
+        self._sql_running = {}
+        self._profiled_threads = set()
+        self._slots = None
+        self._listening = False
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_HEADER', 'X-Warbler-Profile')
+        app.config.setdefault('PROFILE_TOKEN', None)
+        app.config.setdefault('PROFILE_INTERVAL', 0.005)
+        app.config.setdefault('PROFILE_DIR', 'profiles')
+        app.config.setdefault('PROFILE_MAX_CONCURRENT', 4)
+
+        self.app = app
+        self._slots = threading.BoundedSemaphore(
+            app.config['PROFILE_MAX_CONCURRENT'])
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute', self._before_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_execute)
+            self._listening = True
+
+    def _wanted(self, config):
+        token = config['PROFILE_TOKEN']
+        if token:
+            given = request.headers.get(config['PROFILE_HEADER'], '')
+            # bytes: compare_digest refuses non-ASCII str
+            if hmac.compare_digest(given.encode(), token.encode()):
+                return True
+
+        rate = config['PROFILE_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def _before_request(self):
+        config = self.app.config
+        if not self._wanted(config):
+            return
+
+        # don't let a burst of profiled requests pile up sampler threads
+        if not self._slots.acquire(blocking=False):
+            return
+
+        thread_id = threading.get_ident()
+        self._profiled_threads.add(thread_id)
+        g._profile = Profile(thread_id, request.endpoint,
+                             config['PROFILE_INTERVAL'], self._sql_running)
+        g._profile.start()
+
+    def _after_request(self, response):
+        # keep sampling until a streamed body has been sent, too
+        profile = g.pop('_profile', None)
+        if profile is not None:
+            response.call_on_close(lambda: self._finish(profile))
+        return response
+
+    def _teardown_request(self, exc):
+        # the request failed before producing a response
+        profile = g.pop('_profile', None)
+        if profile is not None:
+            self._finish(profile)
+
+    def _finish(self, profile):
+        if not profile.stop():
+            return
+
+        self._profiled_threads.discard(profile.thread_id)
+        self._sql_running.pop(profile.thread_id, None)
+        self._slots.release()
+
+        try:
+            self._write(profile)
+        except OSError:
+            self.app.logger.exception("could not write profile")
+
+    def _write(self, profile):
+        directory = self.app.config['PROFILE_DIR']
+        os.makedirs(directory, exist_ok=True)
+
+        endpoint = (profile.endpoint or 'unknown').replace('.', '-')
+        name = (f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-"
+                f"{profile.elapsed * 1000:.0f}ms-{os.getpid()}.folded")
+
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(profile.folded())
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        thread_id = threading.get_ident()
+        if thread_id in self._profiled_threads:
+            self._sql_running[thread_id] = statement
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        if self._sql_running:
+            self._sql_running.pop(threading.get_ident(), None)
+
+
+profiler = SamplingProfiler()
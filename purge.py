@@ -0,0 +1,345 @@
+"""Purging deleted accounts, and moderators' bulk removals, in chunks.
+
+Deleting an account only tombstones it (users.deleted_at): from then on
+it can't log in and it, its messages and its follows are hidden
+everywhere. What it leaves behind is queued as a PurgeJob and removed in
+the background, PURGE_CHUNK rows per transaction with PURGE_PAUSE
+seconds in between, so no request waits on (and no lock is held for)
+the whole cascade of a prolific account:
+
+    account     likes, messages (hot and archived), follows both ways,
+                notifications, then the user row itself
+    messages    just their messages, hot and archived (moderation)
+
+Jobs are claimed with FOR UPDATE SKIP LOCKED, so any number of workers
+can drain the queue. Every web worker polls it (see Purger), from its
+first request on. A job's started_at is bumped after every chunk; one
+that hasn't moved in PURGE_STALE seconds (its worker died) is claimed
+again, and carries on where it stopped, since every step just deletes
+whatever is still there.
+
+    python purge.py         drain the queue from the command line
+"""
+
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+import archive
+from models import db, PurgeJob
+
+ACCOUNT = 'account'
+MESSAGES = 'messages'
+
+SCOPES = (ACCOUNT, MESSAGES)
+
+PURGE_CHUNK = 500
+
+# seconds between chunks, to leave the database room for everyone else
+PURGE_PAUSE = 0.05
+
+# seconds without progress before a claimed job is taken up again
+PURGE_STALE = 300
+
+CLAIM = """
+    UPDATE purge_jobs SET started_at = :now
+    WHERE id = (
+        SELECT id FROM purge_jobs
+        WHERE finished_at IS NULL
+          AND (started_at IS NULL OR started_at < :stale)
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED)
+    RETURNING id, user_id, scope
+"""
+
+PROGRESS = """
+    UPDATE purge_jobs SET deleted = deleted + :deleted, started_at = :now
+    WHERE id = :job_id
+"""
+
+FINISH = "UPDATE purge_jobs SET finished_at = :now WHERE id = :job_id"
+
+# one chunk each; likes and tags on deleted messages go with them (cascade)
+DELETE_LIKES = """
+    DELETE FROM likes
+    WHERE (user_id, message_id) IN (
+        SELECT user_id, message_id FROM likes
+        WHERE user_id = :user_id LIMIT :chunk)
+"""
+
+DELETE_MESSAGES = """
+    DELETE FROM messages WHERE id IN (
+        SELECT id FROM messages WHERE user_id = :user_id LIMIT :chunk)
+"""
+
+DELETE_FOLLOWING = """
+    DELETE FROM follows
+    WHERE (user_following_id, user_being_followed_id) IN (
+        SELECT user_following_id, user_being_followed_id FROM follows
+        WHERE user_following_id = :user_id LIMIT :chunk)
+"""
+
+DELETE_FOLLOWERS = """
+    DELETE FROM follows
+    WHERE (user_following_id, user_being_followed_id) IN (
+        SELECT user_following_id, user_being_followed_id FROM follows
+        WHERE user_being_followed_id = :user_id LIMIT :chunk)
+"""
+
+DELETE_NOTIFICATIONS = """
+    DELETE FROM notifications WHERE id IN (
+        SELECT id FROM notifications WHERE user_id = :user_id LIMIT :chunk)
+"""
+
+# last, once it has nothing left to cascade to but its stats row; a
+# tombstone only, so a moderator can't take out a live account this way
+DELETE_USER = """
+    DELETE FROM users WHERE id = :user_id AND deleted_at IS NOT NULL
+"""
+
+# stands for the user's archived messages (archive.Archive.remove_users)
+ARCHIVED = 'archived'
+
+STEPS = {
+    ACCOUNT: [DELETE_LIKES, DELETE_MESSAGES, ARCHIVED, DELETE_FOLLOWING,
+              DELETE_FOLLOWERS, DELETE_NOTIFICATIONS, DELETE_USER],
+    MESSAGES: [DELETE_MESSAGES, ARCHIVED],
+}
+
+
+def claim(engine, stale=PURGE_STALE, now=None):
+    """Claim the oldest job no one is working on: (id, user_id, scope),
+    or None if there isn't one."""
+
+    now = now or datetime.utcnow()
+    with engine.begin() as conn:
+        return conn.execute(text(CLAIM), {
+            'now': now, 'stale': now - timedelta(seconds=stale)}).first()
+
+
+def _progress(conn, job_id, deleted):
+    conn.execute(text(PROGRESS), {'job_id': job_id, 'deleted': deleted,
+                                  'now': datetime.utcnow()})
+
+
+def delete_chunks(engine, job_id, statement, user_id, chunk=PURGE_CHUNK,
+                  pause=PURGE_PAUSE):
+    """Run `statement` one chunk per transaction until it runs out of
+    rows; returns how many it deleted."""
+
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text(statement),
+                                {'user_id': user_id, 'chunk': chunk}).rowcount
+            _progress(conn, job_id, rows)
+        deleted += rows
+
+        if rows < chunk:
+            return deleted
+        time.sleep(pause)
+
+
+def run_job(engine, cold, job_id, user_id, scope, chunk=PURGE_CHUNK,
+            pause=PURGE_PAUSE):
+    """Purge what `scope` covers of `user_id`, then mark the job finished.
+
+    Returns how many rows (and archived messages) were deleted.
+    """
+
+    deleted = 0
+    for step in STEPS[scope]:
+        if step is ARCHIVED:
+            removed = cold.remove_users([user_id])
+            with engine.begin() as conn:
+                _progress(conn, job_id, removed)
+            deleted += removed
+        else:
+            deleted += delete_chunks(engine, job_id, step, user_id,
+                                     chunk=chunk, pause=pause)
+
+    with engine.begin() as conn:
+        conn.execute(text(FINISH), {'job_id': job_id,
+                                    'now': datetime.utcnow()})
+
+    return deleted
+
+
+def run_pending(engine, cold, chunk=PURGE_CHUNK, pause=PURGE_PAUSE,
+                stale=PURGE_STALE):
+    """Claim and run jobs until there are none left; returns
+    {job id: rows deleted}."""
+
+    done = {}
+    while True:
+        job = claim(engine, stale=stale)
+        if job is None:
+            return done
+        job_id, user_id, scope = job
+        done[job_id] = run_job(engine, cold, job_id, user_id, scope,
+                               chunk=chunk, pause=pause)
+
+
+class Purger:
+    """Queues purge jobs, and runs them on a background thread.
+
+    The thread starts with the first request a process handles, so
+    jobs a dead or recycled worker left behind are taken up again
+    without waiting for the next deletion. With PURGE_ASYNC off (tests),
+    `kick()` runs the queue right away, in the request.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.asynchronous = True
+        self.chunk = PURGE_CHUNK
+        self.pause = PURGE_PAUSE
+        self.poll = 60.0
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._worker_pid = None
+        self.stats = Counter()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURGE_ASYNC', True)
+        app.config.setdefault('PURGE_CHUNK', PURGE_CHUNK)
+        app.config.setdefault('PURGE_PAUSE', PURGE_PAUSE)
+        app.config.setdefault('PURGE_POLL', 60.0)
+
+        if self.app is not app:
+            app.before_request(self._start_polling)
+
+        self.app = app
+        self.asynchronous = app.config['PURGE_ASYNC']
+        self.chunk = app.config['PURGE_CHUNK']
+        self.pause = app.config['PURGE_PAUSE']
+        self.poll = app.config['PURGE_POLL']
+
+    def enqueue(self, user_ids, scope, requested_by=None):
+        """Queue a job per user, in one INSERT; returns their
+        (job id, user id)s.
+
+        Runs in the session's transaction: the caller commits (with the
+        tombstone, for account deletions), then calls `kick()`.
+        """
+
+        if scope not in SCOPES:
+            raise ValueError(f"unknown purge scope {scope!r}")
+
+        jobs = PurgeJob.__table__
+        return [tuple(row) for row in db.session.execute(
+            jobs.insert()
+            .values([{'user_id': user_id, 'scope': scope,
+                      'requested_by': requested_by} for user_id in user_ids])
+            .returning(jobs.c.id, jobs.c.user_id))]
+
+    def kick(self):
+        """Have the queue worked through, now the jobs are committed."""
+
+        if not self.asynchronous:
+            self.drain()
+            return
+
+        self._start_worker()
+        self._wake.set()
+
+    def _start_polling(self):
+        if self.asynchronous:
+            self._start_worker()
+
+    def _start_worker(self):
+        """Start this process's purge thread (threads don't survive fork)."""
+
+        if self._worker_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+
+        thread = threading.Thread(target=self._run_worker, name='purge',
+                                  daemon=True)
+        thread.start()
+
+    def _run_worker(self):
+        # whatever is queued already, then again when kicked, or every
+        # `poll` seconds, for jobs some dead worker left
+        while True:
+            try:
+                self.drain()
+            except Exception:
+                self.app.logger.exception("purge failed")
+                with self._lock:
+                    self.stats['failures'] += 1
+
+            self._wake.wait(self.poll)
+            self._wake.clear()
+
+    def drain(self):
+        """Run queued jobs until there are none left."""
+
+        start = time.perf_counter()
+
+        with self.app.app_context():
+            done = run_pending(db.engine,
+                               archive.store(self.app.config['ARCHIVE_DIR']),
+                               chunk=self.chunk, pause=self.pause)
+
+        with self._lock:
+            self.stats['jobs'] += len(done)
+            self.stats['rows_deleted'] += sum(done.values())
+            self.stats['purge_seconds'] += time.perf_counter() - start
+
+        return done
+
+    def metrics(self):
+        """Counters for the metrics endpoint."""
+
+        with self._lock:
+            stats = dict(self.stats)
+
+        return {
+            'asynchronous': self.asynchronous,
+            'jobs': stats.get('jobs', 0),
+            'rows_deleted': stats.get('rows_deleted', 0),
+            'failures': stats.get('failures', 0),
+            'purge_seconds': stats.get('purge_seconds', 0.0),
+        }
+
+
+def job_status(job):
+    """What the admin endpoints report of a PurgeJob."""
+
+    if job.finished_at is not None:
+        state = 'finished'
+    elif job.started_at is not None:
+        state = 'running'
+    else:
+        state = 'queued'
+
+    return {'id': job.id, 'user_id': job.user_id, 'scope': job.scope,
+            'state': state, 'deleted': job.deleted}
+
+
+purger = Purger()
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    app = create_app()
+    with app.app_context():
+        done = run_pending(db.engine, archive.store(app.config['ARCHIVE_DIR']),
+                           chunk=app.config['PURGE_CHUNK'],
+                           pause=app.config['PURGE_PAUSE'])
+        for job_id, deleted in done.items():
+            print(f"job {job_id}: {deleted} rows deleted")
@@ -0,0 +1,207 @@
+"""Query budgets and N+1 detection.
+
+Routes declare how many queries a request may run:
+
+    @bp.route('/users')
+    @query_budget(3)
+    def list_users():
+        ...
+
+`record_queries()` records the statements run by the current thread and
+groups them by shape (the statement with literals, parameters and IN lists
+normalised away). A shape repeated N_PLUS_ONE_THRESHOLD times or more in
+one request is reported as an N+1.
+
+Tests wrap a request in `record_queries()` and assert there are no
+`violations()`. With the QueryBudget extension installed,
+QUERY_BUDGET_MODE does the same check for every request: "log" (staging)
+logs violations, "enforce" fails the request with QueryBudgetExceeded,
+and "off" (the default) records nothing. Queries a streamed body runs
+after the view returns are only ever logged.
+
+Every route declares a budget; those that run no queries of their own
+still load the logged-in user.
+"""
+
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+N_PLUS_ONE_THRESHOLD = 5
+
+PARAM = r"(?:%\(\w+\)s|%s|\?|:\w+|\$\d+)"
+IN_LIST_RE = re.compile(r"\bIN \(\s*" + PARAM + r"(?:\s*,\s*" + PARAM + r")*\s*\)",
+                        re.IGNORECASE)
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r"\b\d+\b")
+PARAM_RE = re.compile(PARAM)
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(Exception):
+    """A request broke its query budget or ran an N+1."""
+
+
+def query_budget(limit):
+    """Declare that a view may run at most `limit` queries per request."""
+
+    def decorator(view):
+        view.query_budget = limit
+        return view
+
+    return decorator
+
+
+def budget_for(app, endpoint):
+    """The query budget declared by `endpoint`'s view, or None."""
+
+    view = app.view_functions.get(endpoint)
+    return getattr(view, 'query_budget', None)
+
+
+def shape(statement):
+    """`statement` with everything that varies between calls removed."""
+
+    statement = STRING_RE.sub("?", statement)
+    statement = IN_LIST_RE.sub("IN (...)", statement)
+    statement = PARAM_RE.sub("?", statement)
+    statement = NUMBER_RE.sub("?", statement)
+    return WHITESPACE_RE.sub(" ", statement).strip()
+
+
+class QueryLog(list):
+    """Statements run during a recording, in order."""
+
+    def shapes(self):
+        return Counter(shape(statement) for statement in self)
+
+    def n_plus_one(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """Shapes run `threshold` or more times, with their counts."""
+
+        return [(statement_shape, count)
+                for statement_shape, count in self.shapes().most_common()
+                if count >= threshold]
+
+    def violations(self, budget=None, threshold=N_PLUS_ONE_THRESHOLD):
+        """Human-readable problems: over budget, or repeated shapes."""
+
+        problems = []
+
+        if budget is not None and len(self) > budget:
+            problems.append(f"{len(self)} queries, budget is {budget}")
+
+        for statement_shape, count in self.n_plus_one(threshold):
+            problems.append(f"N+1: {count} x {statement_shape[:200]}")
+
+        return problems
+
+
+# thread id -> logs being recorded on that thread (recordings can nest)
+_recording = {}
+_listening = False
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    for log in _recording.get(threading.get_ident(), ()):
+        log.append(statement)
+
+
+def _listen():
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_execute)
+        _listening = True
+
+
+def start_recording():
+    """Start recording this thread's queries; returns the QueryLog."""
+
+    _listen()
+    log = QueryLog()
+    _recording.setdefault(threading.get_ident(), []).append(log)
+    return log
+
+
+def stop_recording(log):
+    thread_id = threading.get_ident()
+    # logs are lists, so compare by identity rather than contents
+    logs = [other for other in _recording.get(thread_id, ()) if other is not log]
+    if logs:
+        _recording[thread_id] = logs
+    else:
+        _recording.pop(thread_id, None)
+
+
+@contextmanager
+def record_queries():
+    """Record the queries this thread runs inside the block."""
+
+    log = start_recording()
+    try:
+        yield log
+    finally:
+        stop_recording(log)
+
+
+class QueryBudget:
+    """Flask extension checking every request against its budget."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_BUDGET_MODE', 'off')
+        app.config.setdefault('QUERY_N_PLUS_ONE_THRESHOLD', N_PLUS_ONE_THRESHOLD)
+
+        if app.config['QUERY_BUDGET_MODE'] == 'off':
+            return
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        g._queries = start_recording()
+
+    def _after_request(self, response):
+        log = g.pop('_queries', None)
+        if log is None:
+            return response
+
+        app = current_app._get_current_object()
+        endpoint = request.endpoint
+        budget = budget_for(app, endpoint)
+        threshold = app.config['QUERY_N_PLUS_ONE_THRESHOLD']
+
+        def problems():
+            return log.violations(budget, threshold)
+
+        # enforcing has to happen before the response goes out, so it
+        # covers what the view ran; a streamed body's queries come later,
+        # and can only be logged
+        if app.config['QUERY_BUDGET_MODE'] == 'enforce':
+            found = problems()
+            if found:
+                stop_recording(log)
+                raise QueryBudgetExceeded(f"{endpoint}: " + "; ".join(found))
+
+        def check():
+            stop_recording(log)
+            found = problems()
+            if found:
+                app.logger.warning("query budget: %s: %s", endpoint,
+                                   "; ".join(found))
+
+        if response.is_streamed:
+            response.call_on_close(check)
+        else:
+            check()
+        return response
+
+
+query_budget_guard = QueryBudget()
@@ -0,0 +1,142 @@
+"""Ranked home feed: followed users' recent messages, best first.
+
+The chronological feed is newest first. The ranked one takes the newest
+RANK_CANDIDATES messages from the last RANK_WINDOW and scores each:
+
+    recency     halves every HALF_LIFE_HOURS
+    velocity    likes per hour since it was posted, with GRAVITY_HOURS
+                added to its age so a minute-old like doesn't count
+                sixty times over
+    affinity    how many of the author's messages the viewer has liked
+                in the last AFFINITY_WINDOW
+
+    score = recency * (1 + VELOCITY_WEIGHT * velocity)
+                    * (1 + AFFINITY_WEIGHT * log(1 + affinity))
+
+A user's candidates are loaded (three queries) and cached as parallel
+arrays; each request only rescores them, all at once, with NumPy, so
+scores keep decaying between loads.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func, select
+
+from ids import id_from_datetime
+from models import db, Message, Likes
+
+RANK_WINDOW = timedelta(days=3)
+RANK_CANDIDATES = 500
+
+AFFINITY_WINDOW = timedelta(days=90)
+
+HALF_LIFE_HOURS = 6.0
+GRAVITY_HOURS = 2.0
+VELOCITY_WEIGHT = 1.0
+AFFINITY_WEIGHT = 0.5
+
+LATEST = 'latest'
+RANKED = 'ranked'
+
+FEEDS = (LATEST, RANKED)
+
+_UNIX_EPOCH = datetime(1970, 1, 1)
+
+messages = Message.__table__
+likes = Likes.__table__
+
+
+class Candidates(namedtuple('Candidates', 'cards posted likes affinity')):
+    """A viewer's candidate messages: MessageCards, and arrays of when
+    they were posted (seconds since the Unix epoch), their likes and the
+    viewer's affinity for their authors."""
+
+    __slots__ = ()
+
+
+def candidate_query(query, now=None):
+    """Narrow a message_select() to the newest RANK_CANDIDATES within
+    RANK_WINDOW."""
+
+    now = now or datetime.utcnow()
+    return (query
+            .where(messages.c.id >= id_from_datetime(now - RANK_WINDOW))
+            .order_by(messages.c.id.desc())
+            .limit(RANK_CANDIDATES))
+
+
+def like_counts(message_ids):
+    """{message id: likes} for those of `message_ids` with any."""
+
+    if not message_ids:
+        return {}
+
+    return dict(db.session.execute(
+        select([likes.c.message_id, func.count()])
+        .where(likes.c.message_id.in_(message_ids))
+        .group_by(likes.c.message_id)).fetchall())
+
+
+def author_affinity(user_id, author_ids, now=None):
+    """{author id: messages of theirs `user_id` liked in AFFINITY_WINDOW},
+    for those of `author_ids` with any."""
+
+    if not author_ids:
+        return {}
+
+    now = now or datetime.utcnow()
+    return dict(db.session.execute(
+        select([messages.c.user_id, func.count()])
+        .select_from(likes.join(messages, messages.c.id == likes.c.message_id))
+        .where(likes.c.user_id == user_id)
+        .where(likes.c.message_id >= id_from_datetime(now - AFFINITY_WINDOW))
+        .where(messages.c.user_id.in_(author_ids))
+        .group_by(messages.c.user_id)).fetchall())
+
+
+def load_candidates(user_id, cards):
+    """Candidates for `user_id` from `cards`, MessageCards of
+    candidate_query()."""
+
+    likes_of = like_counts([card.id for card in cards])
+    affinity_of = author_affinity(user_id, {card.user_id for card in cards})
+
+    return Candidates(
+        cards=tuple(cards),
+        posted=np.array([(card.timestamp - _UNIX_EPOCH).total_seconds()
+                         for card in cards], dtype=np.float64),
+        likes=np.array([likes_of.get(card.id, 0) for card in cards],
+                       dtype=np.float64),
+        affinity=np.array([affinity_of.get(card.user_id, 0)
+                           for card in cards], dtype=np.float64))
+
+
+def scores(candidates, now):
+    """Every candidate's score at `now` (seconds since the Unix epoch)."""
+
+    hours = np.maximum(now - candidates.posted, 0) / 3600
+
+    recency = np.exp2(-hours / HALF_LIFE_HOURS)
+    velocity = candidates.likes / (hours + GRAVITY_HOURS)
+    affinity = np.log1p(candidates.affinity)
+
+    return (recency
+            * (1 + VELOCITY_WEIGHT * velocity)
+            * (1 + AFFINITY_WEIGHT * affinity))
+
+
+def ranked(candidates, now=None, offset=0, limit=None):
+    """The candidates' cards, best first, from `offset`."""
+
+    if not candidates.cards:
+        return []
+
+    if now is None:
+        now = (datetime.utcnow() - _UNIX_EPOCH).total_seconds()
+
+    # stable, so ties stay newest first
+    order = np.argsort(-scores(candidates, now), kind='mergesort')
+    end = None if limit is None else offset + limit
+    return [candidates.cards[i] for i in order[offset:end]]
@@ -0,0 +1,151 @@
+"""Read models: what pages show of users and messages, as plain rows.
+
+Pages only read a handful of columns, so rather than full User and
+Message instances (instrumented attributes, the identity map, state to
+check at every flush) they get UserCard and MessageCard tuples built
+straight from Core selects of just those columns. Cards are immutable
+and tied to no session, so they can be cached and shared between
+requests as they are.
+
+Rows come off a server-side cursor ROWS_PER_FETCH at a time, and a
+page's messages share one UserCard per author. Deleted accounts, and
+their messages, are left out while they wait to be purged (purge.py).
+
+    cards = message_cards(stream(message_select().where(...)))
+
+bench_read_models.py compares this with loading ORM instances.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from models import db, User, Message, MessageTag, Follows, Likes
+
+ROWS_PER_FETCH = 100
+
+users = User.__table__
+messages = Message.__table__
+message_tags = MessageTag.__table__
+follows = Follows.__table__
+likes = Likes.__table__
+
+USER_COLUMNS = [users.c.id, users.c.username, users.c.image_url,
+                users.c.header_image_url, users.c.bio, users.c.location]
+
+MESSAGE_COLUMNS = [messages.c.id, messages.c.user_id, messages.c.timestamp,
+                   messages.c.text]
+
+
+class UserCard(namedtuple('UserCard', [c.name for c in USER_COLUMNS])):
+    """What pages show of a user."""
+
+    __slots__ = ()
+
+
+class MessageCard(namedtuple('MessageCard', 'id user_id timestamp text user')):
+    """What pages show of a message; `user` is its author's UserCard."""
+
+    __slots__ = ()
+
+
+def user_select(source=users):
+    return (select(USER_COLUMNS)
+            .select_from(source)
+            .where(users.c.deleted_at.is_(None)))
+
+
+def message_select(source=messages):
+    """Messages from `source` (messages, or a join to it) with authors."""
+
+    return (select(MESSAGE_COLUMNS + USER_COLUMNS)
+            .select_from(source.join(users, users.c.id == messages.c.user_id))
+            .where(users.c.deleted_at.is_(None)))
+
+
+def stream(query):
+    """The rows of `query`, fetched ROWS_PER_FETCH at a time."""
+
+    result = (db.session
+              .connection()
+              .execution_options(stream_results=True)
+              .execute(query))
+    try:
+        while True:
+            rows = result.fetchmany(ROWS_PER_FETCH)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        result.close()
+
+
+def user_cards(rows):
+    return (UserCard._make(row) for row in rows)
+
+
+def message_cards(rows):
+    """MessageCards from rows of message_select()."""
+
+    authors = {}
+    split = len(MESSAGE_COLUMNS)
+
+    for row in rows:
+        author = authors.get(row[1])
+        if author is None:
+            author = authors[row[1]] = UserCard._make(row[split:])
+        yield MessageCard(row[0], row[1], row[2], row[3], author)
+
+
+def archived_card(msg, author):
+    """A MessageCard for an archive.ArchivedMessage written by `author`."""
+
+    return MessageCard(msg.id, msg.user_id, msg.timestamp, msg.text, author)
+
+
+def user(user_id):
+    """The UserCard of `user_id`, or None."""
+
+    row = db.session.execute(
+        user_select().where(users.c.id == user_id)).first()
+    return UserCard._make(row) if row is not None else None
+
+
+def message(message_id):
+    """The MessageCard of hot message `message_id`, or None."""
+
+    rows = db.session.execute(
+        message_select().where(messages.c.id == message_id)).fetchall()
+    return next(message_cards(rows), None)
+
+
+def following(user_id):
+    """Select of the users `user_id` follows."""
+
+    return (user_select(users.join(
+                follows, follows.c.user_being_followed_id == users.c.id))
+            .where(follows.c.user_following_id == user_id))
+
+
+def followers(user_id):
+    """Select of the users following `user_id`."""
+
+    return (user_select(users.join(
+                follows, follows.c.user_following_id == users.c.id))
+            .where(follows.c.user_being_followed_id == user_id))
+
+
+def liked(user_id):
+    """Select of the messages `user_id` likes."""
+
+    return (message_select(messages.join(
+                likes, likes.c.message_id == messages.c.id))
+            .where(likes.c.user_id == user_id))
+
+
+def tagged(tag):
+    """Select of the messages indexed under `tag`."""
+
+    return (message_select(messages.join(
+                message_tags, message_tags.c.message_id == messages.c.id))
+            .where(message_tags.c.tag == tag))
@@ -1,18 +1,33 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from datetime import datetime
+from app import create_app
+from ids import MAX_SEQUENCE, id_from_datetime
+from models import db, User, Message, Follows
+import partitions
 
+create_app()
 
 db.drop_all()
 db.create_all()
 
+with open('generator/messages.csv') as csv:
+    messages = list(DictReader(csv))
+timestamps = [datetime.fromisoformat(row['timestamp']) for row in messages]
+
+# partitions for the seeded months, so nothing lands in messages_default
+with db.engine.begin() as conn:
+    partitions.ensure(conn, months={(ts.year, ts.month) for ts in timestamps})
+
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+# give seeded messages ids that match their (historical) timestamps
+db.session.bulk_insert_mappings(Message, [
+    dict(row, id=id_from_datetime(ts, sequence=i & MAX_SEQUENCE))
+    for i, (row, ts) in enumerate(zip(messages, timestamps))
+])
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
@@ -0,0 +1,343 @@
+"""Startup profiling and warm-up for Warbler workers.
+
+Report where startup time goes (per-module import timings, then app
+creation and warm-up):
+
+    python startup.py [--top N]
+
+`warm_up(app)` gets a worker's templates and connections ready;
+`warm_caches(app)` then prebuilds home timelines, profile counts and
+follow state for recently active users, and loads the hot indexes into
+Postgres' buffers. With WARM_UP set, `create_app` runs both in the
+background (`warm_up_state`), and /healthz/ready answers 503 until they
+finish or WARM_UP_BUDGET seconds pass. `flask warm-up` runs them in the
+foreground.
+"""
+
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from importlib.abc import MetaPathFinder
+
+from sqlalchemy import func, text
+
+
+class ImportTimer(MetaPathFinder):
+    """Meta path hook recording how long each module takes to import.
+
+    Records both the cumulative time (including the module's own imports)
+    and the self time (excluding them).
+    """
+
+    def __init__(self):
+        self.cumulative = {}
+        self.own = {}
+        self._stack = []
+        self._finding = set()
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        # ask the real finders, without recursing back into ourselves
+        if fullname in self._finding:
+            return None
+
+        self._finding.add(fullname)
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, 'find_spec'):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self._finding.discard(fullname)
+
+        loader = spec.loader
+        # builtin and frozen importers are classes shared by every module
+        # they load; only wrap per-module loader instances
+        if (loader is not None and not isinstance(loader, type)
+                and hasattr(loader, 'exec_module')):
+            exec_module = loader.exec_module
+
+            def timed_exec_module(module):
+                self._stack.append(0.0)
+                start = time.perf_counter()
+                try:
+                    exec_module(module)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    children = self._stack.pop()
+                    self.cumulative[fullname] = elapsed
+                    self.own[fullname] = elapsed - children
+                    if self._stack:
+                        self._stack[-1] += elapsed
+
+            try:
+                loader.exec_module = timed_exec_module
+            except AttributeError:
+                pass
+
+        return spec
+
+    def report(self, top=25):
+        """The slowest imports, as printable lines."""
+
+        lines = [f"{'self ms':>9} {'total ms':>9}  module"]
+        slowest = sorted(self.cumulative, key=self.cumulative.get,
+                         reverse=True)[:top]
+        for name in slowest:
+            lines.append(f"{self.own[name] * 1000:9.1f} "
+                         f"{self.cumulative[name] * 1000:9.1f}  {name}")
+        return "\n".join(lines)
+
+
+def warm_up(app, connections=None):
+    """Get `app` ready for traffic; returns timings in seconds.
+
+    Compiles every template (filling the bytecode cache if there is one),
+    imports bcrypt, and opens `connections` pooled database connections
+    (default: the pool size) so the first requests don't pay for them.
+    """
+
+    from models import db, get_bcrypt
+
+    timings = {}
+
+    start = time.perf_counter()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    timings['templates'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    get_bcrypt()
+    timings['bcrypt'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with app.app_context():
+        engine = db.engine
+        if connections is None:
+            size = getattr(engine.pool, 'size', None)
+            connections = size() if callable(size) else 1
+
+        opened = []
+        try:
+            for i in range(connections):
+                conn = engine.connect()
+                conn.execute(text("SELECT 1"))
+                opened.append(conn)
+        finally:
+            # closing hands them back to the pool, still open
+            for conn in opened:
+                conn.close()
+    timings['connections'] = time.perf_counter() - start
+
+    return timings
+
+
+HOT_TABLES = ('users', 'follows', 'likes', 'message_tags')
+
+PREWARM = """
+    SELECT ix.relname, pg_prewarm(ix.oid)
+    FROM pg_index
+    JOIN pg_class ix ON ix.oid = pg_index.indexrelid
+    JOIN pg_class t ON t.oid = pg_index.indrelid
+    WHERE t.relname = ANY(:tables)
+"""
+
+
+def recently_active(limit, days):
+    """Ids of up to `limit` users who posted in the last `days`, latest first."""
+
+    from ids import id_from_datetime
+    from models import db, Message
+
+    since = id_from_datetime(datetime.utcnow() - timedelta(days=days))
+    return [user_id for (user_id,) in
+            db.session.query(Message.user_id)
+            .filter(Message.id >= since)
+            .group_by(Message.user_id)
+            .order_by(func.max(Message.id).desc())
+            .limit(limit)]
+
+
+def prime_indexes(conn, now=None):
+    """Load the hot indexes into shared buffers with pg_prewarm.
+
+    Hot: those of HOT_TABLES and of this and last month's messages
+    partitions. Returns {index: blocks loaded}, or None without the
+    pg_prewarm extension.
+    """
+
+    import partitions
+
+    if conn.dialect.name != 'postgresql':
+        return None
+
+    installed = conn.execute(text(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm'")).scalar()
+    if not installed:
+        return None
+
+    now = now or datetime.utcnow()
+    tables = list(HOT_TABLES) + [
+        partitions.partition_name(*partitions.add_months(now.year, now.month, -i))
+        for i in (1, 0)]
+
+    return dict(conn.execute(text(PREWARM), {'tables': tables}).fetchall())
+
+
+def warm_caches(app, stop=None, deadline=None):
+    """Prebuild cached reads for recently active users; returns a summary.
+
+    Users are warmed WARM_UP_WORKERS at a time. Those not reached before
+    `stop` is set or the `deadline` (a time.time()) passes are skipped.
+    """
+
+    from app import warm_user
+    from models import db
+
+    start = time.perf_counter()
+
+    with app.app_context():
+        user_ids = recently_active(app.config['WARM_UP_USERS'],
+                                   app.config['WARM_UP_DAYS'])
+        with db.engine.connect() as conn:
+            indexes = prime_indexes(conn)
+
+    def warm(user_id):
+        if ((stop is not None and stop.is_set())
+                or (deadline is not None and time.time() >= deadline)):
+            return False
+
+        with app.test_request_context('/'):
+            try:
+                warm_user(user_id)
+            except Exception:
+                app.logger.exception("warming up user %s failed", user_id)
+                return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=app.config['WARM_UP_WORKERS'],
+                            thread_name_prefix='warm-up') as pool:
+        warmed = sum(pool.map(warm, user_ids))
+
+    return {'users': warmed, 'skipped': len(user_ids) - warmed,
+            'indexes': sorted(indexes) if indexes is not None else None,
+            'caches': time.perf_counter() - start}
+
+
+class WarmUp:
+    """This process's background warm-up, and whether it's ready for traffic.
+
+    Ready once the warm-up is over, or its time budget is spent, whichever
+    comes first. A process that never started one is ready.
+    """
+
+    def __init__(self):
+        self.started = None
+        self.finished = None
+        self.budget = None
+        self.results = {}
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, app):
+        self.budget = app.config['WARM_UP_BUDGET']
+        self.started = time.time()
+        self.finished = None
+        self._stop.clear()
+
+        self._thread = threading.Thread(target=self._run, args=(app,),
+                                        name='warm-up', daemon=True)
+        self._thread.start()
+
+    def _run(self, app):
+        try:
+            results = dict(warm_up(app))
+            results.update(warm_caches(
+                app, stop=self._stop, deadline=self.started + self.budget))
+            self.results = results
+        except Exception as e:
+            app.logger.exception("warm-up failed")
+            self.error = repr(e)
+        finally:
+            self.finished = time.time()
+
+    def stop(self):
+        """Let the warm-up use the rest of its budget, then stop it.
+
+        For a master about to fork: no thread may be mid-query then.
+        """
+
+        if self._thread is None:
+            return
+
+        self._thread.join(max(0.0, self.started + self.budget - time.time()))
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def ready(self):
+        if self.started is None or self.finished is not None:
+            return True
+        return time.time() >= self.started + self.budget
+
+    def status(self):
+        if self.started is None:
+            state = 'off'
+        elif self.finished is not None:
+            state = 'done'
+        elif self.ready:
+            state = 'over budget'
+        else:
+            state = 'warming'
+
+        return {'state': state, 'ready': self.ready, 'error': self.error,
+                'results': self.results}
+
+
+warm_up_state = WarmUp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report Warbler startup time.")
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--no-warm-up', action='store_true')
+    args = parser.parse_args()
+
+    timer = ImportTimer()
+    timer.install()
+
+    start = time.perf_counter()
+    import app as app_module
+    imported = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app = app_module.create_app()
+    created = time.perf_counter() - start
+
+    timer.uninstall()
+
+    print(timer.report(args.top))
+    print()
+    print(f"import app:   {imported * 1000:8.1f} ms")
+    print(f"create_app(): {created * 1000:8.1f} ms")
+
+    if not args.no_warm_up:
+        for step, seconds in warm_up(app).items():
+            print(f"warm-up {step + ':':<12} {seconds * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
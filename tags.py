@@ -0,0 +1,38 @@
+"""#tag and @mention extraction for Warbler messages."""
+
+import re
+
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, MessageTag, USERNAME_PATTERN
+
+# a sigil that isn't glued to a preceding word (so "a#b" and emails don't
+# count), followed by the tag, or by anything a username can be
+TAG_RE = re.compile(rf"(?<![\w#@])(#\w+|@{USERNAME_PATTERN})")
+
+
+def extract_tags(text):
+    """Return the set of tags in `text`, e.g. {"#python", "@alice"}."""
+
+    return {tag.lower() for tag in TAG_RE.findall(text or "")}
+
+
+def tag_rows(message_id, text):
+    """Rows for `message_tags` indexing one message."""
+
+    return [{'tag': tag, 'message_id': message_id}
+            for tag in extract_tags(text)]
+
+
+def index_rows(rows):
+    """Insert index rows in one statement, skipping any already present."""
+
+    if rows:
+        db.session.execute(
+            insert(MessageTag.__table__).on_conflict_do_nothing(), rows)
+
+
+def index_message(message):
+    """Index a new (flushed) message's tags and mentions."""
+
+    index_rows(tag_rows(message.id, message.text))
@@ -0,0 +1,90 @@
+# run these tests like:
+#
+#    python -m unittest test_analytics.py
+
+from unittest import TestCase
+
+import numpy as np
+
+from analytics import Activity, HOUR, WEEK, WEEKS
+
+NOW = 1700000000.0
+
+
+class ActivityTestCase(TestCase):
+    """Test bulk aggregation of activity."""
+
+    def setUp(self):
+        self.activity = Activity(4, NOW)
+
+    def test_hourly(self):
+        """Are messages counted by user and hour of day?"""
+
+        midnight = NOW - NOW % (24 * HOUR)
+        self.activity.add_messages(
+            np.array([1, 1, 1, 3], dtype=np.float64),
+            np.array([midnight + 5 * HOUR, midnight + 5 * HOUR + 59,
+                      midnight - HOUR, midnight]))
+
+        self.assertEqual(self.activity.hourly[1, 5], 2)
+        self.assertEqual(self.activity.hourly[1, 23], 1)
+        self.assertEqual(self.activity.hourly[3, 0], 1)
+        self.assertEqual(self.activity.messages.tolist(), [0, 3, 0, 1])
+
+    def test_weekly(self):
+        """Are messages bucketed by week, dropping older ones?"""
+
+        self.activity.add_messages(
+            np.array([2, 2, 2, 2], dtype=np.float64),
+            np.array([NOW - 1, NOW + 60, NOW - WEEK - 1,
+                      NOW - (WEEKS + 1) * WEEK]))
+
+        self.assertEqual(self.activity.weekly[2, -1], 2)
+        self.assertEqual(self.activity.weekly[2, -2], 1)
+        self.assertEqual(self.activity.weekly[2].sum(), 3)
+        self.assertEqual(self.activity.messages[2], 4)
+
+    def test_chunks_add_up(self):
+        """Do counts accumulate over several chunks?"""
+
+        for _ in range(3):
+            self.activity.add_likes(np.array([1, 2, 2], dtype=np.float64))
+
+        self.assertEqual(self.activity.likes_received.tolist(), [0, 3, 6, 0])
+
+    def test_newcomers_skipped(self):
+        """Is a user who signed up during the run left for the next one?"""
+
+        self.activity.add_likes(np.array([2, 7], dtype=np.float64))
+        self.activity.add_messages(np.array([3, 4], dtype=np.float64),
+                                   np.array([NOW - 1, NOW - 1]))
+        self.activity.add_follows(np.array([9], dtype=np.float64),
+                                  np.array([NOW - 1]))
+
+        self.assertEqual(self.activity.likes_received.tolist(), [0, 0, 1, 0])
+        self.assertEqual(self.activity.messages.tolist(), [0, 0, 0, 1])
+        self.assertEqual(self.activity.followers.sum(), 0)
+
+    def test_followers(self):
+        """Is follower count cumulative, with untimed follows as the base?"""
+
+        self.activity.add_follows(
+            np.array([1, 1, 1], dtype=np.float64),
+            np.array([np.nan, NOW - 2 * WEEK - 1, NOW - 1]))
+
+        followers = self.activity.followers[1].tolist()
+        self.assertEqual(len(followers), WEEKS)
+        self.assertEqual(followers[0], 1)
+        self.assertEqual(followers[-3:], [2, 2, 3])
+
+    def test_rows(self):
+        """Are rows only made for users with activity?"""
+
+        self.activity.add_likes(np.array([2], dtype=np.float64))
+        self.activity.add_messages(np.array([2.0]), np.array([NOW - 1]))
+
+        rows = list(self.activity.rows(computed_at=None))
+        self.assertEqual([row['user_id'] for row in rows], [2])
+        self.assertEqual(rows[0]['messages'], 1)
+        self.assertEqual(rows[0]['likes_received'], 1)
+        self.assertEqual(len(rows[0]['hourly']), 24)
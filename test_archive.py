@@ -0,0 +1,170 @@
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+import archive
+from export import archived_batches
+from ids import id_from_datetime
+
+
+def row(user_id, when, text):
+    # one node per user, so ids made at the same time still differ
+    return (user_id, id_from_datetime(when, user_id), archive.to_micros(when),
+            text)
+
+
+class SegmentTestCase(TestCase):
+    """Test writing and reading one segment file."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.seg')
+
+        self.rows = sorted(
+            [row(user_id, datetime(2024, 1, day, 12), f"{user_id}/{day} ✓")
+             for user_id in (1, 2, 3) for day in range(1, 29)],
+            key=lambda r: (r[0], r[1]))
+        archive.write_segment(self.path, self.rows, block_rows=10)
+        self.segment = archive.Segment(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        """Does every row come back as written, across text blocks?"""
+
+        self.assertEqual(list(self.segment.rows()), self.rows)
+
+    def test_user_rows(self):
+        """Are a user's rows found newest first, below the cursor?"""
+
+        rows = self.segment.user_rows(2)
+        self.assertEqual([self.segment.text(r) for r in rows][:2],
+                         ["2/28 ✓", "2/27 ✓"])
+
+        before = id_from_datetime(datetime(2024, 1, 3, 12), 2)
+        rows = self.segment.user_rows(2, before=before)
+        self.assertEqual([self.segment.text(r) for r in rows],
+                         ["2/2 ✓", "2/1 ✓"])
+
+        self.assertEqual(len(self.segment.user_rows(99)), 0)
+
+    def test_find(self):
+        """Is a message found by id, and a missing one not?"""
+
+        user_id, message_id, micros, text = self.rows[40]
+        msg = self.segment.message(self.segment.find(message_id))
+
+        self.assertEqual((msg.user_id, msg.text), (user_id, text))
+        self.assertEqual(msg.timestamp, archive.from_micros(micros))
+        self.assertIsNone(self.segment.find(message_id + 1))
+
+    def test_threads_share_blocks(self):
+        """Do threads reading all over a segment get the right texts,
+        while blocks are evicted under them?"""
+
+        texts = [r[3] for r in self.rows]
+
+        def read(i):
+            row = (i * 7) % len(texts)
+            return self.segment.text(row) == texts[row]
+
+        with patch.object(archive, 'CACHED_BLOCKS', 2), \
+                ThreadPoolExecutor(max_workers=8) as pool:
+            self.assertTrue(all(pool.map(read, range(20 * len(texts)))))
+        self.assertLessEqual(len(self.segment._blocks), 2)
+
+
+class ArchiveTestCase(TestCase):
+    """Test an archive directory of monthly segments."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = archive.Archive(self.directory)
+
+        self.archive.add_month(2024, 1, [
+            row(1, datetime(2024, 1, day), f"january {day}")
+            for day in range(1, 11)])
+        self.archive.add_month(2024, 2, [
+            row(1, datetime(2024, 2, day), f"february {day}")
+            for day in range(1, 6)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_empty(self):
+        """Does a directory with no manifest read as an empty archive?"""
+
+        empty = archive.Archive(os.path.join(self.directory, 'none'))
+        self.assertIsNone(empty.refresh().cutoff)
+        self.assertEqual(list(empty.user_messages(1)), [])
+
+    def test_user_messages(self):
+        """Do pages run newest first across months?"""
+
+        texts = [m.text for m in self.archive.user_messages(1, limit=7)]
+        self.assertEqual(texts[:5], [f"february {d}" for d in range(5, 0, -1)])
+        self.assertEqual(texts[5:], ["january 10", "january 9"])
+        self.assertEqual(self.archive.user_count(1), 15)
+
+    def test_cutoff(self):
+        """Does the cutoff cover the newest archived month?"""
+
+        self.assertEqual(self.archive.refresh().cutoff,
+                         id_from_datetime(datetime(2024, 3, 1)))
+
+    def test_add_month_merges(self):
+        """Does archiving a month again keep rows and drop duplicates?"""
+
+        again = row(1, datetime(2024, 1, 1), "january 1")
+        extra = row(2, datetime(2024, 1, 2), "someone else")
+        self.assertEqual(self.archive.add_month(2024, 1, [again, extra]), 11)
+        self.assertEqual(self.archive.user_count(1), 15)
+
+    def test_remove(self):
+        """Does a removed message disappear for an existing reader?"""
+
+        message_id = id_from_datetime(datetime(2024, 1, 5), 1)
+        self.assertEqual(self.archive.find(message_id).text, "january 5")
+
+        archive.Archive(self.directory).remove([message_id])
+
+        self.assertIsNone(self.archive.find(message_id))
+        self.assertEqual(self.archive.user_count(1), 14)
+
+    def test_contains(self):
+        """Is membership answered by id alone?"""
+
+        self.assertTrue(self.archive.contains(
+            id_from_datetime(datetime(2024, 2, 3), 1)))
+        self.assertFalse(self.archive.contains(
+            id_from_datetime(datetime(2024, 2, 3), 2)))
+        self.assertFalse(self.archive.contains(
+            id_from_datetime(datetime(2025, 2, 3), 1)))
+
+    def test_remove_users(self):
+        """Are all of a user's messages removed, and no one else's?"""
+
+        self.archive.add_month(2024, 1, [
+            row(2, datetime(2024, 1, 2), "someone else")])
+
+        self.assertEqual(archive.Archive(self.directory).remove_users([1]), 15)
+
+        self.assertEqual(self.archive.user_count(1), 0)
+        self.assertEqual([m.text for m in self.archive.user_messages(2)],
+                         ["someone else"])
+
+    def test_export(self):
+        """Are archived messages exported as message rows?"""
+
+        batches = list(archived_batches(self.archive, 1))
+        self.assertEqual(sum(len(batch) for batch in batches), 15)
+        self.assertEqual({kind for kind, fields in batches[0]}, {'message'})
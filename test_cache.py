@@ -0,0 +1,183 @@
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+import threading
+import time
+from unittest import TestCase
+
+from cache import TTLCache
+from startup import WarmUp
+
+
+class TTLCacheTestCase(TestCase):
+    """Test the in-process cache."""
+
+    def test_get_or_load(self):
+        """Is the loader only called on a miss?"""
+
+        cache = TTLCache('test-load', maxsize=10, ttl=60)
+        calls = []
+
+        def load():
+            calls.append(1)
+            return 'value'
+
+        self.assertEqual(cache.get_or_load('key', load), 'value')
+        self.assertEqual(cache.get_or_load('key', load), 'value')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.metrics(), {
+            'size': 1, 'hits': 1, 'stale_hits': 0, 'misses': 1,
+            'coalesced': 0, 'errors': 0, 'coalesced_rate': 0.0})
+
+    def test_expiry(self):
+        """Do entries expire after the TTL?"""
+
+        cache = TTLCache('test-expiry', ttl=0.01)
+        cache.set('key', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('key'))
+
+    def test_lru(self):
+        """Is the least recently used entry dropped when full?"""
+
+        cache = TTLCache('test-lru', maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_delete(self):
+        cache = TTLCache('test-delete')
+        cache.set('a', 1)
+        cache.delete('a', 'missing')
+        self.assertIsNone(cache.get('a'))
+
+
+class SingleFlightTestCase(TestCase):
+    """Test load coalescing and stale-while-revalidate."""
+
+    def slow_loader(self, value):
+        """A loader that blocks until self.release is set."""
+
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+        def load():
+            self.calls += 1
+            self.started.set()
+            self.release.wait(5)
+            return value
+
+        return load
+
+    def in_thread(self, fn):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(fn()))
+        thread.start()
+        return thread, results
+
+    def test_coalesced(self):
+        """Do concurrent misses on a key share one load?"""
+
+        cache = TTLCache('test-coalesce', ttl=60)
+        load = self.slow_loader('value')
+
+        leader, first = self.in_thread(lambda: cache.get_or_load('key', load))
+        self.started.wait(5)
+        followers = [self.in_thread(lambda: cache.get_or_load('key', load))
+                     for _ in range(5)]
+        while cache.coalesced < 5:
+            time.sleep(0.001)
+        self.release.set()
+
+        leader.join()
+        for thread, _ in followers:
+            thread.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(first + [r for _, res in followers for r in res],
+                         ['value'] * 6)
+        self.assertEqual(cache.metrics()['coalesced_rate'], 5 / 6)
+
+    def test_stale_while_revalidate(self):
+        """Is a stale entry served while another caller refreshes it?"""
+
+        cache = TTLCache('test-stale', ttl=0.01, stale_ttl=60)
+        cache.set('key', 'old')
+        time.sleep(0.02)
+
+        load = self.slow_loader('new')
+        refresher, refreshed = self.in_thread(
+            lambda: cache.get_or_load('key', load))
+        self.started.wait(5)
+
+        self.assertEqual(cache.get_or_load('key', load), 'old')
+        self.release.set()
+        refresher.join()
+
+        self.assertEqual(refreshed, ['new'])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache.get('key'), 'new')
+
+    def test_stale_on_error(self):
+        """Is the stale value kept if the refresh fails?"""
+
+        cache = TTLCache('test-stale-error', ttl=0.01, stale_ttl=60)
+        cache.set('key', 'old')
+        time.sleep(0.02)
+
+        def fail():
+            raise RuntimeError("database is down")
+
+        self.assertEqual(cache.get_or_load('key', fail), 'old')
+        self.assertEqual(cache.metrics()['errors'], 1)
+
+        with self.assertRaises(RuntimeError):
+            cache.get_or_load('other', fail)
+
+    def test_delete_during_load(self):
+        """Is a load that started before a delete not cached?"""
+
+        cache = TTLCache('test-invalidate', ttl=60)
+        load = self.slow_loader('before the write')
+
+        loader, loaded = self.in_thread(lambda: cache.get_or_load('key', load))
+        self.started.wait(5)
+        cache.delete('key')
+        self.release.set()
+        loader.join()
+
+        self.assertEqual(loaded, ['before the write'])
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.get_or_load('key', lambda: 'after'), 'after')
+
+
+class WarmUpTestCase(TestCase):
+    """Test readiness around the warm-up."""
+
+    def test_not_started(self):
+        """Is a process that doesn't warm up ready straight away?"""
+
+        self.assertTrue(WarmUp().ready)
+        self.assertEqual(WarmUp().status()['state'], 'off')
+
+    def test_budget(self):
+        """Does readiness wait for the warm-up, but only up to its budget?"""
+
+        state = WarmUp()
+        state.started = time.time()
+        state.budget = 60
+        self.assertFalse(state.ready)
+
+        state.started -= 61
+        self.assertTrue(state.ready)
+        self.assertEqual(state.status()['state'], 'over budget')
+
+        state.finished = time.time()
+        self.assertEqual(state.status()['state'], 'done')
@@ -0,0 +1,87 @@
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+import gzip
+from unittest import TestCase
+
+from compression import CompressionMiddleware, negotiate
+
+
+def make_app(body, content_type='text/html; charset=utf-8', length=True):
+    """A tiny WSGI app returning `body` in two chunks."""
+
+    def app(environ, start_response):
+        headers = [('Content-Type', content_type)]
+        if length:
+            headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        half = len(body) // 2
+        return [body[:half], body[half:]]
+
+    return app
+
+
+class CompressionTestCase(TestCase):
+    """Test response compression."""
+
+    def call(self, app, accept_encoding='gzip'):
+        headers = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            headers.update(response_headers)
+
+        environ = {'REQUEST_METHOD': 'GET',
+                   'HTTP_ACCEPT_ENCODING': accept_encoding}
+        body = b''.join(CompressionMiddleware(app)(environ, start_response))
+        return headers, body
+
+    def test_negotiate(self):
+        """Does it honour the client's encodings and q-values?"""
+
+        self.assertEqual(negotiate('gzip, deflate'), 'gzip')
+        self.assertIsNone(negotiate('gzip;q=0'))
+        self.assertIsNone(negotiate(''))
+
+    def test_compresses_html(self):
+        """Is a large HTML response gzipped?"""
+
+        body = b'<p>warble</p>' * 200
+        headers, compressed = self.call(make_app(body))
+
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', headers)
+        self.assertEqual(gzip.decompress(compressed), body)
+
+    def test_streamed(self):
+        """Is a response with no length compressed too?"""
+
+        body = b'x' * 100
+        headers, compressed = self.call(make_app(body, length=False))
+
+        self.assertEqual(gzip.decompress(compressed), body)
+
+    def test_small_left_alone(self):
+        """Are responses under the threshold sent as they are?"""
+
+        headers, body = self.call(make_app(b'tiny'))
+
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(body, b'tiny')
+
+    def test_images_left_alone(self):
+        """Are already-compressed types sent as they are?"""
+
+        body = b'\xff\xd8' * 1000
+        headers, sent = self.call(make_app(body, content_type='image/jpeg'))
+
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(sent, body)
+
+    def test_not_accepted(self):
+        """Is nothing compressed for clients that don't ask?"""
+
+        body = b'<p>warble</p>' * 200
+        headers, sent = self.call(make_app(body), accept_encoding='identity')
+
+        self.assertEqual(sent, body)
@@ -0,0 +1,89 @@
+# run these tests like:
+#
+#    python -m unittest test_digest.py
+
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from email import message_from_bytes
+from unittest import TestCase
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import digest
+
+END = datetime(2024, 5, 6)
+
+
+def candidate(likes, message_id, author_id):
+    return (likes, message_id, author_id, f"user{author_id}",
+            datetime(2024, 5, 1), f"message {message_id}")
+
+
+class DigestTestCase(TestCase):
+    """Test picking, rendering and checkpointing digests."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_week_ending(self):
+        self.assertEqual(digest.week_ending(datetime(2024, 5, 8, 15)), END)
+        self.assertEqual(digest.week_ending(END), END)
+
+    def test_top_messages(self):
+        """Are the best of the followed authors' candidates picked?"""
+
+        by_author = {1: [candidate(9, 10, 1), candidate(2, 11, 1)],
+                     2: [candidate(5, 20, 2), candidate(5, 21, 2)],
+                     3: [candidate(50, 30, 3)]}
+
+        top = digest.top_messages(by_author, [1, 2, 4], size=3)
+        self.assertEqual([message[1] for message in top], [10, 21, 20])
+        self.assertEqual(digest.top_messages(by_author, [4]), [])
+
+    def test_chunk_ranges(self):
+        self.assertEqual(digest.chunk_ranges(2500, 1000),
+                         [(0, 0, 1000), (1, 1000, 2000), (2, 2000, 3000)])
+
+    def test_checkpoint_resumes(self):
+        """Does a checkpoint remember finished chunks, at its chunk size?"""
+
+        path = os.path.join(self.directory, 'week.checkpoint.json')
+        digest.Checkpoint(path, 1000).record(3, {'sent': 7})
+
+        resumed = digest.Checkpoint(path, 1000)
+        self.assertEqual(resumed.done, {3})
+        self.assertEqual(resumed.stats['sent'], 7)
+
+        self.assertEqual(digest.Checkpoint(path, 500).done, set())
+
+    def test_file_transport(self):
+        """Is a rendered digest written where the file transport says?"""
+
+        env = Environment(loader=FileSystemLoader('templates'),
+                          autoescape=select_autoescape(['html']))
+        templates = {'text': env.get_template('digest/email.txt'),
+                     'html': env.get_template('digest/email.html')}
+
+        msg = digest.build_message(
+            (7, "reader", "reader@test.com"),
+            [candidate(3, 10, 1), (0, 11, 2, "user2", datetime(2024, 5, 2),
+                                   "<b>bold</b>")],
+            templates, END, "digest@test.com", "http://warbler.test")
+
+        with digest.FileTransport(self.directory) as transport:
+            transport.send(msg)
+
+        with open(os.path.join(self.directory, '7.eml'), 'rb') as f:
+            sent = message_from_bytes(f.read())
+
+        self.assertEqual(sent['To'], "reader@test.com")
+        text, html = [part.get_payload(decode=True).decode()
+                      for part in sent.get_payload()]
+        self.assertIn("@user1 (3 likes)", text)
+        self.assertIn("http://warbler.test/messages/10", text)
+        self.assertIn("&lt;b&gt;bold&lt;/b&gt;", html)
@@ -0,0 +1,114 @@
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from unittest import TestCase
+
+from flask import Flask
+
+from export import (encode, JOB_NAME_RE, job_name, cleanup, running_job,
+                    start_job, STALE_AFTER)
+
+BATCHES = [
+    [('profile', {'id': 1, 'username': 'alice', 'email': 'a@test.com'}),
+     ('message', {'id': 10, 'text': 'hi, "you"',
+                  'timestamp': datetime(2020, 1, 2, 3, 4, 5)})],
+    [('following', {'user_id': 2, 'username': 'bob'})],
+]
+
+
+class EncodeTestCase(TestCase):
+    """Test export encoding."""
+
+    def test_ndjson(self):
+        """Is each row a JSON line tagged with its type?"""
+
+        chunks = list(encode(iter(BATCHES), 'ndjson'))
+        self.assertEqual(len(chunks), 2)
+
+        rows = [json.loads(line) for line in b"".join(chunks).splitlines()]
+        self.assertEqual([row['type'] for row in rows],
+                         ['profile', 'message', 'following'])
+        self.assertEqual(rows[1]['timestamp'], '2020-01-02T03:04:05')
+
+    def test_csv(self):
+        """Is it one CSV with a header, quoting intact?"""
+
+        data = b"".join(encode(iter(BATCHES), 'csv')).decode()
+        rows = list(csv.DictReader(io.StringIO(data)))
+
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1]['text'], 'hi, "you"')
+        self.assertEqual(rows[2]['username'], 'bob')
+
+    def test_csv_empty(self):
+        """Does an empty export still get its header?"""
+
+        data = b"".join(encode(iter([]), 'csv')).decode()
+        self.assertTrue(data.startswith('type,id,'))
+
+    def test_job_name(self):
+        """Do job names match the pattern downloads are checked against?"""
+
+        match = JOB_NAME_RE.fullmatch(job_name(42, 'csv'))
+        self.assertEqual(match.group(1), '42')
+
+
+class JobFilesTestCase(TestCase):
+    """Test background export bookkeeping in the export directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = time.time()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def touch(self, name, age=0):
+        path = os.path.join(self.directory, name)
+        open(path, 'w').close()
+        os.utime(path, (self.now - age, self.now - age))
+        return name
+
+    def test_running_job(self):
+        """Is a fresh .tmp the user's running job, and a stale one not?"""
+
+        name = job_name(42, 'csv')
+        self.touch(name + '.tmp')
+        self.touch(job_name(7, 'csv') + '.tmp')
+
+        self.assertEqual(running_job(self.directory, 42, self.now), name)
+        self.assertIsNone(running_job(self.directory, 4, self.now))
+        self.assertIsNone(running_job(self.directory, 42,
+                                      self.now + STALE_AFTER))
+
+    def test_start_job_reuses_running(self):
+        """Does asking again while an export runs get the running one?"""
+
+        app = Flask(__name__)
+        app.config.update(EXPORT_RETENTION=3600, EXPORT_WORKERS=1)
+        name = self.touch(job_name(42, 'ndjson') + '.tmp')[:-len('.tmp')]
+
+        self.assertEqual(start_job(app, 42, 'csv', self.directory), name)
+        self.assertEqual(os.listdir(self.directory), [name + '.tmp'])
+
+    def test_cleanup(self):
+        """Are only expired exports, failures and abandoned files deleted?"""
+
+        kept = [self.touch(job_name(1, 'csv'), age=60),
+                self.touch(job_name(2, 'csv') + '.tmp', age=60),
+                self.touch('notes.txt', age=7200)]
+        self.touch(job_name(3, 'csv'), age=7200)
+        self.touch(job_name(4, 'ndjson') + '.failed', age=7200)
+        self.touch(job_name(5, 'csv') + '.tmp', age=STALE_AFTER)
+
+        self.assertEqual(cleanup(self.directory, 3600, self.now), 3)
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(kept))
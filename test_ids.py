@@ -0,0 +1,67 @@
+# run these tests like:
+#
+#    python -m unittest test_ids.py
+
+from datetime import datetime
+from unittest import TestCase
+
+from ids import (IdGenerator, MAX_NODE_ID, MAX_SEQUENCE, NODE_SHIFT,
+                 datetime_from_id, id_from_datetime)
+
+
+class IdGeneratorTestCase(TestCase):
+    """Test time-ordered message ids."""
+
+    def test_ids_increase(self):
+        """Are ids strictly increasing?"""
+
+        gen = IdGenerator(node_id=5)
+        ids = [gen.next_id() for i in range(10000)]
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_ids_fit_bigint(self):
+        """Do ids fit in a signed 64-bit column?"""
+
+        gen = IdGenerator(node_id=1023)
+        self.assertLess(gen.next_id(), 2 ** 63)
+
+    def test_nodes_differ(self):
+        """Do two nodes never mint the same id?"""
+
+        a = IdGenerator(node_id=1)
+        b = IdGenerator(node_id=2)
+        ids_a = {a.next_id() for i in range(1000)}
+        ids_b = {b.next_id() for i in range(1000)}
+
+        self.assertFalse(ids_a & ids_b)
+
+    def test_set_node_id(self):
+        """Does a generator mint as its new node, still increasing?"""
+
+        gen = IdGenerator(node_id=1)
+        first = gen.next_id()
+        gen.set_node_id(7)
+        second = gen.next_id()
+
+        self.assertEqual((second >> NODE_SHIFT) & MAX_NODE_ID, 7)
+        self.assertGreater(second, first)
+        with self.assertRaises(ValueError):
+            gen.set_node_id(MAX_NODE_ID + 1)
+
+    def test_datetime_round_trip(self):
+        """Can the creation time be read back out of an id?"""
+
+        when = datetime(2023, 10, 24, 22, 35, 27, 123000)
+        message_id = id_from_datetime(when, node_id=3, sequence=MAX_SEQUENCE)
+
+        self.assertEqual(datetime_from_id(message_id), when)
+
+    def test_datetime_orders_ids(self):
+        """Does id order follow time order?"""
+
+        earlier = id_from_datetime(datetime(2020, 1, 1), sequence=MAX_SEQUENCE)
+        later = id_from_datetime(datetime(2020, 1, 1, 0, 0, 0, 1000))
+
+        self.assertLess(earlier, later)
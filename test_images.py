@@ -0,0 +1,206 @@
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from io import BytesIO
+from unittest import TestCase, skipIf
+
+from werkzeug.datastructures import FileStorage
+
+import images
+from images import (VARIANTS, Image, ImageError, image_dir, image_variant,
+                    make_variants, media_file, store_upload, variants_missing)
+
+DIGEST = 'ab' * 32
+
+
+class ImageVariantTestCase(TestCase):
+    """Test variant URLs and serving fallbacks."""
+
+    def test_local_variant(self):
+        """Does a stored image URL map to its variant?"""
+
+        self.assertEqual(image_variant(f"/media/{DIGEST}/original.png", 'card'),
+                         f"/media/{DIGEST}/card.jpg")
+
+    def test_remote_untouched(self):
+        """Are remote and default URLs left alone?"""
+
+        for url in ("https://randomuser.me/api/portraits/men/80.jpg",
+                    "/static/images/default-pic.png",
+                    None):
+            self.assertEqual(image_variant(url, 'card'), url)
+
+    def test_unknown_variant(self):
+        """Is an unknown variant name ignored?"""
+
+        url = f"/media/{DIGEST}/original.png"
+        self.assertEqual(image_variant(url, 'poster'), url)
+
+    def test_media_file_fallback(self):
+        """Is the original served until the variant exists?"""
+
+        with tempfile.TemporaryDirectory() as media_dir:
+            directory = image_dir(DIGEST, media_dir)
+            os.makedirs(directory)
+            open(os.path.join(directory, 'original.png'), 'wb').close()
+
+            self.assertEqual(media_file(DIGEST, 'card.jpg', media_dir),
+                             (directory, 'original.png', False))
+
+            open(os.path.join(directory, 'card.jpg'), 'wb').close()
+
+            self.assertEqual(media_file(DIGEST, 'card.jpg', media_dir),
+                             (directory, 'card.jpg', True))
+
+    def test_variants_missing(self):
+        """Is a directory short of any variant due another resize?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            for name in list(VARIANTS)[:-1]:
+                open(os.path.join(directory, f"{name}.jpg"), 'wb').close()
+            self.assertTrue(variants_missing(directory))
+
+            open(os.path.join(directory, f"{list(VARIANTS)[-1]}.jpg"),
+                 'wb').close()
+            self.assertFalse(variants_missing(directory))
+
+
+def png_bytes(size=(800, 300)):
+    """A PNG with some transparency, as uploaded."""
+
+    image = Image.new('RGBA', size, (200, 30, 30, 255))
+    image.paste((0, 0, 0, 0), (0, 0, size[0] // 2, size[1] // 2))
+    out = BytesIO()
+    image.save(out, 'PNG')
+    return out.getvalue()
+
+
+def upload(data, filename='avatar.png'):
+    return FileStorage(BytesIO(data), filename=filename)
+
+
+@skipIf(Image is None, "needs Pillow")
+class MakeVariantsTestCase(TestCase):
+    """Test resizing a stored original."""
+
+    def setUp(self):
+        self.media_dir = tempfile.mkdtemp()
+        self.data = png_bytes()
+        self.digest = hashlib.sha256(self.data).hexdigest()
+        self.directory = image_dir(self.digest, self.media_dir)
+        os.makedirs(self.directory)
+        self.original = os.path.join(self.directory, 'original.png')
+        with open(self.original, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.media_dir)
+
+    def test_variant_sizes(self):
+        """Is the timeline avatar cropped, and the others only shrunk?"""
+
+        make_variants(self.original)
+
+        sizes = {}
+        for name in VARIANTS:
+            with Image.open(os.path.join(self.directory, f"{name}.jpg")) as image:
+                self.assertEqual((image.format, image.mode), ('JPEG', 'RGB'))
+                sizes[name] = image.size
+
+        self.assertEqual(sizes, {'timeline': (96, 96), 'card': (400, 150),
+                                 'hero': (800, 300)})
+        self.assertFalse(variants_missing(self.directory))
+        self.assertEqual(
+            [name for name in os.listdir(self.directory) if name.endswith('.tmp')],
+            [])
+
+    def test_media_file_after_resize(self):
+        """Is the original served before the resize, the variant after?"""
+
+        self.assertEqual(media_file(self.digest, 'card.jpg', self.media_dir),
+                         (self.directory, 'original.png', False))
+
+        make_variants(self.original)
+
+        self.assertEqual(media_file(self.digest, 'card.jpg', self.media_dir),
+                         (self.directory, 'card.jpg', True))
+
+
+@skipIf(Image is None, "needs Pillow")
+class StoreUploadTestCase(TestCase):
+    """Test storing uploads by content."""
+
+    def setUp(self):
+        self.media_dir = tempfile.mkdtemp()
+        self.data = png_bytes()
+        self.digest = hashlib.sha256(self.data).hexdigest()
+        self.directory = image_dir(self.digest, self.media_dir)
+
+        # record resizes instead of running them, unless a test wants them
+        self.queued = []
+        self.queue_variants = images.queue_variants
+        images.queue_variants = (
+            lambda original, *args: self.queued.append(original))
+
+    def tearDown(self):
+        images.queue_variants = self.queue_variants
+        shutil.rmtree(self.media_dir)
+
+    def store(self, data=None, **kwargs):
+        return store_upload(upload(data or self.data),
+                            media_dir=self.media_dir, **kwargs)
+
+    def test_content_addressed(self):
+        """Is the original stored, once, under the digest of its bytes?"""
+
+        url = self.store()
+        original = os.path.join(self.directory, 'original.png')
+
+        self.assertEqual(url, f"/media/{self.digest}/original.png")
+        with open(original, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+        self.assertEqual(self.store(), url)
+        self.assertEqual(os.listdir(self.directory), ['original.png'])
+
+    def test_requeue_missing_variants(self):
+        """Is a re-upload resized again only while variants are missing?"""
+
+        self.store()
+        self.store()
+        original = os.path.join(self.directory, 'original.png')
+        self.assertEqual(self.queued, [original, original])
+
+        for name in VARIANTS:
+            open(os.path.join(self.directory, f"{name}.jpg"), 'wb').close()
+        self.store()
+        self.assertEqual(len(self.queued), 2)
+
+    def test_refused(self):
+        """Are files that aren't images in an allowed format refused?"""
+
+        bmp = BytesIO()
+        Image.new('RGB', (10, 10)).save(bmp, 'BMP')
+
+        for data in (b"not an image", bmp.getvalue()):
+            with self.assertRaises(ImageError):
+                self.store(data)
+        self.assertEqual(self.queued, [])
+
+    def test_resized_in_pool(self):
+        """Are the variants made in the background after the upload?"""
+
+        images.queue_variants = self.queue_variants
+        self.store(max_workers=1)
+
+        deadline = time.monotonic() + 30
+        while variants_missing(self.directory) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        self.assertFalse(variants_missing(self.directory))
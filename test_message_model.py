@@ -83,7 +83,7 @@ class MessageModelTestCase(TestCase):
         db.session.commit()
 
         # Message should be connected to the user
-        self.assertEqual(len(self.sample1.messages), 1)
+        self.assertEqual(self.sample1.messages.count(), 1)
         # Should have a timestamp
         self.assertTrue(m.timestamp)
         # Checking the message
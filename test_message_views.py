@@ -19,7 +19,9 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+import cache
+from models import db, connect_db, Message, User, Follows, Likes
+from querybudget import record_queries, budget_for
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -31,7 +33,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, follow_cache, timeline_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -43,6 +45,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Query budgets are checked against uncached pages
+
+app.config['CACHE_ENABLED'] = False
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -178,4 +184,166 @@ class MessageViewTestCase(TestCase):
 
             resp = c.post(f"/messages/{msg.id}/delete")
             
-            self.assertEqual(resp.location, "http://localhost/")
\ No newline at end of file
+            self.assertEqual(resp.location, "http://localhost/")
+
+    def test_homepage_queries(self):
+        """Are feed messages loaded with their authors, not one at a time?"""
+
+        for i in range(6):
+            user = User.signup(f"author{i}", f"author{i}@test.com",
+                               "password", None)
+            db.session.flush()
+            db.session.add(Follows(user_following_id=self.testuser.id,
+                                   user_being_followed_id=user.id))
+            db.session.add(Message(text=f"#hello from {i}", user_id=user.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with record_queries() as queries:
+                resp = c.get("/")
+                html = resp.get_data(as_text=True)
+
+            self.assertIn("@author5", html)
+            self.assertEqual(
+                queries.violations(budget_for(app, 'warbler.homepage')), [])
+
+    def test_homepage_cached(self):
+        """Is the home timeline served from cache until the user follows?"""
+
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.flush()
+        db.session.add(Follows(user_following_id=self.testuser.id,
+                               user_being_followed_id=author.id))
+        db.session.add(Message(text="first", user_id=author.id))
+        newcomer = User.signup("newcomer", "new@test.com", "password", None)
+        db.session.flush()
+        db.session.add(Message(text="from the newcomer", user_id=newcomer.id))
+        db.session.commit()
+        newcomer_id = newcomer.id
+
+        cache.clear_all()
+        app.config['CACHE_ENABLED'] = True
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                with record_queries() as cold:
+                    c.get("/").get_data()
+                with record_queries() as warm:
+                    html = c.get("/").get_data(as_text=True)
+
+                self.assertLess(len(warm), len(cold))
+                self.assertIn("first", html)
+                self.assertNotIn("from the newcomer", html)
+
+                c.post(f"/users/follow/{newcomer_id}")
+                html = c.get("/").get_data(as_text=True)
+                self.assertIn("from the newcomer", html)
+        finally:
+            app.config['CACHE_ENABLED'] = False
+
+    def test_follow_seen_on_other_workers(self):
+        """Does a worker holding the old timeline still show the new follow?"""
+
+        newcomer = User.signup("newcomer", "new@test.com", "password", None)
+        db.session.flush()
+        db.session.add(Message(text="from the newcomer", user_id=newcomer.id))
+        db.session.commit()
+        newcomer_id = newcomer.id
+        user_id = self.testuser.id
+
+        cache.clear_all()
+        app.config['CACHE_ENABLED'] = True
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                c.post(f"/users/follow/{newcomer_id}")
+
+                # what another worker cached before the follow
+                follow_cache.get_or_load((user_id, 0), frozenset)
+                timeline_cache.get_or_load((user_id, 0), list)
+
+                html = c.get("/").get_data(as_text=True)
+                self.assertIn("from the newcomer", html)
+        finally:
+            app.config['CACHE_ENABLED'] = False
+
+    def test_homepage_ranked(self):
+        """Does ?feed=ranked put a liked message first, and stick?"""
+
+        author = User.signup("author", "author@test.com", "password", None)
+        fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.flush()
+        db.session.add(Follows(user_following_id=self.testuser.id,
+                               user_being_followed_id=author.id))
+        popular = Message(text="popular", user_id=author.id)
+        db.session.add(popular)
+        db.session.flush()
+        db.session.add(Message(text="newest", user_id=author.id))
+        db.session.add(Likes(user_id=fan.id, message_id=popular.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with record_queries() as queries:
+                html = c.get("/?feed=ranked").get_data(as_text=True)
+            self.assertLess(html.index("popular"), html.index("newest"))
+            self.assertEqual(
+                queries.violations(budget_for(app, 'warbler.homepage')), [])
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertLess(html.index("popular"), html.index("newest"))
+
+            html = c.get("/?feed=latest").get_data(as_text=True)
+            self.assertLess(html.index("newest"), html.index("popular"))
+
+    def test_message_page_cached(self):
+        """Is a cached message page dropped when the message is deleted?"""
+
+        cache.clear_all()
+        app.config['CACHE_ENABLED'] = True
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                c.post("/messages/new", data={"text": "Going soon"})
+                msg_id = Message.query.one().id
+
+                with record_queries() as cold:
+                    c.get(f"/messages/{msg_id}")
+                with record_queries() as warm:
+                    resp = c.get(f"/messages/{msg_id}")
+
+                self.assertIn("Going soon", resp.get_data(as_text=True))
+                self.assertLess(len(warm), len(cold))
+
+                c.post(f"/messages/{msg_id}/delete")
+                self.assertEqual(c.get(f"/messages/{msg_id}").status_code, 404)
+        finally:
+            app.config['CACHE_ENABLED'] = False
+
+    def test_show_message_queries(self):
+        """Does showing a message stay within its query budget?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hello"})
+            msg = Message.query.one()
+
+            with record_queries() as queries:
+                resp = c.get(f"/messages/{msg.id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                queries.violations(budget_for(app, 'warbler.messages_show')), [])
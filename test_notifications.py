@@ -0,0 +1,89 @@
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+from notifications import NotificationBatcher, summary, FOLLOW, LIKE
+
+
+class BatcherTestCase(TestCase):
+    """Test folding events together in memory."""
+
+    def setUp(self):
+        self.batcher = NotificationBatcher()
+        # keep the flush thread asleep; these tests don't touch the database
+        self.batcher.interval = 3600
+
+    def test_aggregates(self):
+        """Are events about the same subject folded into one?"""
+
+        for actor_id in (2, 3, 4):
+            self.batcher.notify(LIKE, 1, actor_id, 99)
+        self.batcher.notify(LIKE, 1, 2, 100)
+
+        self.assertEqual(self.batcher._pending[(1, LIKE, 99)], [3, [2, 3, 4]])
+        self.assertEqual(self.batcher._pending[(1, LIKE, 100)], [1, [2]])
+
+    def test_repeat_actor(self):
+        """Does liking twice count one person, moved to newest?"""
+
+        for actor_id in (2, 3, 2):
+            self.batcher.notify(LIKE, 1, actor_id, 99)
+
+        self.assertEqual(self.batcher._pending[(1, LIKE, 99)], [2, [3, 2]])
+
+    def test_requeue_counts_people(self):
+        """Is an actor in both a failed flush and a newer event counted once?"""
+
+        self.batcher.notify(LIKE, 1, 2, 99)
+        pending, self.batcher._pending = self.batcher._pending, {}
+
+        self.batcher.notify(LIKE, 1, 2, 99)
+        self.batcher.notify(LIKE, 1, 3, 99)
+        self.batcher._requeue(pending)
+
+        self.assertEqual(self.batcher._pending[(1, LIKE, 99)], [2, [2, 3]])
+
+    def test_not_self(self):
+        """Are users never notified about themselves?"""
+
+        self.batcher.notify(FOLLOW, 1, 1)
+
+        self.assertEqual(self.batcher._pending, {})
+
+
+class SummaryTestCase(TestCase):
+    """Test notification wording."""
+
+    def notification(self, kind, count, actor_ids):
+        return SimpleNamespace(kind=kind, count=count, actor_ids=actor_ids)
+
+    def test_many(self):
+        """Are the latest actors named, and the rest counted?"""
+
+        n = self.notification(LIKE, 12, [1, 2])
+        self.assertEqual(summary(n, {1: 'alice', 2: 'bob'}),
+                         "@alice, @bob and 10 others liked your warble")
+
+    def test_few(self):
+        """Are small groups named in full?"""
+
+        n = self.notification(FOLLOW, 2, [1, 2])
+        self.assertEqual(summary(n, {1: 'alice', 2: 'bob'}),
+                         "@alice and @bob followed you")
+
+    def test_names_latest_only(self):
+        """Are only the newest MAX_ACTORS actors named?"""
+
+        n = self.notification(LIKE, 4, [1, 2, 3, 4])
+        usernames = {1: 'a', 2: 'b', 3: 'c', 4: 'd'}
+        self.assertEqual(summary(n, usernames),
+                         "@a, @b, @c and 1 other liked your warble")
+
+    def test_deleted_actors(self):
+        """Does it cope when the actors have gone?"""
+
+        n = self.notification(FOLLOW, 3, [1])
+        self.assertEqual(summary(n, {}), "3 people followed you")
@@ -0,0 +1,149 @@
+# run these tests like (needs a local Postgres, 12 or later):
+#
+#    python -m unittest test_partitions.py
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from ids import id_from_datetime
+from models import db, User, Message
+import partitions
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+db.drop_all()
+db.create_all()
+
+
+class MonthTestCase(TestCase):
+    """Test month arithmetic and bounds."""
+
+    def test_add_months(self):
+        """Does it carry over years both ways?"""
+
+        self.assertEqual(partitions.add_months(2026, 11, 3), (2027, 2))
+        self.assertEqual(partitions.add_months(2026, 1, -1), (2025, 12))
+
+    def test_bounds_meet(self):
+        """Does each month start where the last one ended?"""
+
+        self.assertEqual(partitions.month_bounds(2026, 12)[1],
+                         partitions.month_bounds(2027, 1)[0])
+        low, high = partitions.month_bounds(2026, 10)
+        self.assertTrue(low <= id_from_datetime(datetime(2026, 10, 31, 23, 59)) < high)
+
+
+class PartitionTestCase(TestCase):
+    """Test partition management against the database."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User(username="partitioned", email="p@test.com",
+                         password="HASHED_PASSWORD")
+        db.session.add(self.user)
+        db.session.commit()
+
+        self.now = datetime(2026, 10, 15)
+        with db.engine.begin() as conn:
+            partitions.create_partition(conn, 2025, 1)
+            partitions.ensure(conn, ahead=2, now=self.now)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def partition_of(self, message_id):
+        return db.session.execute(text(
+            "SELECT tableoid::regclass::text FROM messages WHERE id = :id"),
+            {'id': message_id}).scalar()
+
+    def test_ensure(self):
+        """Are this month and the next ones created, once?"""
+
+        with db.engine.begin() as conn:
+            names = [name for y, m, name in partitions.monthly_partitions(conn)]
+            again = partitions.ensure(conn, ahead=2, now=self.now)
+
+        self.assertEqual(names, ['messages_y2025m01', 'messages_y2026m10',
+                                 'messages_y2026m11', 'messages_y2026m12'])
+        self.assertEqual(again, [])
+
+    def test_routing(self):
+        """Do rows land in their month, or the default partition?"""
+
+        in_month = id_from_datetime(datetime(2026, 11, 3), 1)
+        uncovered = id_from_datetime(datetime(2024, 6, 1), 1)
+        for message_id in (in_month, uncovered):
+            db.session.add(Message(id=message_id, text="hi",
+                                   user_id=self.user.id))
+        db.session.commit()
+
+        self.assertEqual(self.partition_of(in_month), 'messages_y2026m11')
+        self.assertEqual(self.partition_of(uncovered), 'messages_default')
+
+    def test_ensure_moves_default_rows(self):
+        """Does a new month take its rows out of the default partition?"""
+
+        stray = id_from_datetime(datetime(2024, 6, 1), 1)
+        db.session.add(Message(id=stray, text="hi", user_id=self.user.id))
+        db.session.commit()
+        db.session.execute(text(
+            "INSERT INTO likes (user_id, message_id) VALUES (:user, :msg)"),
+            {'user': self.user.id, 'msg': stray})
+        db.session.commit()
+
+        with db.engine.begin() as conn:
+            created = partitions.ensure(conn, ahead=2, now=self.now,
+                                        months=[(2024, 6)])
+
+        self.assertEqual(created, ['messages_y2024m06'])
+        self.assertEqual(self.partition_of(stray), 'messages_y2024m06')
+        with db.engine.begin() as conn:
+            self.assertEqual(partitions.default_rows(conn), 0)
+
+        # the like still points at it, and still cascades
+        db.session.execute(text("DELETE FROM messages WHERE id = :id"),
+                           {'id': stray})
+        db.session.commit()
+        self.assertEqual(db.session.execute(text(
+            "SELECT count(*) FROM likes")).scalar(), 0)
+
+    def test_pruning(self):
+        """Does a bounded feed query only touch partitions in its window?"""
+
+        low = id_from_datetime(datetime(2026, 10, 1))
+        high = id_from_datetime(datetime(2026, 11, 1))
+        plan = "\n".join(row[0] for row in db.session.execute(text(
+            "EXPLAIN SELECT id FROM messages WHERE id >= :low AND id < :high "
+            "ORDER BY id DESC LIMIT 100"), {'low': low, 'high': high}))
+
+        self.assertIn('messages_y2026m10', plan)
+        self.assertNotIn('messages_y2025m01', plan)
+        self.assertNotIn('messages_y2026m11', plan)
+
+    def test_detach(self):
+        """Are only months before the cutoff detached?"""
+
+        with db.engine.begin() as conn:
+            detached = partitions.detach(conn, (2026, 1), drop=True)
+            names = [name for y, m, name in partitions.monthly_partitions(conn)]
+
+        self.assertEqual(detached, ['messages_y2025m01'])
+        self.assertNotIn('messages_y2025m01', names)
+
+    def test_feed_walks_back(self):
+        """Does a profile page reach messages older than the first window?"""
+
+        old = id_from_datetime(datetime(2025, 1, 10), 1)
+        db.session.add(Message(id=old, text="from long ago",
+                               user_id=self.user.id))
+        db.session.commit()
+
+        resp = app.test_client().get(f"/users/{self.user.id}")
+        self.assertIn("from long ago", resp.get_data(as_text=True))
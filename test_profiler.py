@@ -0,0 +1,127 @@
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import TestCase
+
+from flask import Flask, render_template
+from sqlalchemy import create_engine, text
+
+from profiler import SamplingProfiler, frame_label, sql_label
+
+TOKEN = 'let-me-see'
+
+# a query that keeps SQLite busy for a while
+SLOW_QUERY = """
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n
+                            WHERE i < 300000)
+    SELECT count(*) FROM n
+"""
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+    return ""
+
+
+class LabelTestCase(TestCase):
+    """Test stack labels."""
+
+    def test_sql_label(self):
+        """Are statements flattened onto one short line?"""
+
+        self.assertEqual(sql_label("SELECT *\n  FROM users", width=13),
+                         "[sql] SELECT * FROM")
+
+    def test_frame_label(self):
+        """Are Python frames labelled by file and function?"""
+
+        self.assertEqual(frame_label(sys._getframe()),
+                         "test_profiler.py:test_frame_label")
+
+
+class ProfilerTestCase(TestCase):
+    """Test profiling a request end to end."""
+
+    def setUp(self):
+        self.templates = tempfile.mkdtemp()
+        self.profiles = tempfile.mkdtemp()
+        with open(os.path.join(self.templates, 'slow.html'), 'w') as f:
+            f.write("<p>{{ busy(0.05) }}{{ query() }}</p>")
+
+        engine = create_engine('sqlite://')
+
+        def query():
+            with engine.connect() as conn:
+                return conn.execute(text(SLOW_QUERY)).scalar()
+
+        self.app = Flask(__name__, template_folder=self.templates)
+        self.app.config.update(PROFILE_TOKEN=TOKEN,
+                               PROFILE_DIR=self.profiles,
+                               PROFILE_INTERVAL=0.001)
+        self.profiler = SamplingProfiler(self.app)
+
+        @self.app.route('/slow')
+        def slow():
+            return render_template('slow.html', busy=busy, query=query)
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.templates)
+        shutil.rmtree(self.profiles)
+
+    def get(self, token=None):
+        headers = {} if token is None else {'X-Warbler-Profile': token}
+        resp = self.client.get('/slow', headers=headers)
+        resp.close()
+        return resp
+
+    def test_profile_by_token(self):
+        """Does the token profile a request into a folded file?"""
+
+        self.assertEqual(self.get(TOKEN).status_code, 200)
+
+        [name] = os.listdir(self.profiles)
+        self.assertTrue(name.endswith('.folded'))
+        self.assertIn('-slow-', name)
+
+        with open(os.path.join(self.profiles, name)) as f:
+            lines = f.read().splitlines()
+
+        stacks = {}
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            stacks[stack] = int(count)
+
+        self.assertTrue(all(count > 0 for count in stacks.values()))
+        self.assertTrue(any('[template] slow.html' in stack
+                            and stack.endswith('test_profiler.py:busy')
+                            for stack in stacks))
+        self.assertTrue(any(stack.split(';')[-1].startswith(
+            '[sql] WITH RECURSIVE') for stack in stacks))
+
+    def test_not_profiled(self):
+        """Are requests without the token, or with a wrong one, left alone?"""
+
+        for token in (None, 'wrong', 'näive'):
+            self.assertEqual(self.get(token).status_code, 200)
+
+        self.assertEqual(os.listdir(self.profiles), [])
+
+    def test_concurrency_limit(self):
+        """Is a request over PROFILE_MAX_CONCURRENT served unprofiled?"""
+
+        self.assertTrue(self.profiler._slots.acquire(blocking=False))
+        for i in range(self.app.config['PROFILE_MAX_CONCURRENT'] - 1):
+            self.profiler._slots.acquire(blocking=False)
+
+        self.assertEqual(self.get(TOKEN).status_code, 200)
+        self.assertEqual(os.listdir(self.profiles), [])
@@ -0,0 +1,160 @@
+"""Account deletion and moderation purge tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_purge.py
+
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+import archive
+import purge
+from ids import id_from_datetime
+from models import db, Message, User, Follows, Likes, PurgeJob
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from purge import purger
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['CACHE_ENABLED'] = False
+
+# purge in the request, two rows per chunk, so every step takes several
+app.config['PURGE_ASYNC'] = False
+app.config['PURGE_CHUNK'] = 2
+app.config['PURGE_PAUSE'] = 0
+purger.init_app(app)
+
+
+class PurgeTestCase(TestCase):
+    """Test tombstoning accounts and purging what they leave behind."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.user = User.signup("prolific", "prolific@test.com", "password",
+                                None)
+        self.other = User.signup("other", "other@test.com", "password", None)
+        self.admin = User.signup("admin", "admin@test.com", "password", None)
+        self.admin.is_admin = True
+        db.session.commit()
+
+        self.user_id = self.user.id
+        self.other_id = self.other.id
+        self.admin_id = self.admin.id
+
+        for i in range(5):
+            db.session.add(Message(text=f"post {i}", user_id=self.user_id))
+        other_msg = Message(text="someone else's", user_id=self.other_id)
+        db.session.add(other_msg)
+        db.session.flush()
+
+        db.session.add(Likes(user_id=self.user_id, message_id=other_msg.id))
+        db.session.add(Follows(user_following_id=self.user_id,
+                               user_being_followed_id=self.other_id))
+        db.session.add(Follows(user_following_id=self.other_id,
+                               user_being_followed_id=self.user_id))
+        db.session.commit()
+
+        self.directory = tempfile.mkdtemp()
+        app.config['ARCHIVE_DIR'] = self.directory
+        when = datetime(2019, 5, 1)
+        archive.store(self.directory).add_month(2019, 5, [
+            (self.user_id, id_from_datetime(when, 1), archive.to_micros(when),
+             "from the archive")])
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['ARCHIVE_DIR'] = archive.ARCHIVE_DIR
+        shutil.rmtree(self.directory)
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_tombstone_hides_account(self):
+        """Is a deleted account hidden before its purge has run?"""
+
+        User.query.get(self.user_id).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        with self.client as c:
+            self.assertEqual(c.get(f"/users/{self.user_id}").status_code, 404)
+
+            self.login(c, self.other_id)
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn("post 0", html)
+
+        self.assertFalse(User.authenticate("prolific", "password"))
+
+    def test_delete_user(self):
+        """Is everything the account left behind purged?"""
+
+        with self.client as c:
+            self.login(c, self.user_id)
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.location, "http://localhost/signup")
+
+        self.assertIsNone(User.query.get(self.user_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.user_id).count(),
+                         0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(archive.store(self.directory).user_count(self.user_id),
+                         0)
+
+        job = PurgeJob.query.one()
+        self.assertEqual((job.scope, job.deleted), (purge.ACCOUNT, 10))
+        self.assertIsNotNone(job.finished_at)
+
+        # the rest are left alone
+        self.assertEqual(Message.query.filter_by(user_id=self.other_id).count(),
+                         1)
+
+    def test_moderation_requires_admin(self):
+        with self.client as c:
+            self.login(c, self.other_id)
+            resp = c.post("/admin/moderation",
+                          data={'action': 'messages',
+                                'user_ids': str(self.user_id)})
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertEqual(PurgeJob.query.count(), 0)
+
+    def test_moderate_messages(self):
+        """Are only the users' messages removed, leaving their accounts?"""
+
+        with self.client as c:
+            self.login(c, self.admin_id)
+            resp = c.post("/admin/moderation",
+                          data={'action': 'messages',
+                                'user_ids': f"{self.user_id}, {self.other_id}"})
+            self.assertEqual(resp.status_code, 202)
+
+            jobs = resp.get_json()['jobs']
+            self.assertEqual(sorted(job['user_id'] for job in jobs),
+                             sorted([self.user_id, self.other_id]))
+
+            status = c.get(f"/admin/purges/{jobs[0]['id']}").get_json()
+            self.assertEqual(status['state'], 'finished')
+
+        self.assertEqual(Message.query.count(), 0)
+        self.assertIsNotNone(User.query.get(self.user_id))
+        self.assertEqual(Follows.query.count(), 2)
+
+    def test_moderation_bad_request(self):
+        with self.client as c:
+            self.login(c, self.admin_id)
+            resp = c.post("/admin/moderation",
+                          data={'action': 'messages', 'user_ids': "1,two"})
+
+        self.assertEqual(resp.status_code, 400)
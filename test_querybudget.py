@@ -0,0 +1,91 @@
+# run these tests like:
+#
+#    python -m unittest test_querybudget.py
+
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from flask import Flask
+
+from querybudget import (shape, record_queries, query_budget, QueryBudget,
+                         QueryLog)
+
+
+class ShapeTestCase(TestCase):
+    """Test statement normalisation."""
+
+    def test_parameters_and_literals(self):
+        """Do parameters and literals all become placeholders?"""
+
+        self.assertEqual(
+            shape("SELECT * FROM users\nWHERE id = %(id_1)s AND name = 'bob' LIMIT 10"),
+            "SELECT * FROM users WHERE id = ? AND name = ? LIMIT ?")
+
+    def test_in_lists(self):
+        """Do IN lists of any length have the same shape?"""
+
+        self.assertEqual(shape("SELECT 1 WHERE id IN (%(id_1)s, %(id_2)s)"),
+                         shape("SELECT 1 WHERE id IN (%(id_1)s)"))
+
+
+class QueryLogTestCase(TestCase):
+    """Test budget and N+1 checks."""
+
+    def test_n_plus_one(self):
+        """Is a shape repeated per row reported?"""
+
+        log = QueryLog(f"SELECT * FROM users WHERE id = {i}" for i in range(5))
+        log.append("SELECT * FROM messages")
+
+        self.assertEqual(log.n_plus_one(),
+                         [("SELECT * FROM users WHERE id = ?", 5)])
+        self.assertEqual(len(log.violations(budget=6)), 1)
+
+    def test_over_budget(self):
+        """Is going over budget reported?"""
+
+        log = QueryLog(["SELECT 1", "SELECT 2 FROM users"])
+
+        self.assertEqual(log.violations(budget=2), [])
+        self.assertEqual(log.violations(budget=1),
+                         ["2 queries, budget is 1"])
+
+    def test_record_queries(self):
+        """Are queries recorded, and nested recordings both kept?"""
+
+        engine = create_engine('sqlite://')
+
+        with engine.connect() as conn:
+            with record_queries() as outer:
+                conn.execute(text("SELECT 1"))
+                with record_queries() as inner:
+                    conn.execute(text("SELECT 2"))
+            conn.execute(text("SELECT 3"))
+
+        self.assertEqual(list(outer), ["SELECT 1", "SELECT 2"])
+        self.assertEqual(list(inner), ["SELECT 2"])
+
+
+class EnforceTestCase(TestCase):
+    """Test the extension in enforce mode."""
+
+    def test_fails_request(self):
+        """Does a route over its budget fail, rather than only log?"""
+
+        app = Flask(__name__)
+        app.config['QUERY_BUDGET_MODE'] = 'enforce'
+        QueryBudget(app)
+        engine = create_engine('sqlite://')
+
+        @app.route('/<int:queries>')
+        @query_budget(1)
+        def run(queries):
+            with engine.connect() as conn:
+                for i in range(queries):
+                    conn.execute(text("SELECT 1"))
+            return "done"
+
+        client = app.test_client()
+        self.assertEqual(client.get('/1').status_code, 200)
+        self.assertEqual(client.get('/2').status_code, 500)
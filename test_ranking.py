@@ -0,0 +1,62 @@
+# run these tests like:
+#
+#    python -m unittest test_ranking.py
+
+from unittest import TestCase
+
+import numpy as np
+
+import ranking
+
+HOUR = 3600.0
+NOW = 1714564800.0
+
+
+def candidates(*messages):
+    """Candidates from (hours old, likes, affinity) triples; cards are
+    numbered in order."""
+
+    return ranking.Candidates(
+        cards=tuple(range(len(messages))),
+        posted=np.array([NOW - hours * HOUR for hours, _, _ in messages]),
+        likes=np.array([likes for _, likes, _ in messages], dtype=np.float64),
+        affinity=np.array([affinity for _, _, affinity in messages],
+                          dtype=np.float64))
+
+
+class RankingTestCase(TestCase):
+    """Test scoring and ordering candidates."""
+
+    def test_recency_halves(self):
+        """Does an unliked message's score halve every half-life?"""
+
+        found = ranking.scores(candidates((0, 0, 0),
+                                          (ranking.HALF_LIFE_HOURS, 0, 0)),
+                               NOW)
+        self.assertAlmostEqual(found[1] / found[0], 0.5)
+
+    def test_velocity_beats_recency(self):
+        """Does a quickly liked message outrank a newer unliked one?"""
+
+        order = ranking.ranked(candidates((0, 0, 0), (3, 40, 0)), now=NOW)
+        self.assertEqual(order, [1, 0])
+
+    def test_affinity(self):
+        """Does liking an author lift their messages?"""
+
+        order = ranking.ranked(candidates((1, 2, 0), (1, 2, 5)), now=NOW)
+        self.assertEqual(order, [1, 0])
+
+    def test_ties_stay_newest_first(self):
+        order = ranking.ranked(candidates((1, 0, 0), (1, 0, 0), (1, 0, 0)),
+                               now=NOW)
+        self.assertEqual(order, [0, 1, 2])
+
+    def test_pages(self):
+        ranked = candidates(*[(hours, 0, 0) for hours in range(5)])
+
+        self.assertEqual(ranking.ranked(ranked, now=NOW, offset=2, limit=2),
+                         [2, 3])
+        self.assertEqual(ranking.ranked(ranked, now=NOW, offset=4, limit=2),
+                         [4])
+        self.assertEqual(ranking.ranked(candidates(), now=NOW), [])
@@ -0,0 +1,51 @@
+# run these tests like:
+#
+#    python -m unittest test_read_models.py
+
+from datetime import datetime
+from unittest import TestCase
+
+from archive import ArchivedMessage
+from read_models import MessageCard, UserCard, message_cards, archived_card
+
+NOW = datetime(2024, 5, 1, 12, 0)
+
+
+def row(message_id, user_id):
+    return (message_id, user_id, NOW, f"message {message_id}",
+            user_id, f"user{user_id}", "/image.png", "/header.png", None, None)
+
+
+class CardsTestCase(TestCase):
+    """Test building cards from rows."""
+
+    def test_message_cards(self):
+        cards = list(message_cards([row(3, 1), row(2, 7), row(1, 1)]))
+
+        self.assertEqual([card.id for card in cards], [3, 2, 1])
+        self.assertEqual(cards[1].user.username, "user7")
+        self.assertEqual(cards[0].timestamp, NOW)
+
+    def test_shared_authors(self):
+        """Do a page's messages by one author share one UserCard?"""
+
+        first, _, last = message_cards([row(3, 1), row(2, 7), row(1, 1)])
+        self.assertIs(first.user, last.user)
+
+    def test_immutable(self):
+        """Are cards read-only and without a per-instance __dict__?"""
+
+        card = next(message_cards([row(1, 1)]))
+
+        with self.assertRaises(AttributeError):
+            card.text = "edited"
+        with self.assertRaises(AttributeError):
+            card.user.bio = "edited"
+        self.assertFalse(hasattr(card, '__dict__'))
+
+    def test_archived_card(self):
+        author = UserCard(1, "user1", "/image.png", "/header.png", None, None)
+        archived = ArchivedMessage(5, 1, NOW, "old news")
+
+        self.assertEqual(archived_card(archived, author),
+                         MessageCard(5, 1, NOW, "old news", author))
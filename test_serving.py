@@ -0,0 +1,75 @@
+# run these tests like:
+#
+#    python -m unittest test_serving.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import create_engine, text
+
+import models  # noqa: F401 (installs the pool's fork guard)
+from bench_serve import parse_config, config_name
+
+
+class ForkGuardTestCase(TestCase):
+    """Test that pooled connections don't cross a fork."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.directory, 'test.db')}")
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def checkout(self):
+        conn = self.engine.connect()
+        conn.execute(text("SELECT 1"))
+        raw = conn.connection.connection
+        conn.close()
+        return raw
+
+    def test_same_process_reuses(self):
+        """Does the pool still reuse connections within a process?"""
+
+        self.assertIs(self.checkout(), self.checkout())
+
+    @skipUnless(hasattr(os, 'fork'), "needs fork")
+    def test_child_reconnects(self):
+        """Does a forked child get a connection of its own?"""
+
+        inherited = self.checkout()
+        read, write = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(write, b"new" if self.checkout() is not inherited
+                         else b"inherited")
+            finally:
+                os._exit(0)
+
+        os.close(write)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read, 16), b"new")
+        os.close(read)
+
+        # the parent's connection is still there and usable
+        self.assertIs(self.checkout(), inherited)
+
+
+class ConfigTestCase(TestCase):
+    """Test benchmark configuration names."""
+
+    def test_parse(self):
+        self.assertEqual(parse_config("4x2"),
+                         {'workers': 4, 'threads': 2, 'preload': True})
+        self.assertEqual(parse_config("3:nopreload"),
+                         {'workers': 3, 'threads': 1, 'preload': False})
+
+    def test_round_trip(self):
+        for name in ("4x1", "2x8:nopreload"):
+            self.assertEqual(config_name(parse_config(name)), name)
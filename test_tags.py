@@ -0,0 +1,45 @@
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+from unittest import TestCase
+
+from tags import extract_tags, tag_rows
+
+
+class ExtractTagsTestCase(TestCase):
+    """Test #tag and @mention parsing."""
+
+    def test_tags_and_mentions(self):
+        """Does it find both kinds?"""
+
+        self.assertEqual(extract_tags("hi @Alice, loving #Python and #flask!"),
+                         {"@alice", "#python", "#flask"})
+
+    def test_duplicates(self):
+        """Are repeated tags collapsed?"""
+
+        self.assertEqual(extract_tags("#a #A #a"), {"#a"})
+
+    def test_mention_punctuation(self):
+        """Do mentions take dots and dashes, but not a trailing full stop?"""
+
+        self.assertEqual(extract_tags("cc @jane.doe and @bob-smith."),
+                         {"@jane.doe", "@bob-smith"})
+        self.assertEqual(extract_tags("#end."), {"#end"})
+
+    def test_not_tags(self):
+        """Are emails and mid-word sigils ignored?"""
+
+        self.assertEqual(extract_tags("mail me at bob@example.com, c#d ##"), set())
+
+    def test_empty(self):
+        """Does it cope with no text?"""
+
+        self.assertEqual(extract_tags(""), set())
+        self.assertEqual(extract_tags(None), set())
+
+    def test_rows(self):
+        """Does it build index rows for a message?"""
+
+        self.assertEqual(tag_rows(7, "#one"), [{'tag': '#one', 'message_id': 7}])
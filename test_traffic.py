@@ -0,0 +1,102 @@
+# run these tests like:
+#
+#    python -m unittest test_traffic.py
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+
+from traffic import TrafficCapture, Replay, load, percentile
+
+
+def make_app(log_path, rate=1.0):
+    app = Flask(__name__)
+    app.config['TRAFFIC_CAPTURE_RATE'] = rate
+    app.config['TRAFFIC_LOG'] = log_path
+
+    @app.route('/hello')
+    def hello():
+        return "hello"
+
+    @app.route('/broken')
+    def broken():
+        return "no", 500
+
+    TrafficCapture(app)
+    return app
+
+
+class CaptureTestCase(TestCase):
+    """Test request capture."""
+
+    def setUp(self):
+        self.log_path = os.path.join(tempfile.mkdtemp(), 'logs', 'requests.jsonl')
+
+    def test_capture(self):
+        """Is each request written with its timing?"""
+
+        client = make_app(self.log_path).test_client()
+        client.get('/hello?x=1').close()
+        client.post('/hello').close()
+
+        with open(self.log_path) as f:
+            records = [json.loads(line) for line in f]
+
+        self.assertEqual([(r['method'], r['path'], r['status']) for r in records],
+                         [('GET', '/hello?x=1', 200), ('POST', '/hello', 405)])
+        self.assertEqual(records[0]['endpoint'], 'hello')
+        self.assertIsNone(records[0]['user_id'])
+        self.assertGreaterEqual(records[0]['duration_ms'], 0)
+
+    def test_sampling_off(self):
+        """Is nothing written at a rate of 0?"""
+
+        client = make_app(self.log_path, rate=0).test_client()
+        client.get('/hello').close()
+
+        self.assertFalse(os.path.exists(self.log_path))
+
+
+class ReplayTestCase(TestCase):
+    """Test replaying a captured log."""
+
+    def setUp(self):
+        self.log_path = os.path.join(tempfile.mkdtemp(), 'requests.jsonl')
+        with open(self.log_path, 'w') as f:
+            for i, path in enumerate(['/hello', '/broken', '/hello', '/hello']):
+                f.write(json.dumps({'ts': 100 + i / 100, 'method': 'GET',
+                                    'path': path, 'endpoint': path[1:],
+                                    'user_id': None, 'status': 200,
+                                    'duration_ms': 5.0}) + '\n')
+            f.write(json.dumps({'ts': 99, 'method': 'POST', 'path': '/hello',
+                                'user_id': None}) + '\n')
+
+    def test_load(self):
+        """Are only replayable methods kept, oldest first?"""
+
+        self.assertEqual(len(load(self.log_path)), 4)
+        self.assertEqual(load(self.log_path, methods=('GET', 'POST'))[0]['ts'], 99)
+
+    def test_replay(self):
+        """Is latency reported per route, with errors counted?"""
+
+        app = make_app(os.path.join(tempfile.mkdtemp(), 'out.jsonl'), rate=0)
+        report = Replay(app, concurrency=2, speed=10).run(load(self.log_path))
+
+        rows = {row[0]: row for row in report.rows()}
+        self.assertEqual(rows['hello'][1:3], (3, 0))
+        self.assertEqual(rows['broken'][1:3], (1, 1))
+        self.assertEqual(rows['hello'][7], 5.0)
+        self.assertIn('hello', report.format())
+
+    def test_percentile(self):
+        """Does it use the nearest rank?"""
+
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 90), 7)
+        self.assertIsNone(percentile([], 50))
@@ -0,0 +1,162 @@
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import trending
+from trending import SlidingCountMin, TopK, Trends, terms, current
+
+NOW = 1700000000
+
+
+class TermsTestCase(TestCase):
+    """Test picking the terms out of a message."""
+
+    def test_terms(self):
+        self.assertEqual(
+            terms("Loving the #Python release, @alice! https://x.org"),
+            {'#python', 'loving', 'release'})
+
+    def test_once_per_message(self):
+        self.assertEqual(terms("cats cats CATS"), {'cats'})
+
+
+class SketchTestCase(TestCase):
+    """Test the sliding count-min sketch."""
+
+    def test_estimate(self):
+        """Are counts exact enough, and never under?"""
+
+        sketch = SlidingCountMin(300, 12)
+        for i in range(1000):
+            sketch.add(f"term{i}", NOW)
+        for _ in range(50):
+            sketch.add('popular', NOW)
+
+        self.assertGreaterEqual(sketch.estimate('popular', NOW), 50)
+        self.assertLess(sketch.estimate('popular', NOW), 55)
+        self.assertEqual(sketch.window(NOW).sum(), 4 * 1050)
+
+    def test_sliding(self):
+        """Do counts leave the window as it moves on?"""
+
+        sketch = SlidingCountMin(300, 12)
+        sketch.add('old', NOW)
+        sketch.add('new', NOW + 3000)
+
+        self.assertEqual(sketch.estimate('old', NOW + 3000), 1)
+        self.assertEqual(sketch.estimate('old', NOW + 3600), 0)
+        self.assertEqual(sketch.estimate('new', NOW + 3600), 1)
+
+    def test_too_old(self):
+        """Is a use older than the window ignored, not wrapped round?"""
+
+        sketch = SlidingCountMin(300, 12)
+        sketch.add('now', NOW)
+        sketch.add('then', NOW - 3600)
+
+        self.assertEqual(sketch.estimate('now', NOW), 1)
+        self.assertEqual(sketch.estimate('then', NOW), 0)
+
+
+class TopKTestCase(TestCase):
+    """Test the candidates heap."""
+
+    def test_evicts_lowest(self):
+        top = TopK(2)
+        top.offer('a', 1)
+        top.offer('b', 5)
+        top.offer('c', 3)
+        top.offer('d', 2)
+
+        self.assertEqual(top.counts, {'b': 5, 'c': 3})
+
+    def test_update(self):
+        """Does a raised count protect a term from eviction?"""
+
+        top = TopK(2)
+        top.offer('a', 1)
+        top.offer('b', 2)
+        top.offer('a', 4)
+        top.offer('c', 3)
+
+        self.assertEqual(top.counts, {'a': 4, 'c': 3})
+
+
+class TrendsTestCase(TestCase):
+    """Test trend scores and snapshots."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.trends = Trends()
+        self.trends.directory = self.directory
+        self.trends.interval = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_spike(self):
+        """Does a sudden term trend, and a steady one not?"""
+
+        for hours_ago in range(23, -1, -1):
+            for i in range(5):
+                self.trends.record("weather", NOW - hours_ago * 3600 - i)
+        for minutes_ago in range(10, 0, -1):
+            self.trends.record("the #eclipse", NOW - minutes_ago * 60)
+        self.trends.snapshot()
+
+        found = current(self.directory, now=NOW)
+        self.assertEqual([trend.term for trend in found], ['#eclipse'])
+        self.assertEqual(found[0].count, 10)
+
+    def test_workers_add_up(self):
+        """Are several workers' snapshots summed?"""
+
+        for _ in range(2):
+            self.trends.record("#eclipse", NOW)
+        self.trends.snapshot()
+        os.rename(self.trends.path, os.path.join(self.directory, '1.npz'))
+        self.trends.snapshot()
+
+        self.assertEqual(current(self.directory, now=NOW)[0].count, 4)
+
+    def test_resume(self):
+        """Does a worker restarted under the same pid carry on counting?"""
+
+        for _ in range(3):
+            self.trends.record("#eclipse", NOW)
+        self.trends.snapshot()
+
+        restarted = Trends()
+        restarted.directory = self.directory
+        restarted.interval = 0
+        restarted.record("#eclipse", NOW)
+
+        self.assertEqual(restarted.recent.estimate('#eclipse', NOW), 4)
+        self.assertIn('#eclipse', restarted.top.counts)
+
+    def test_expired_snapshot(self):
+        """Are snapshots older than the baseline window removed?"""
+
+        self.trends.record("#eclipse", NOW)
+        self.trends.snapshot()
+
+        self.assertEqual(current(self.directory, now=NOW + 2 * 86400), [])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_other_shape(self):
+        """Is a snapshot from differently sized sketches ignored?"""
+
+        self.trends.record("#eclipse", NOW)
+        self.trends.snapshot()
+
+        width = trending.WIDTH
+        trending.WIDTH = width * 2
+        try:
+            self.assertIsNone(trending.load(self.trends.path))
+        finally:
+            trending.WIDTH = width
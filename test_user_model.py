@@ -99,8 +99,8 @@ class UserModelTestCase(TestCase):
         db.session.commit()
 
         # User should have no messages & no followers
-        self.assertEqual(len(u.messages), 0)
-        self.assertEqual(len(u.followers), 0)
+        self.assertEqual(u.messages.count(), 0)
+        self.assertEqual(u.followers.count(), 0)
 
     def test_repr(self):
         """does __repr__ work?"""
@@ -140,6 +140,12 @@ class UserModelTestCase(TestCase):
         with self.assertRaises(exc.IntegrityError) as context:
             db.session.commit()
 
+    def test_username_case_taken(self):
+        """Is a username taken in another case refused?"""
+        User.signup("SampleUser", "other@test.com", "password", None)
+        with self.assertRaises(exc.IntegrityError):
+            db.session.commit()
+
     def test_failed_email_signup(self):
         """Will email fail?"""
         fail = User.signup("testtest", None, "password", None)
@@ -17,9 +17,21 @@
 
 
 import os
+import shutil
+import tempfile
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Follows
+import analytics
+import archive
+import images
+from ids import id_from_datetime
+from models import (db, connect_db, Message, User, Follows, Likes,
+                    Notification, UserStats)
+import notifications
+from notifications import notifier
+from purge import purger
+from querybudget import record_queries, budget_for
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -43,6 +55,15 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Query budgets are checked against uncached pages
+
+app.config['CACHE_ENABLED'] = False
+
+# deleted accounts are purged in the request, not behind the next test
+
+app.config['PURGE_ASYNC'] = False
+purger.init_app(app)
+
 
 class UserViewTestCase(TestCase):
     """Test views for messages."""
@@ -195,4 +216,228 @@ class UserViewTestCase(TestCase):
 
             print(like.status_code)
 
-            
\ No newline at end of file
+            
+
+    def assertWithinBudget(self, endpoint, queries):
+        """Did the request stay in its route's query budget, without N+1s?"""
+
+        self.assertEqual(queries.violations(budget_for(app, endpoint)), [])
+
+    def follow_many(self, count=6):
+        """Have testuser follow `count` new users (enough to show an N+1)."""
+
+        for i in range(count):
+            user = User.signup(f"followed{i}", f"followed{i}@test.com",
+                               "password", None)
+            db.session.flush()
+            db.session.add(Follows(user_following_id=self.testuser_id,
+                                   user_being_followed_id=user.id))
+        db.session.commit()
+
+    def test_list_users_queries(self):
+        """Does the user list check follows in one query, not one per card?"""
+
+        self.follow_many()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with record_queries() as queries:
+                resp = c.get("/users")
+                resp.get_data()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertWithinBudget('warbler.list_users', queries)
+
+    def test_show_following_queries(self):
+        """Does the following page stay within its query budget?"""
+
+        self.follow_many()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with record_queries() as queries:
+                resp = c.get(f"/users/{self.testuser_id}/following")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertWithinBudget('warbler.show_following', queries)
+
+    def test_user_likes_queries(self):
+        """Are liked messages loaded with their authors?"""
+
+        for i in range(6):
+            msg = Message(text=f"message {i}", user_id=self.u1_id)
+            db.session.add(msg)
+            db.session.flush()
+            db.session.add(Likes(user_id=self.testuser_id, message_id=msg.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with record_queries() as queries:
+                resp = c.get(f"/users/{self.testuser_id}/likes")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertWithinBudget('warbler.users_likes', queries)
+
+    def test_like_toggles(self):
+        """Can several users like one message, each once, and unlike it?"""
+
+        msg = Message(text="popular", user_id=self.u1_id)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add(Likes(user_id=self.u2_id, message_id=msg.id))
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/add_like/{msg_id}")
+            self.assertEqual(
+                Likes.query.filter_by(message_id=msg_id).count(), 2)
+
+            c.post(f"/users/add_like/{msg_id}")
+            self.assertFalse(Likes.exists(self.testuser_id, msg_id))
+            self.assertTrue(Likes.exists(self.u2_id, msg_id))
+
+    def test_follow_notifies(self):
+        """Does following someone notify them?"""
+
+        notifier.interval = 0  # write each notification straight away
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                c.post(f"/users/follow/{self.u1_id}")
+        finally:
+            notifier.interval = app.config['NOTIFICATIONS_INTERVAL']
+
+        notification = Notification.query.filter_by(user_id=self.u1_id).one()
+        self.assertEqual(notification.kind, 'follow')
+        self.assertEqual(notification.actor_ids, [self.testuser_id])
+        self.assertEqual(User.query.get(self.u1_id).unread_notifications, 1)
+
+    def test_like_notification_counts_people(self):
+        """Does liking again in a later flush count the same person once?"""
+
+        msg = Message(text="likeable", user_id=self.u1_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        notifier.interval = 0  # every like is its own flush
+        try:
+            with self.client as c:
+                for user_id in (self.testuser_id, self.testuser_id,
+                                self.testuser_id, self.u2_id):
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = user_id
+                    # like, unlike, like again; then someone else
+                    c.post(f"/users/add_like/{msg_id}")
+        finally:
+            notifier.interval = app.config['NOTIFICATIONS_INTERVAL']
+
+        notification = Notification.query.filter_by(user_id=self.u1_id).one()
+        self.assertEqual(notification.count, 2)
+        self.assertEqual(notification.actor_ids, [self.u2_id, self.testuser_id])
+
+    def test_like_notification_stays_small(self):
+        """Does a row keep only the newest actors, while counting them all?"""
+
+        notifier.interval = 0
+        try:
+            for actor_id in (1, 2, 3, 4, 5, 4):
+                notifier.notify(notifications.LIKE, self.u1_id, actor_id, 42)
+        finally:
+            notifier.interval = app.config['NOTIFICATIONS_INTERVAL']
+
+        notification = Notification.query.filter_by(user_id=self.u1_id).one()
+        self.assertEqual(notification.count, 5)
+        self.assertEqual(notification.actor_ids, [4, 5, 3])
+
+    def test_show_archived_messages(self):
+        """Does a profile read through to archived messages?"""
+
+        directory = tempfile.mkdtemp()
+        app.config['ARCHIVE_DIR'] = directory
+        try:
+            when = datetime(2019, 5, 1)
+            archive.store(directory).add_month(2019, 5, [
+                (self.testuser_id, id_from_datetime(when, 1),
+                 archive.to_micros(when), "from the archive")])
+
+            db.session.add(Message(text="still hot", user_id=self.testuser_id))
+            db.session.commit()
+
+            with self.client as c:
+                resp = c.get(f"/users/{self.testuser_id}")
+                html = resp.get_data(as_text=True)
+
+            self.assertIn("still hot", html)
+            self.assertIn("from the archive", html)
+            self.assertLess(html.index("still hot"),
+                            html.index("from the archive"))
+        finally:
+            app.config['ARCHIVE_DIR'] = archive.ARCHIVE_DIR
+            shutil.rmtree(directory)
+
+    def test_media_cache_headers(self):
+        """Is the original served briefly cached until its variant exists?"""
+
+        digest = 'ab' * 32
+        media_dir = tempfile.mkdtemp()
+        app.config['MEDIA_DIR'] = media_dir
+        try:
+            directory = images.image_dir(digest, media_dir)
+            os.makedirs(directory)
+            for name in ('original.png', 'card.jpg'):
+                with open(os.path.join(directory, name), 'wb') as f:
+                    f.write(name.encode())
+
+            with self.client as c:
+                resp = c.get(f"/media/{digest}/hero.jpg")
+                self.assertEqual(resp.get_data(), b"original.png")
+                self.assertEqual(resp.headers['Cache-Control'],
+                                 'public, max-age=60')
+                resp.close()
+
+                resp = c.get(f"/media/{digest}/card.jpg")
+                self.assertEqual(resp.get_data(), b"card.jpg")
+                self.assertIn('immutable', resp.headers['Cache-Control'])
+                resp.close()
+
+                self.assertEqual(c.get("/media/not-a-digest/card.jpg")
+                                 .status_code, 404)
+        finally:
+            app.config['MEDIA_DIR'] = images.MEDIA_DIR
+            shutil.rmtree(media_dir)
+
+    def test_user_stats(self):
+        """Does the stats page show what the analytics job computed?"""
+
+        for i in range(3):
+            db.session.add(Message(text=f"post {i}", user_id=self.testuser_id))
+        db.session.add(Follows(user_following_id=self.u1_id,
+                               user_being_followed_id=self.testuser_id))
+        db.session.commit()
+
+        analytics.run(db.engine)
+
+        with self.client as c:
+            with record_queries() as queries:
+                resp = c.get(f"/users/{self.testuser_id}/stats")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Messages by hour of day", resp.get_data(as_text=True))
+        self.assertWithinBudget('warbler.users_stats', queries)
+
+        stats = UserStats.query.get(self.testuser_id)
+        self.assertEqual((stats.messages, stats.followers[-1]), (3, 1))
@@ -0,0 +1,98 @@
+# run these tests like:
+#
+#    python -m unittest test_write_behind.py
+
+import os
+from unittest import TestCase
+
+from write_behind import WriteBehindBuffer, LIKE, FOLLOW
+
+
+class WriteBehindTestCase(TestCase):
+    """Test coalescing of buffered like/follow changes."""
+
+    def setUp(self):
+        self.buffer = WriteBehindBuffer()
+
+        # pretend this process's flush thread is already running, so
+        # nothing here touches the database
+        self.buffer._flusher_pid = os.getpid()
+
+    def test_opposites_cancel(self):
+        """Does like-then-unlike leave nothing to write?"""
+
+        self.buffer.record(LIKE, 1, 10, True)
+        self.buffer.record(LIKE, 1, 10, False)
+
+        self.assertFalse(self.buffer.has_pending(LIKE, 1))
+        self.assertEqual(self.buffer.metrics()['cancelled'], 2)
+        self.assertEqual(self.buffer.metrics()['pending'], 0)
+
+    def test_state_prefers_pending(self):
+        """Is a pending change seen before the database?"""
+
+        self.buffer.record(FOLLOW, 1, 2, True)
+
+        self.assertTrue(self.buffer.state(FOLLOW, 1, 2, lambda: False))
+        self.assertFalse(self.buffer.state(FOLLOW, 1, 3, lambda: False))
+
+    def test_overlay(self):
+        """Are pending changes applied to ids read from the database?"""
+
+        self.buffer.record(LIKE, 1, 10, True)
+        self.buffer.record(LIKE, 1, 11, False)
+        self.buffer.record(LIKE, 2, 12, True)
+
+        self.assertEqual(self.buffer.overlay(LIKE, 1, [11, 13]), {10, 13})
+
+    def test_in_flight_still_read(self):
+        """Are changes being written still seen until they land?"""
+
+        self.buffer.record(LIKE, 1, 10, True)
+        self.buffer.record(LIKE, 1, 11, False)
+        seen = []
+
+        def write(pending):
+            seen.append((self.buffer.state(LIKE, 1, 10, lambda: False),
+                         self.buffer.overlay(LIKE, 1, [11]),
+                         self.buffer.has_pending(LIKE, 1),
+                         self.buffer.metrics()['in_flight']))
+            # meanwhile, the user likes 11 again
+            self.buffer.record(LIKE, 1, 11, True)
+            self.assertEqual(self.buffer.overlay(LIKE, 1, []), {10, 11})
+            self.buffer._requeue(pending)
+
+        self.buffer._write = write
+        self.buffer.flush()
+
+        self.assertEqual(seen, [(True, {10}, True, 2)])
+        self.assertEqual(self.buffer.metrics()['in_flight'], 0)
+        # the requeued unlike of 11 was reversed since
+        self.assertEqual(self.buffer.overlay(LIKE, 1, [11]), {10, 11})
+
+    def test_requeue_after_failure(self):
+        """Does a failed write keep changes that weren't reversed since?"""
+
+        self.buffer.record(LIKE, 1, 10, True)
+        self.buffer.record(LIKE, 1, 11, True)
+        pending, self.buffer._pending, self.buffer._size = self.buffer._pending, {}, 0
+
+        # while the write was failing, the user unliked message 11
+        self.buffer.record(LIKE, 1, 11, False)
+        self.buffer._requeue(pending)
+
+        self.assertEqual(self.buffer.overlay(LIKE, 1, []), {10})
+        self.assertEqual(self.buffer.metrics()['pending'], 1)
+
+    def test_requeue_same_change(self):
+        """Does a change recorded again during a failed write survive?"""
+
+        self.buffer.record(LIKE, 1, 10, True)
+        pending, self.buffer._pending, self.buffer._size = self.buffer._pending, {}, 0
+
+        # the database didn't have the like yet, so it was recorded again
+        self.buffer.record(LIKE, 1, 10, True)
+        self.buffer._requeue(pending)
+
+        self.assertEqual(self.buffer.overlay(LIKE, 1, []), {10})
+        self.assertEqual(self.buffer.metrics()['pending'], 1)
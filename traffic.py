@@ -0,0 +1,296 @@
+"""Capture live traffic to a JSONL request log, and replay it.
+
+With TRAFFIC_CAPTURE_RATE above 0 (0 to 1, default 0), that fraction of
+requests is appended to TRAFFIC_LOG, one JSON object per line:
+
+    {"ts": 1760000000.123, "method": "GET", "path": "/?before=123",
+     "endpoint": "warbler.homepage", "user_id": 12, "status": 200,
+     "duration_ms": 41.7}
+
+Only the request line and who made it are kept, never bodies or cookies.
+The duration runs until the response has been sent, streamed bodies
+included.
+
+The replay engine runs a log against a local app (seeded with matching
+data) and reports latency percentiles per route:
+
+    python traffic.py logs/requests.jsonl --concurrency 8 --speed 10
+
+Requests are sent at their original spacing divided by `--speed`, or as
+fast as the workers allow with `--no-pace`. Each request is sent as the
+user who made it.
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, request
+
+TRAFFIC_LOG = os.path.join('logs', 'requests.jsonl')
+
+
+class TrafficCapture:
+    """Flask extension logging a sample of requests as JSONL."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_pid = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRAFFIC_CAPTURE_RATE', 0.0)
+        app.config.setdefault('TRAFFIC_LOG', TRAFFIC_LOG)
+
+        self.app = app
+
+        if app.config['TRAFFIC_CAPTURE_RATE'] > 0:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+
+    def _before_request(self):
+        if random.random() < self.app.config['TRAFFIC_CAPTURE_RATE']:
+            g._traffic_started = (time.time(), time.perf_counter())
+
+    def _after_request(self, response):
+        started = g.pop('_traffic_started', None)
+        if started is None:
+            return response
+
+        ts, t0 = started
+        user = getattr(g, 'user', None)
+        record = {
+            'ts': round(ts, 3),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'user_id': user.id if user is not None else None,
+            'status': response.status_code,
+        }
+
+        # streamed bodies are still being produced; time until sent
+        def finish():
+            record['duration_ms'] = round((time.perf_counter() - t0) * 1000, 2)
+            self._write(record)
+
+        response.call_on_close(finish)
+        return response
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+
+        try:
+            with self._lock:
+                # files don't survive fork cleanly; reopen per process
+                if self._file is None or self._file_pid != os.getpid():
+                    path = self.app.config['TRAFFIC_LOG']
+                    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                    self._file = open(path, 'a', buffering=1)
+                    self._file_pid = os.getpid()
+                self._file.write(line)
+        except OSError:
+            self.app.logger.exception("could not write traffic log")
+
+
+traffic = TrafficCapture()
+
+
+##############################################################################
+# Replay
+
+
+def load(path, methods=('GET',), limit=None):
+    """Captured requests from `path`, oldest first.
+
+    Only `methods` are kept: other requests need bodies, which aren't
+    captured.
+    """
+
+    records = []
+
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if methods and record['method'] not in methods:
+                continue
+            records.append(record)
+
+    records.sort(key=lambda record: record['ts'])
+    return records[:limit] if limit else records
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def login_as(client, user_id):
+    """Make `client` send requests as `user_id` (None: logged out)."""
+
+    from app import CURR_USER_KEY
+
+    with client.session_transaction() as sess:
+        if user_id is None:
+            sess.pop(CURR_USER_KEY, None)
+        else:
+            sess[CURR_USER_KEY] = user_id
+
+
+class Replay:
+    """Replays captured requests against an app's test client."""
+
+    def __init__(self, app, concurrency=4, speed=1.0, pace=True,
+                 login=login_as):
+        self.app = app
+        self.concurrency = concurrency
+        self.speed = speed
+        self.pace = pace
+        self.login = login
+        self._local = threading.local()
+
+    def _client(self, user_id):
+        # one client per worker thread and user, so sessions stay put
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+
+        if user_id not in clients:
+            client = clients[user_id] = self.app.test_client()
+            if user_id is not None:
+                self.login(client, user_id)
+
+        return clients[user_id]
+
+    def _send(self, record, due):
+        lag = 0.0
+        if due is not None:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lag = -delay
+
+        client = self._client(record.get('user_id'))
+
+        started = time.perf_counter()
+        resp = client.open(record['path'], method=record['method'])
+        resp.get_data()
+        resp.close()
+        elapsed = time.perf_counter() - started
+
+        return record, resp.status_code, elapsed, lag
+
+    def run(self, records):
+        """Replay `records`; returns a ReplayReport."""
+
+        report = ReplayReport()
+        if not records:
+            return report
+
+        first = records[0]['ts']
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = []
+            for record in records:
+                due = None
+                if self.pace:
+                    due = start + (record['ts'] - first) / self.speed
+                futures.append(pool.submit(self._send, record, due))
+
+            for future in futures:
+                report.add(*future.result())
+
+        report.elapsed = time.perf_counter() - start
+        return report
+
+
+class ReplayReport:
+    """Latency of replayed requests, per route."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.captured = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.max_lag = 0.0
+        self.elapsed = 0.0
+
+    def add(self, record, status, elapsed, lag):
+        route = record.get('endpoint') or record['path'].split('?')[0]
+        self.latencies[route].append(elapsed * 1000)
+        if record.get('duration_ms') is not None:
+            self.captured[route].append(record['duration_ms'])
+        if status >= 500:
+            self.errors[route] += 1
+        self.max_lag = max(self.max_lag, lag)
+
+    def rows(self):
+        """(route, count, errors, p50, p90, p99, max, captured p50) rows."""
+
+        rows = []
+
+        for route, values in self.latencies.items():
+            values = sorted(values)
+            captured = sorted(self.captured[route])
+            rows.append((route, len(values), self.errors[route],
+                         percentile(values, 50), percentile(values, 90),
+                         percentile(values, 99), values[-1],
+                         percentile(captured, 50)))
+
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows
+
+    def format(self):
+        lines = [f"{'route':32} {'count':>6} {'5xx':>4} {'p50':>8} {'p90':>8} "
+                 f"{'p99':>8} {'max':>8} {'live p50':>9}"]
+
+        for route, count, errors, p50, p90, p99, worst, live in self.rows():
+            live = f"{live:9.1f}" if live is not None else f"{'-':>9}"
+            lines.append(f"{route[:32]:32} {count:6d} {errors:4d} {p50:8.1f} "
+                         f"{p90:8.1f} {p99:8.1f} {worst:8.1f} {live}")
+
+        total = sum(len(values) for values in self.latencies.values())
+        lines.append(f"{total} requests in {self.elapsed:.1f}s "
+                     f"(fell behind schedule by up to {self.max_lag * 1000:.0f} ms)")
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Replay a captured request log against a local app.")
+    parser.add_argument('log', nargs='?', default=TRAFFIC_LOG)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay this many times faster than captured")
+    parser.add_argument('--no-pace', dest='pace', action='store_false',
+                        help="send requests as fast as workers allow")
+    parser.add_argument('--methods', default='GET',
+                        help="comma-separated methods to replay")
+    parser.add_argument('--limit', type=int)
+    args = parser.parse_args()
+
+    from app import create_app
+
+    records = load(args.log, methods=args.methods.upper().split(','),
+                   limit=args.limit)
+    replay = Replay(create_app({'WTF_CSRF_ENABLED': False}),
+                    concurrency=args.concurrency, speed=args.speed,
+                    pace=args.pace)
+    print(replay.run(records).format())
@@ -0,0 +1,430 @@
+"""Trending words and #tags, counted as messages are posted.
+
+messages_add() hands each new message's text to `trends.record`, which
+counts its terms (words and #tags, once per message) in two sliding
+count-min sketches:
+
+    recent      the last hour, in 5-minute buckets
+    baseline    the last day, in hourly buckets
+
+Memory is fixed by the sketches' shape, however many distinct terms
+there are. A sketch can only answer "how often was this term seen", so
+each worker also keeps the CANDIDATES terms with the highest recent
+counts in a heap; they are re-counted whenever the window moves on, so
+yesterday's spike doesn't hold its place.
+
+A term trends when its rate over the last hour is well above its rate
+over the day:
+
+    score = (recent per hour + PRIOR) / (baseline per hour + PRIOR)
+
+PRIOR keeps a couple of mentions of a rare word from topping the list.
+
+Every TRENDS_INTERVAL seconds each worker writes its sketches and
+candidates to TRENDS_DIR/<pid>.npz. Sketches of the same shape add up,
+so `current()` sums every worker's file for the site-wide picture, and
+a worker restarted under the same pid picks up where its file left off.
+Files whose newest bucket has left the baseline window are deleted.
+Trends are per host unless TRENDS_DIR is shared.
+"""
+
+import atexit
+import glob
+import hashlib
+import heapq
+import os
+import re
+import threading
+import time
+import zipfile
+from collections import Counter, namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+from tags import extract_tags
+
+TRENDS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'trends')
+
+WIDTH = 2048
+DEPTH = 4
+
+# (seconds per bucket, buckets)
+RECENT = (300, 12)
+BASELINE = (3600, 24)
+
+# terms each worker follows closely
+CANDIDATES = 100
+TOP_K = 10
+
+# fewest uses in the recent window for a term to trend
+MIN_COUNT = 3
+# uses per hour added to both rates
+PRIOR = 1.0
+
+HOUR = 3600
+
+# a bare word: letters first, not part of a #tag, @mention or URL path
+WORD_RE = re.compile(r"(?<![\w#@/.])([^\W\d_][\w']{2,})")
+
+STOPWORDS = frozenset("""
+    about after again all also and any are because been before being but
+    can could did does doing don't down for from get got had has have
+    her here hers him his how http https i'm into its it's just like
+    more most not now off once only other our out over own same she
+    should some such than that that's the their them then there these
+    they this those through too under until very was were what when
+    where which while who whom why will with would www you you're your
+    yours
+""".split())
+
+Trend = namedtuple('Trend', 'term count score')
+
+
+def terms(text):
+    """The distinct #tags and words in `text` worth counting."""
+
+    found = {tag for tag in extract_tags(text) if tag.startswith('#')}
+    found.update(word for word in (w.lower() for w in WORD_RE.findall(text))
+                 if word not in STOPWORDS)
+    return found
+
+
+@lru_cache(maxsize=65536)
+def columns(term, width=WIDTH, depth=DEPTH):
+    """The column `term` counts in, in each of a sketch's `depth` rows.
+
+    Two 64-bit halves of one hash, combined as h1 + i * h2 (Kirsch and
+    Mitzenmacher), stand in for `depth` independent hashes. Stable
+    across processes, unlike hash().
+    """
+
+    digest = hashlib.blake2b(term.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return tuple((h1 + i * h2) % width for i in range(depth))
+
+
+class SlidingCountMin:
+    """A count-min sketch over the last `buckets` x `bucket_seconds`.
+
+    One (depth, width) counter array per bucket, reused in a ring: a
+    bucket is zeroed when time comes round to it again. Estimates never
+    undercount; they overcount by at most a few uses in WIDTH of the
+    window's total.
+    """
+
+    def __init__(self, bucket_seconds, buckets, width=WIDTH, depth=DEPTH):
+        self.bucket_seconds = bucket_seconds
+        self.width = width
+        self.depth = depth
+
+        self.counts = np.zeros((buckets, depth, width), dtype=np.int32)
+        # which bucket (time // bucket_seconds) each slot holds; -1: none
+        self.epochs = np.full(buckets, -1, dtype=np.int64)
+
+    @property
+    def buckets(self):
+        return len(self.epochs)
+
+    @property
+    def hours(self):
+        return self.buckets * self.bucket_seconds / HOUR
+
+    def _slot(self, now):
+        """The slot for `now`, or None if `now` is older than the window."""
+
+        bucket = int(now // self.bucket_seconds)
+        slot = bucket % self.buckets
+        if self.epochs[slot] > bucket:
+            return None
+        if self.epochs[slot] != bucket:
+            self.counts[slot] = 0
+            self.epochs[slot] = bucket
+        return slot
+
+    def live(self, now):
+        """Mask of the slots inside the window ending at `now`."""
+
+        return live(self.epochs, self.bucket_seconds, now)
+
+    def add(self, term, now, count=1):
+        slot = self._slot(now)
+        if slot is None:
+            return
+        self.counts[slot, np.arange(self.depth),
+                    list(columns(term, self.width, self.depth))] += count
+
+    def estimate(self, term, now):
+        # (buckets, depth): the term's cells only, then the live buckets
+        cells = self.counts[:, np.arange(self.depth),
+                            list(columns(term, self.width, self.depth))]
+        return int(cells[self.live(now)].sum(axis=0).min())
+
+    def window(self, now):
+        """(depth, width) counts of the whole window ending at `now`."""
+
+        return self.counts[self.live(now)].sum(axis=0)
+
+
+def live(epochs, bucket_seconds, now):
+    bucket = int(now // bucket_seconds)
+    return (epochs > bucket - len(epochs)) & (epochs <= bucket)
+
+
+def estimates(window, candidates):
+    """Count-min estimates of each of `candidates` from `window` counts."""
+
+    depth, width = window.shape
+    cols = np.array([columns(term, width, depth) for term in candidates],
+                    dtype=np.int64).reshape(-1, depth)
+    return window[np.arange(depth), cols].min(axis=1)
+
+
+class TopK:
+    """The `size` terms offered with the highest counts.
+
+    A min-heap of (count, term) finds the one to evict. Updating a
+    term pushes a new entry rather than searching the heap; entries
+    that no longer match `counts` are skipped when they surface.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = {}
+        self._heap = []
+
+    def offer(self, term, count):
+        if term not in self.counts and len(self.counts) >= self.size:
+            lowest, lowest_term = self._lowest()
+            if count <= lowest:
+                return
+            heapq.heappop(self._heap)
+            del self.counts[lowest_term]
+
+        self.counts[term] = count
+        heapq.heappush(self._heap, (count, term))
+
+        if len(self._heap) > 4 * self.size:
+            self.reset(self.counts)
+
+    def _lowest(self):
+        while True:
+            count, term = self._heap[0]
+            if self.counts.get(term) == count:
+                return count, term
+            heapq.heappop(self._heap)
+
+    def reset(self, counts):
+        """Replace every count, e.g. after re-counting them all."""
+
+        self.counts = dict(counts)
+        self._heap = [(count, term) for term, count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class Trends:
+    """This worker's sketches and candidates, and their snapshots."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.directory = TRENDS_DIR
+        self.interval = 30.0
+        self._lock = threading.Lock()
+        self._pid = None
+        # the recent bucket the candidates were last re-counted in
+        self._bucket = None
+        self.stats = Counter()
+
+        self.recent = SlidingCountMin(*RECENT)
+        self.baseline = SlidingCountMin(*BASELINE)
+        self.top = TopK(CANDIDATES)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRENDS_DIR', TRENDS_DIR)
+        app.config.setdefault('TRENDS_INTERVAL', 30.0)
+
+        self.app = app
+        self.directory = app.config['TRENDS_DIR']
+        self.interval = app.config['TRENDS_INTERVAL']
+
+        atexit.register(self.snapshot)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"{os.getpid()}.npz")
+
+    def _start(self):
+        """Resume this pid's snapshot and start the snapshot thread, once
+        per process (threads don't survive fork)."""
+
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._resume()
+
+        if self.interval:
+            thread = threading.Thread(target=self._run_snapshots,
+                                      name='trends', daemon=True)
+            thread.start()
+
+    def _run_snapshots(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.snapshot()
+            except Exception:
+                self.app.logger.exception("trends snapshot failed")
+
+    def record(self, text, now=None):
+        """Count the terms of one new message."""
+
+        found = terms(text)
+        if not found:
+            return
+
+        now = now if now is not None else time.time()
+
+        with self._lock:
+            self._start()
+            self._recount(now)
+
+            for term in found:
+                self.recent.add(term, now)
+                self.baseline.add(term, now)
+                self.top.offer(term, self.recent.estimate(term, now))
+
+            self.stats['messages'] += 1
+            self.stats['terms'] += len(found)
+
+    def _recount(self, now):
+        """Re-count the candidates once the recent window has moved on."""
+
+        bucket = int(now // self.recent.bucket_seconds)
+        if bucket == self._bucket:
+            return
+
+        self._bucket = bucket
+        candidates = list(self.top.counts)
+        if candidates:
+            counts = estimates(self.recent.window(now), candidates)
+            self.top.reset(zip(candidates, counts.tolist()))
+
+    def snapshot(self):
+        """Write this worker's state to its file in the trends directory."""
+
+        if self._pid != os.getpid():
+            # nothing recorded in this process
+            return
+
+        with self._lock:
+            state = {'meta': np.array([WIDTH, DEPTH, *RECENT, *BASELINE]),
+                     'recent': self.recent.counts.copy(),
+                     'recent_epochs': self.recent.epochs.copy(),
+                     'baseline': self.baseline.counts.copy(),
+                     'baseline_epochs': self.baseline.epochs.copy(),
+                     'candidates': np.array(sorted(self.top.counts),
+                                            dtype=str)}
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **state)
+        os.replace(path + '.tmp', path)
+
+        self.stats['snapshots'] += 1
+
+    def _resume(self):
+        state = load(self.path)
+        if state is None:
+            return
+
+        self.recent.counts = state['recent']
+        self.recent.epochs = state['recent_epochs']
+        self.baseline.counts = state['baseline']
+        self.baseline.epochs = state['baseline_epochs']
+        # counts are filled in by the first _recount
+        self.top.reset({term: 0 for term in state['candidates'].tolist()})
+        self._bucket = None
+
+    def current(self, limit=TOP_K, now=None):
+        return current(self.directory, limit, now)
+
+    def metrics(self):
+        return dict(self.stats, candidates=len(self.top),
+                    sketch_bytes=self.recent.counts.nbytes
+                    + self.baseline.counts.nbytes)
+
+
+def load(path):
+    """The arrays saved at `path`, or None if it's missing or of another
+    shape (the constants above changed)."""
+
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            state = {name: data[name] for name in data.files}
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return None
+
+    if 'meta' not in state or state['meta'].tolist() != [WIDTH, DEPTH, *RECENT, *BASELINE]:
+        return None
+    return state
+
+
+def current(directory=TRENDS_DIR, limit=TOP_K, now=None):
+    """Up to `limit` Trends, highest score first, from every snapshot in
+    `directory`."""
+
+    now = now if now is not None else time.time()
+
+    recent = np.zeros((DEPTH, WIDTH), dtype=np.int64)
+    baseline = np.zeros((DEPTH, WIDTH), dtype=np.int64)
+    candidates = set()
+
+    for path in glob.glob(os.path.join(directory, '*.npz')):
+        state = load(path)
+        if state is None:
+            continue
+
+        in_baseline = live(state['baseline_epochs'], BASELINE[0], now)
+        if not in_baseline.any():
+            # a worker long gone
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+
+        recent += state['recent'][
+            live(state['recent_epochs'], RECENT[0], now)].sum(axis=0)
+        baseline += state['baseline'][in_baseline].sum(axis=0)
+        candidates.update(state['candidates'].tolist())
+
+    if not candidates:
+        return []
+
+    candidates = sorted(candidates)
+    recent_counts = estimates(recent, candidates)
+    baseline_counts = estimates(baseline, candidates)
+
+    recent_hours = RECENT[0] * RECENT[1] / HOUR
+    baseline_hours = BASELINE[0] * BASELINE[1] / HOUR
+    scores = ((recent_counts / recent_hours + PRIOR)
+              / (baseline_counts / baseline_hours + PRIOR))
+
+    trending = [Trend(term, int(count), float(score))
+                for term, count, score
+                in zip(candidates, recent_counts, scores)
+                if count >= MIN_COUNT and score > 1]
+    return heapq.nlargest(limit, trending, key=lambda trend: trend.score)
+
+
+trends = Trends()
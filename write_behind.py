@@ -0,0 +1,344 @@
+"""Write-behind buffering of like and follow changes.
+
+With WRITE_BEHIND enabled, the like/follow routes don't commit each change.
+They record it here, in this worker's memory, and a background thread
+writes all pending changes every WRITE_BEHIND_INTERVAL seconds, as one
+multi-row INSERT and one multi-row DELETE per table.
+
+Changes are coalesced by (kind, user, target). Only real state changes are
+recorded, so an opposite pair (like then unlike) cancels out and never
+reaches the database.
+
+Callers only record likes of messages that exist, but one may be
+deleted before the flush; changes the database refuses are dropped (see
+`_write`) rather than holding up everyone else's.
+
+Durability: a change is in memory for at most WRITE_BEHIND_INTERVAL
+seconds, or until WRITE_BEHIND_MAX_PENDING changes are waiting, whichever
+comes first. Pending changes are flushed at interpreter exit. A crashed
+worker loses at most one interval's worth.
+
+Read-your-writes: `state()` and `overlay()` answer from pending changes
+first, then from changes being written (popped by a flush but not yet
+committed), and `flush_user()` pushes one user's changes out before a
+page lists their collection.
+"""
+
+import atexit
+import os
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Follows, Likes
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+# kind -> (table, column holding the acting user, column holding the target)
+TABLES = {
+    LIKE: (Likes.__table__, 'user_id', 'message_id'),
+    FOLLOW: (Follows.__table__, 'user_following_id', 'user_being_followed_id'),
+}
+
+
+class WriteBehindBuffer:
+    """Per-worker buffer of pending like/follow changes."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.interval = 0.5
+        self.max_pending = 5000
+        self._lock = threading.Lock()
+        # (kind, user_id) -> {target_id: True to add / False to remove}
+        self._pending = {}
+        self._size = 0
+        # batches popped by a flush and not yet committed (or put back),
+        # oldest first; same shape as _pending
+        self._in_flight = []
+        self._flusher_pid = None
+        self.stats = Counter()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('WRITE_BEHIND', False)
+        app.config.setdefault('WRITE_BEHIND_INTERVAL', 0.5)
+        app.config.setdefault('WRITE_BEHIND_MAX_PENDING', 5000)
+
+        self.app = app
+        self.enabled = app.config['WRITE_BEHIND']
+        self.interval = app.config['WRITE_BEHIND_INTERVAL']
+        self.max_pending = app.config['WRITE_BEHIND_MAX_PENDING']
+
+        if self.enabled:
+            atexit.register(self.flush)
+
+    def _start_flusher(self):
+        """Start this process's flush thread (threads don't survive fork)."""
+
+        if self._flusher_pid == os.getpid():
+            return
+
+        self._flusher_pid = os.getpid()
+        thread = threading.Thread(target=self._run_flusher,
+                                  name='write-behind', daemon=True)
+        thread.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("write-behind flush failed")
+
+    ##########################################################################
+    # Recording and reading changes
+
+    def state(self, kind, user_id, target_id, lookup):
+        """Does the like/follow exist, counting pending changes?
+
+        `lookup` is called to ask the database only if nothing is pending
+        or being written.
+        """
+
+        key = (kind, user_id)
+        with self._lock:
+            pending = self._pending.get(key, {}).get(target_id)
+            for batch in reversed(self._in_flight):
+                if pending is not None:
+                    break
+                pending = batch.get(key, {}).get(target_id)
+
+        return lookup() if pending is None else pending
+
+    def record(self, kind, user_id, target_id, add):
+        """Record a change of state (callers check it is a change)."""
+
+        with self._lock:
+            self._start_flusher()
+            self.stats['intents'] += 1
+
+            targets = self._pending.setdefault((kind, user_id), {})
+            if target_id in targets:
+                # the pending change is the opposite one: both cancel out
+                del targets[target_id]
+                self._size -= 1
+                self.stats['cancelled'] += 2
+            else:
+                targets[target_id] = add
+                self._size += 1
+
+            full = self._size >= self.max_pending
+
+        if full:
+            self.flush()
+
+    def overlay(self, kind, user_id, target_ids):
+        """Apply `user_id`'s pending changes to ids read from the database."""
+
+        key = (kind, user_id)
+        with self._lock:
+            # oldest first, so later changes win
+            layers = [dict(batch.get(key, {})) for batch in self._in_flight]
+            layers.append(dict(self._pending.get(key, {})))
+
+        result = set(target_ids)
+        for targets in layers:
+            for target_id, add in targets.items():
+                if add:
+                    result.add(target_id)
+                else:
+                    result.discard(target_id)
+
+        return result
+
+    def has_pending(self, kind, user_id):
+        """Are any of `user_id`'s changes of this kind still in memory?"""
+
+        key = (kind, user_id)
+        with self._lock:
+            return (bool(self._pending.get(key))
+                    or any(batch.get(key) for batch in self._in_flight))
+
+    ##########################################################################
+    # Flushing
+
+    def flush_user(self, kind, user_id):
+        """Write out one user's pending changes of one kind now."""
+
+        with self._lock:
+            targets = self._pending.pop((kind, user_id), {})
+            self._size -= len(targets)
+            batch = {(kind, user_id): targets}
+            if targets:
+                self._in_flight.append(batch)
+
+        if targets:
+            self._write(batch)
+
+    def flush(self):
+        """Write out every pending change."""
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._size = 0
+            if pending:
+                self._in_flight.append(pending)
+
+        if pending:
+            self._write(pending)
+
+    def _write(self, pending):
+        """Write `pending` changes; on failure put back what wasn't redone.
+
+        `pending` stays in `_in_flight` until it is committed or put back.
+
+        A change the database refuses (a like of a message deleted since)
+        would fail the whole batch, again on every retry: if the batch
+        breaks a constraint, each change is tried on its own instead, and
+        those refused are dropped.
+        """
+
+        start = time.perf_counter()
+
+        try:
+            with self.app.app_context(), db.engine.begin() as conn:
+                rows = self._execute(conn, pending)
+        except IntegrityError:
+            rows = self._write_each(pending)
+        except Exception:
+            self._requeue(pending)
+            raise
+
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self._landed(pending)
+            self.stats['flushes'] += 1
+            self.stats['rows_written'] += rows
+            self.stats['flush_seconds'] += elapsed
+            self.stats['max_flush_seconds'] = max(
+                self.stats['max_flush_seconds'], elapsed)
+
+    def _write_each(self, pending):
+        """Write `pending` a change at a time, each under a savepoint,
+        dropping those that break a constraint; returns rows written."""
+
+        rows = 0
+        dropped = []
+
+        try:
+            with self.app.app_context(), db.engine.begin() as conn:
+                for (kind, user_id), targets in pending.items():
+                    for target_id, add in targets.items():
+                        try:
+                            with conn.begin_nested():
+                                rows += self._execute(
+                                    conn, {(kind, user_id): {target_id: add}})
+                        except IntegrityError:
+                            dropped.append((kind, user_id, target_id))
+        except Exception:
+            self._requeue(pending)
+            raise
+
+        if dropped:
+            self.app.logger.warning("write-behind dropped %d changes the "
+                                    "database refused: %r",
+                                    len(dropped), dropped[:10])
+            with self._lock:
+                self.stats['dropped'] += len(dropped)
+
+        return rows
+
+    def _execute(self, conn, pending):
+        """Run the INSERTs and DELETEs for `pending`; returns the rows."""
+
+        rows = 0
+        for kind, (table, user_col, target_col) in TABLES.items():
+            adds = []
+            removes = []
+            for (k, user_id), targets in pending.items():
+                if k != kind:
+                    continue
+                for target_id, add in targets.items():
+                    if add:
+                        adds.append({user_col: user_id,
+                                     target_col: target_id})
+                    else:
+                        removes.append((user_id, target_id))
+
+            if adds:
+                conn.execute(insert(table)
+                             .values(adds)
+                             .on_conflict_do_nothing())
+            if removes:
+                conn.execute(table.delete().where(
+                    tuple_(table.c[user_col], table.c[target_col])
+                    .in_(removes)))
+
+            rows += len(adds) + len(removes)
+
+        return rows
+
+    def _requeue(self, pending):
+        """Merge unwritten changes back under any recorded since."""
+
+        with self._lock:
+            self._landed(pending)
+            for key, targets in pending.items():
+                current = self._pending.setdefault(key, {})
+                for target_id, add in targets.items():
+                    if target_id not in current:
+                        current[target_id] = add
+                        self._size += 1
+                    elif current[target_id] != add:
+                        # a newer change reversed this one in the meantime
+                        del current[target_id]
+                        self._size -= 1
+                    # else the same change was recorded again
+
+    def _landed(self, pending):
+        """Stop reading `pending` as in flight (call with the lock held)."""
+
+        self._in_flight = [batch for batch in self._in_flight
+                           if batch is not pending]
+
+    def metrics(self):
+        """Counters for the metrics endpoint."""
+
+        with self._lock:
+            stats = dict(self.stats)
+            pending = self._size
+            in_flight = sum(len(targets) for batch in self._in_flight
+                            for targets in batch.values())
+
+        intents = stats.get('intents', 0)
+        flushes = stats.get('flushes', 0)
+
+        return {
+            'enabled': self.enabled,
+            'pending': pending,
+            'in_flight': in_flight,
+            'intents': intents,
+            'cancelled': stats.get('cancelled', 0),
+            'dropped': stats.get('dropped', 0),
+            'rows_written': stats.get('rows_written', 0),
+            # rows reaching the database per change requested
+            'coalescing_ratio': (stats.get('rows_written', 0) / intents
+                                 if intents else None),
+            'flushes': flushes,
+            'avg_flush_ms': (stats.get('flush_seconds', 0) * 1000 / flushes
+                             if flushes else None),
+            'max_flush_ms': stats.get('max_flush_seconds', 0) * 1000,
+        }
+
+
+write_behind = WriteBehindBuffer()